@@ -25,33 +25,20 @@ END_OF_UTTERANCE = embedded_assistant_pb2.ConverseResponse.END_OF_UTTERANCE
 def log_converse_request_without_audio(converse_request):
     """Log ConverseRequest fields without audio data."""
     if logging.getLogger().isEnabledFor(logging.DEBUG):
-        resp_copy = embedded_assistant_pb2.ConverseRequest()
-        resp_copy.CopyFrom(converse_request)
-        if len(resp_copy.audio_in) > 0:
-            size = len(resp_copy.audio_in)
-            resp_copy.ClearField('audio_in')
+        # audio_in is in a oneof, a request carrying audio has nothing else.
+        if converse_request.WhichOneof('converse_request') == 'audio_in':
             logging.debug('ConverseRequest: audio_in (%d bytes)',
-                          size)
+                          len(converse_request.audio_in))
             return
-        logging.debug('ConverseRequest: %s', resp_copy)
+        logging.debug('ConverseRequest: %s', converse_request)
 
 
 def log_converse_response_without_audio(converse_response):
     """Log ConverseResponse fields without audio data."""
     if logging.getLogger().isEnabledFor(logging.DEBUG):
-        resp_copy = embedded_assistant_pb2.ConverseResponse()
-        resp_copy.CopyFrom(converse_response)
-        has_audio_data = (resp_copy.HasField('audio_out') and
-                          len(resp_copy.audio_out.audio_data) > 0)
-        if has_audio_data:
-            size = len(resp_copy.audio_out.audio_data)
-            resp_copy.audio_out.ClearField('audio_data')
-            if resp_copy.audio_out.ListFields():
-                logging.debug('ConverseResponse: %s audio_data (%d bytes)',
-                              resp_copy,
-                              size)
-            else:
-                logging.debug('ConverseResponse: audio_data (%d bytes)',
-                              size)
+        # Same for audio_out, logged without copying the message.
+        if converse_response.WhichOneof('converse_response') == 'audio_out':
+            logging.debug('ConverseResponse: audio_data (%d bytes)',
+                          len(converse_response.audio_out.audio_data))
             return
-        logging.debug('ConverseResponse: %s', resp_copy)
+        logging.debug('ConverseResponse: %s', converse_response)
@@ -0,0 +1,651 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Device runtime on one asyncio event loop, talking to the API with grpc.aio.
+
+The button, the conversations and the LED animations are tasks on the
+loop. Only the blocking sound device calls run on threads, one per
+direction, behind AsyncConversationStream. A push during a conversation
+cancels it: the Converse call is cancelled, recording stops and the
+queued answer is dropped.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import signal
+import time
+
+import grpc
+import grpc.aio
+
+from google.rpc import code_pb2
+from tenacity import retry, stop_after_attempt, retry_if_exception
+
+from push_button import PushButtonEvent
+
+try:
+    from . import (
+        assistant_helpers,
+        audio_codecs,
+        audio_helpers,
+        channel_helpers,
+        led_animator,
+        push_red_to_talk,
+        turn_tracing
+    )
+except (SystemError, ImportError):
+    import assistant_helpers
+    import audio_codecs
+    import audio_helpers
+    import channel_helpers
+    import led_animator
+    import push_red_to_talk
+    import turn_tracing
+
+
+# Writes queued for the playback thread before write() waits for them,
+# the back pressure on the Converse call.
+DEFAULT_MAX_PENDING_WRITES = 4
+
+# Returned by next() at the end of a blocking iterator.
+_END = object()
+
+
+def audio_executor(direction):
+    """Returns a single thread executor for the sound device calls of a direction."""
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix='audio-%s' % direction)
+
+
+class AsyncConversationStream(object):
+    """Coroutine interface of a ConversationStream.
+
+    The blocking reads and writes of the sound device run on two single
+    thread executors, one per direction, so a read waiting for the
+    microphone never holds up the answer. A cancelled read or write
+    returns at once, the device call it waited on ends in the background
+    within a block.
+
+    Args:
+      conversation_stream(ConversationStream): stream adapted.
+      capture_executor: executor of the reads, shared across
+        conversations. A new one is used and shut down on close() if
+        missing.
+      playback_executor: executor of the writes, same as capture_executor.
+      max_pending_writes: writes queued before write() waits.
+    """
+    def __init__(self, conversation_stream, capture_executor=None,
+                 playback_executor=None,
+                 max_pending_writes=DEFAULT_MAX_PENDING_WRITES):
+        self.stream = conversation_stream
+        self._owned = []
+        if capture_executor is None:
+            capture_executor = audio_executor(audio_helpers.LEVELS_CAPTURE)
+            self._owned.append(capture_executor)
+        if playback_executor is None:
+            playback_executor = audio_executor(audio_helpers.LEVELS_PLAYBACK)
+            self._owned.append(playback_executor)
+        self._capture = capture_executor
+        self._playback = playback_executor
+        self._max_pending_writes = max_pending_writes
+        self._pending = collections.deque()
+
+    async def _run(self, executor, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, func, *args)
+
+    async def start_recording(self):
+        await self._run(self._capture, self.stream.start_recording)
+
+    def stop_recording(self):
+        """Make the read in flight the last one, see ConversationStream."""
+        self.stream.stop_recording()
+
+    async def iterate(self, iterator):
+        """Yields the items of a blocking iterator advanced on the capture thread.
+
+        Args:
+          iterator: iterator reading the stream, e.g. the audio requests
+            of SampleAssistant.gen_converse_requests().
+        """
+        while True:
+            item = await self._run(self._capture, next, iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+    def start_playback(self):
+        self.stream.start_playback()
+
+    async def write(self, buf):
+        """Queue bytes for the playback thread, waiting when too many are."""
+        loop = asyncio.get_running_loop()
+        self._pending.append(
+            loop.run_in_executor(self._playback, self.stream.write, buf))
+        while len(self._pending) > self._max_pending_writes:
+            await self._pending.popleft()
+
+    async def run_on_playback(self, func, *args):
+        """Runs func(*args) on the playback thread, after the queued writes."""
+        return await self._run(self._playback, func, *args)
+
+    def call_on_playback(self, func, *args):
+        """Runs func(*args) on the playback thread without waiting.
+
+        Returns: concurrent.futures.Future of the call.
+        """
+        return self._playback.submit(func, *args)
+
+    async def drain(self):
+        """Wait for the queued writes."""
+        while self._pending:
+            await self._pending.popleft()
+
+    async def stop_playback(self):
+        """Stop playback once the queued audio has played."""
+        await self.drain()
+        await self._run(self._playback, self.stream.stop_playback)
+
+    def abort(self):
+        """Stop recording and drop the queued answer, without waiting.
+
+        Returns: concurrent.futures.Future of the playback stop.
+        """
+        self.stream.stop_recording()
+        while self._pending:
+            self._pending.popleft().cancel()
+        playback_buffer = self.stream.playback_buffer
+        if playback_buffer is not None:
+            # Ends a drain in progress on the playback thread.
+            playback_buffer.abort(wait=False)
+        return self.call_on_playback(self.stream.stop_playback, True)
+
+    def close(self):
+        """Close the stream after the calls in flight, see ConversationStream.
+
+        Returns: concurrent.futures.Future of the close.
+        """
+        closed = self.call_on_playback(self.stream.close)
+        for executor in self._owned:
+            executor.shutdown(wait=False)
+        return closed
+
+    @property
+    def xruns(self):
+        return self.stream.xruns
+
+    @property
+    def sample_rate(self):
+        return self.stream.sample_rate
+
+
+class AsyncAssistant(push_red_to_talk.SampleAssistant):
+    """SampleAssistant holding its conversations on an asyncio event loop.
+
+    Takes a grpc.aio channel and the same arguments as SampleAssistant,
+    except channel_monitor: the state of an aio channel is read as is.
+    converse() is a coroutine, cancelling it cancels the Converse call.
+
+    Args:
+      audio(AsyncConversationStream): optional adapter of the conversation
+        stream, e.g. with executors shared across conversations.
+    """
+
+    def __init__(self, conversation_stream, channel, deadline_sec,
+                 audio=None, **kwargs):
+        super(AsyncAssistant, self).__init__(conversation_stream, channel,
+                                             deadline_sec, **kwargs)
+        self.channel = channel
+        self.audio = (audio if audio is not None
+                      else AsyncConversationStream(conversation_stream))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, etype, e, traceback):
+        # Also on errors, to stop the playback worker of a shared device.
+        closed = self.audio.close()
+        # A cancelled conversation ends without waiting for the device.
+        if etype is not asyncio.CancelledError:
+            await asyncio.wrap_future(closed)
+        return False
+
+    @retry(reraise=True, stop=stop_after_attempt(3),
+           retry=retry_if_exception(
+               push_red_to_talk.SampleAssistant.is_grpc_error_unavailable))
+    async def converse(self):
+        """Send a voice request to the Assistant and playback the response.
+
+        Returns: True if conversation should continue.
+        """
+        continue_conversation = False
+
+        # Calling on a channel known to be down only burns time.
+        state = self.channel.get_state()
+        if state in channel_helpers.DOWN_STATES:
+            raise channel_helpers.ChannelUnavailableError(
+                'gRPC channel is %s' % state)
+
+        # Follow-on turns are traced from here, the first one from the push.
+        if self.tracer.current is None:
+            self.tracer.start_turn()
+        xruns_before = sum(self.audio.xruns.values())
+
+        await self.audio.start_recording()
+        self.led.start_breathing()
+        logging.info('Recording audio request.')
+        # The answer plays once the request has been sent, as the
+        # blocking stream does.
+        request_sent = asyncio.Event()
+
+        async def iter_converse_requests():
+            async for c in self.audio.iterate(self.gen_converse_requests()):
+                assistant_helpers.log_converse_request_without_audio(c)
+                if self.recorder is not None:
+                    self.recorder.record_request(call, c)
+                self.tracer.mark(turn_tracing.FIRST_REQUEST_SENT)
+                if c.audio_in:
+                    self.tracer.count(turn_tracing.BYTES_SENT, len(c.audio_in))
+                yield c
+            request_sent.set()
+
+        # Compressed answers are decoded as they arrive, the decoder
+        # thread writes them to the stream.
+        decoder = None
+        if self.audio_out_encoding != audio_codecs.AUDIO_OUT_LINEAR16:
+            decoder = audio_codecs.StreamDecoder(
+                self.play_audio, self.audio.sample_rate)
+        call = None
+        if self.recorder is not None:
+            call = self.recorder.start_call()
+        error = None
+        playing = False
+        rpc = self.assistant.Converse(iter_converse_requests(),
+                                      timeout=self.deadline)
+        try:
+            async for resp in rpc:
+                assistant_helpers.log_converse_response_without_audio(resp)
+                if self.recorder is not None:
+                    self.recorder.record_response(call, resp)
+                if resp.error.code != code_pb2.OK:
+                    logging.error('server error: %s', resp.error.message)
+                    break
+                if resp.event_type == push_red_to_talk.END_OF_UTTERANCE:
+                    logging.info('End of audio request detected')
+                    self.tracer.mark(turn_tracing.END_OF_UTTERANCE)
+                    self.audio.stop_recording()
+                    self.led.stop()
+                if resp.result.spoken_request_text:
+                    self.print_spoken_request(resp)
+                if len(resp.audio_out.audio_data) > 0:
+                    self.tracer.mark(turn_tracing.FIRST_AUDIO_OUT)
+                    self.tracer.count(turn_tracing.BYTES_RECEIVED,
+                                      len(resp.audio_out.audio_data))
+                    if not playing:
+                        await request_sent.wait()
+                        self.audio.start_playback()
+                        playing = True
+                    if decoder is not None:
+                        await self.audio.run_on_playback(
+                            decoder.feed, resp.audio_out.audio_data)
+                    else:
+                        await self.audio.write(resp.audio_out.audio_data)
+                if resp.result.spoken_response_text:
+                    self.print_response(resp)
+                if resp.result.conversation_state:
+                    self.conversation_state = resp.result.conversation_state
+                if resp.result.volume_percentage != 0:
+                    self.conversation_stream.volume_percentage = (
+                        resp.result.volume_percentage
+                    )
+                if resp.result.microphone_mode == push_red_to_talk.DIALOG_FOLLOW_ON:
+                    continue_conversation = True
+                    logging.info('Expecting follow-on query from user.')
+                elif resp.result.microphone_mode == push_red_to_talk.CLOSE_MICROPHONE:
+                    continue_conversation = False
+            if decoder is not None:
+                await self.audio.run_on_playback(decoder.close)
+                decoder = None
+        except grpc.RpcError as e:
+            error = str(e.code())
+            self.audio.abort()
+            self.led.stop()
+            raise
+        except asyncio.CancelledError:
+            error = 'cancelled'
+            rpc.cancel()
+            self.audio.abort()
+            self.led.stop()
+            raise
+        finally:
+            if decoder is not None:
+                # Closing waits for the decoder thread, after the aborted
+                # stream took its last writes.
+                self.audio.call_on_playback(decoder.close)
+            if self.recorder is not None:
+                self.recorder.end_call(call, error)
+        logging.info('Finished playing assistant response.')
+        self.audio.stop_recording()
+        await self.audio.stop_playback()
+        self.tracer.mark(turn_tracing.STOP_PLAYBACK)
+        self.tracer.count(turn_tracing.XRUNS,
+                          sum(self.audio.xruns.values()) - xruns_before)
+        self.tracer.finish_turn()
+        return continue_conversation
+
+
+class AsyncPushButton(object):
+    """Coroutine interface of a PushButton, without a thread of its own.
+
+    GPIO edge callbacks wake the event loop up, polling sleeps on it.
+    Events are debounced and long presses reported like
+    PushButton.events() does.
+
+    Args:
+      button(PushButton): button read, its GPIO is set up on first use.
+    """
+    def __init__(self, button):
+        self.button = button
+
+    def events(self):
+        """Returns an async iterator of PushButtonEvents, until cancelled."""
+        if not self.button.gpio_inited:
+            self.button.init_gpio()
+        if self.button.edge_detection:
+            return self._edge_events()
+        return self._polled_events()
+
+    def _is_long_press(self, pressed, pressed_at, now):
+        return (pressed and self.button.long_press_time is not None
+                and now - pressed_at >= self.button.long_press_time)
+
+    def _event(self, pressed):
+        return PushButtonEvent.PRESS if pressed else PushButtonEvent.RELEASE
+
+    async def _polled_events(self):
+        pressed = self.button.is_pressed()
+        pressed_at = time.monotonic()
+        long_press_reported = False
+        while True:
+            await asyncio.sleep(self.button.sleep_time)
+            now = time.monotonic()
+            if self.button.is_pressed() != pressed:
+                pressed = not pressed
+                pressed_at = now
+                long_press_reported = False
+                yield self._event(pressed)
+            elif self._is_long_press(pressed, pressed_at, now) \
+                    and not long_press_reported:
+                long_press_reported = True
+                yield PushButtonEvent.LONG_PRESS
+
+    async def _edge_events(self):
+        button = self.button
+        loop = asyncio.get_running_loop()
+        edge = asyncio.Event()
+        button.gpio.add_edge_callback(
+            button.button_gpio_pin,
+            lambda pin: loop.call_soon_threadsafe(edge.set))
+        try:
+            pressed = button.is_pressed()
+            pressed_at = time.monotonic()
+            long_press_reported = False
+            # State changes are reported on the leading edge, the contacts
+            # are then left to settle before the level is read again.
+            settled_at = 0
+            recheck = False
+            while True:
+                deadlines = []
+                if recheck:
+                    deadlines.append(settled_at)
+                if pressed and button.long_press_time is not None \
+                        and not long_press_reported:
+                    deadlines.append(pressed_at + button.long_press_time)
+                timeout = None
+                if deadlines:
+                    timeout = max(0, min(deadlines) - time.monotonic())
+                try:
+                    await asyncio.wait_for(edge.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                edge.clear()
+
+                now = time.monotonic()
+                if now < settled_at:
+                    recheck = True
+                    continue
+                recheck = False
+                if button.is_pressed() != pressed:
+                    pressed = not pressed
+                    pressed_at = now
+                    long_press_reported = False
+                    settled_at = now + button.debounce_time
+                    recheck = True
+                    yield self._event(pressed)
+                    # Forget the edges seen while the event was handled.
+                    edge.clear()
+                elif self._is_long_press(pressed, pressed_at, now) \
+                        and not long_press_reported:
+                    long_press_reported = True
+                    yield PushButtonEvent.LONG_PRESS
+                    edge.clear()
+                    recheck = True
+        finally:
+            button.gpio.remove_edge_callback(button.button_gpio_pin)
+
+
+async def connect_channel(manager, keepalive_time_ms,
+                          timeout=push_red_to_talk.DEFAULT_CHANNEL_CONNECT_TIMEOUT,
+                          api_endpoint=push_red_to_talk.ASSISTANT_API_ENDPOINT):
+    """Returns a grpc.aio channel authorized by a CredentialManager, connected.
+
+    Must run on the event loop the channel is used from.
+    """
+    import google.auth.transport.grpc
+    credentials = grpc.composite_channel_credentials(
+        grpc.ssl_channel_credentials(),
+        grpc.metadata_call_credentials(
+            google.auth.transport.grpc.AuthMetadataPlugin(
+                manager.credentials, manager.request)))
+    channel = grpc.aio.secure_channel(
+        api_endpoint, credentials,
+        options=channel_helpers.keepalive_options(keepalive_time_ms))
+    logging.info('Connecting to %s', api_endpoint)
+    started_at = time.monotonic()
+    try:
+        await asyncio.wait_for(channel.channel_ready(), timeout)
+        logging.info('gRPC channel ready after %.1f ms',
+                     (time.monotonic() - started_at) * 1000)
+    except asyncio.TimeoutError:
+        logging.warning('gRPC channel not ready after %d s, still connecting', timeout)
+    return channel
+
+
+async def converse_with_assistant(
+        audio_device_manager,
+        channel,
+        deadline,
+        bleep_start=None,
+        bleep_end=None,
+        connection_error_cue=None,
+        bleep_overlap=audio_helpers.PROMPT_OVERLAP_DROP,
+        vad=None,
+        playback_buffer_ms=0,
+        audio_in_encoding=audio_codecs.AUDIO_IN_LINEAR16,
+        audio_out_encoding=audio_codecs.AUDIO_OUT_LINEAR16,
+        tracer=None,
+        recorder=None,
+        device_free=None,
+        level_meter=None,
+        led=None,
+        capture_pipeline=None,
+        playback_pipeline=None,
+        executors=(None, None),
+        pushed_at=None
+):
+    """Coroutine counterpart of push_red_to_talk.converse_with_assistant().
+
+    Args:
+      executors: (capture, playback) executors of the sound device calls,
+        see AsyncConversationStream.
+      pushed_at: time.monotonic() of the push, defaults to now.
+      The other arguments are the ones of the blocking version.
+    """
+    loop = asyncio.get_running_loop()
+    pushed_at = pushed_at if pushed_at is not None else time.monotonic()
+    if device_free is not None:
+        # A push during the boot sound waits for it to end.
+        await loop.run_in_executor(None, device_free.wait)
+    tracer = tracer if tracer is not None else turn_tracing.TurnTracer()
+    tracer.start_turn(pushed_at)
+    capture_executor, playback_executor = executors
+    try:
+        audio_device = await loop.run_in_executor(
+            playback_executor, audio_device_manager.device)
+        tracer.mark(turn_tracing.DEVICE_OPEN)
+        state = channel.get_state()
+        if state in channel_helpers.DOWN_STATES:
+            raise channel_helpers.ChannelUnavailableError(
+                'gRPC channel is %s' % state)
+
+        if level_meter is not None:
+            level_meter.reset()
+        conversation_stream = audio_device_manager.conversation_stream(
+            vad=vad, playback_buffer_ms=playback_buffer_ms,
+            level_meter=level_meter, capture_pipeline=capture_pipeline,
+            playback_pipeline=playback_pipeline)
+        if bleep_start:
+            # Start the microphone and the call while the bleep plays.
+            tracer.mark(turn_tracing.BLEEP_START)
+            bleep = bleep_start.play(sink=audio_device, blocking=False)
+            tracer.mark(turn_tracing.BLEEP_END, at=bleep.end_time)
+            conversation_stream.mask_prompt(bleep.end_time, bleep_overlap)
+        audio = AsyncConversationStream(conversation_stream,
+                                        capture_executor, playback_executor)
+        async with AsyncAssistant(
+                conversation_stream=conversation_stream,
+                channel=channel,
+                deadline_sec=deadline,
+                audio=audio,
+                tracer=tracer,
+                audio_in_encoding=audio_in_encoding,
+                audio_out_encoding=audio_out_encoding,
+                recorder=recorder,
+                led=led
+        ) as assistant:
+            while await assistant.converse():
+                continue
+
+        if level_meter is not None:
+            push_red_to_talk.log_audio_levels(level_meter, tracer)
+        push_red_to_talk.log_dsp_timings(conversation_stream, tracer)
+
+        if conversation_stream.first_frame_time is not None:
+            logging.info('First audio frame captured %.1f ms after push',
+                         (conversation_stream.first_frame_time - pushed_at) * 1000)
+        logging.info('Audio xruns so far: %s', audio_device.xruns)
+
+        if bleep_end:
+            await loop.run_in_executor(playback_executor, bleep_end.play,
+                                       audio_device)
+    except asyncio.CancelledError:
+        logging.info('Conversation cancelled %.1f ms after push',
+                     (time.monotonic() - pushed_at) * 1000)
+        tracer.finish_turn(error='cancelled')
+        raise
+    except audio_helpers.AudioDeviceError as e:
+        logging.error('Audio device error: %s, reopening the device', e)
+        tracer.finish_turn(error='audio device error: %s' % e)
+        audio_device_manager.open_in_background()
+    except channel_helpers.ChannelUnavailableError as e:
+        logging.error('Assistant API unreachable: %s', e)
+        tracer.finish_turn(error='channel unavailable: %s' % e)
+        await loop.run_in_executor(
+            playback_executor, push_red_to_talk.play_connection_error_cue,
+            audio_device_manager, connection_error_cue, led)
+    except grpc.RpcError as e:
+        # Unavailable errors have been retried by AsyncAssistant.converse().
+        logging.error('Assistant API call failed: %s', e)
+        tracer.finish_turn(error='rpc error: %s' % e.code().name)
+        await loop.run_in_executor(
+            playback_executor, push_red_to_talk.play_connection_error_cue,
+            audio_device_manager, connection_error_cue, led)
+
+
+def _log_conversation_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error('Conversation failed', exc_info=task.exception())
+
+
+async def serve(button, connect, animator=None, **conversation_options):
+    """Holds a conversation per push until cancelled.
+
+    A push during a conversation cancels it instead of starting another.
+
+    Args:
+      button(AsyncPushButton): button triggering the conversations.
+      connect: coroutine function returning the grpc.aio channel, awaited
+        before the button is armed.
+      animator(LedAnimator): LEDs driven by a task of the loop, defaults to
+        the one shared by the LEDs of the device.
+      conversation_options: arguments of converse_with_assistant(), but
+        the channel.
+    """
+    animator = animator if animator is not None else led_animator.default_animator()
+    leds = asyncio.ensure_future(animator.run())
+    executors = (audio_executor(audio_helpers.LEVELS_CAPTURE),
+                 audio_executor(audio_helpers.LEVELS_PLAYBACK))
+    channel = None
+    conversation = None
+    try:
+        channel = await connect()
+        async for event in button.events():
+            if event != PushButtonEvent.PRESS:
+                continue
+            if conversation is not None and not conversation.done():
+                logging.info('Push during the conversation, cancelling it')
+                conversation.cancel()
+                continue
+            conversation = asyncio.ensure_future(converse_with_assistant(
+                channel=channel, executors=executors,
+                pushed_at=time.monotonic(), **conversation_options))
+            conversation.add_done_callback(_log_conversation_error)
+    finally:
+        tasks = [task for task in (conversation, leds) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if channel is not None:
+            await channel.close()
+        for executor in executors:
+            executor.shutdown(wait=False)
+
+
+def run(main):
+    """Runs the main coroutine on a new event loop.
+
+    SIGTERM (systemd stopping the service) cancels it like Ctrl-C does.
+    """
+    async def run_main():
+        task = asyncio.ensure_future(main)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,
+                                                      task.cancel)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            logging.info('Stopped')
+
+    return asyncio.run(run_main())
@@ -0,0 +1,240 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming codecs for the audio exchanged with the Assistant API."""
+
+import logging
+import os
+import select
+import threading
+import time
+
+import numpy as np
+import soundfile as sf
+
+
+AUDIO_IN_LINEAR16 = 'LINEAR16'
+AUDIO_IN_FLAC = 'FLAC'
+AUDIO_IN_ENCODINGS = (AUDIO_IN_LINEAR16, AUDIO_IN_FLAC)
+
+# MP3 is left out: libsndfile reports MPEG streams as seekable, and
+# soundfile seeks after every read, which fails on a stream.
+AUDIO_OUT_LINEAR16 = 'LINEAR16'
+AUDIO_OUT_OPUS_IN_OGG = 'OPUS_IN_OGG'
+AUDIO_OUT_ENCODINGS = (AUDIO_OUT_LINEAR16, AUDIO_OUT_OPUS_IN_OGG)
+
+# soundfile format and subtype of the compressed output encodings.
+AUDIO_OUT_FORMATS = {
+    AUDIO_OUT_OPUS_IN_OGG: ('OGG', 'OPUS'),
+}
+
+# Frames of PCM handed out per decoded block, 50 ms at 16 kHz.
+DEFAULT_DECODE_BLOCK_FRAMES = 800
+
+# FLAC level 0 encodes 1152 sample blocks, 72 ms at 16 kHz, with the
+# least CPU. Higher levels use 4096 sample blocks.
+DEFAULT_FLAC_COMPRESSION_LEVEL = 0.0
+
+# Errors of libsndfile on a corrupt or truncated stream, logged on close.
+# Any other error, e.g. of the sound device the PCM is written to, is
+# raised again by StreamDecoder.close().
+DECODE_ERRORS = (RuntimeError, ValueError)
+
+
+class StreamOutput(object):
+    """Seekable file-like object handing out bytes as they are written.
+
+    Encoders write their stream sequentially and may seek back on close
+    to patch a header. Bytes returned by take() are gone, so writes to
+    them are dropped: a streamed header keeps its placeholder values.
+    """
+    def __init__(self):
+        self._pending = bytearray()
+        self._taken = 0
+        self._position = 0
+
+    def write(self, data):
+        size = len(data)
+        skip = self._taken - self._position
+        if skip < size:
+            data = memoryview(data)[max(skip, 0):]
+            offset = max(self._position - self._taken, 0)
+            if offset > len(self._pending):
+                self._pending.extend(b'\x00' * (offset - len(self._pending)))
+            self._pending[offset:offset + len(data)] = data
+        self._position += size
+        return size
+
+    def read(self, size=-1):
+        offset = self._position - self._taken
+        if offset < 0:
+            return b''
+        end = len(self._pending) if size < 0 else offset + size
+        data = bytes(self._pending[offset:end])
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self._taken + len(self._pending)
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        """Returns the bytes written since the last call."""
+        data = bytes(self._pending)
+        self._taken += len(data)
+        del self._pending[:]
+        return data
+
+
+class FlacEncoder(object):
+    """Incremental FLAC encoder of mono 16-bit PCM.
+
+    Every chunk passed to encode() returns the FLAC frames completed so
+    far, the stream is never buffered as a whole.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes, only 2 is supported.
+      compression_level: FLAC compression level between 0 and 1.
+    """
+    def __init__(self, sample_rate, sample_width=2,
+                 compression_level=DEFAULT_FLAC_COMPRESSION_LEVEL):
+        if sample_width != 2:
+            raise Exception('unsupported sample width:', sample_width)
+        self._output = StreamOutput()
+        self._file = sf.SoundFile(self._output, mode='w',
+                                  samplerate=sample_rate, channels=1,
+                                  format='FLAC', subtype='PCM_16',
+                                  compression_level=compression_level)
+
+    def encode(self, buf):
+        """Returns the FLAC bytes completed after adding buf."""
+        self._file.buffer_write(buf, dtype='int16')
+        return self._output.take()
+
+    def flush(self):
+        """Ends the stream and returns its last FLAC bytes."""
+        self._file.close()
+        return self._output.take()
+
+    def iter_encoded(self, chunks):
+        """Yields the FLAC bytes of an iterable of PCM chunks."""
+        for chunk in chunks:
+            data = self.encode(chunk)
+            if data:
+                yield data
+        data = self.flush()
+        if data:
+            yield data
+
+
+class StreamDecoder(object):
+    """Incremental decoder of Ogg Opus audio to mono 16-bit PCM.
+
+    The encoded chunks passed to feed() go through a pipe to a decoder
+    thread, which hands PCM to output() as soon as libsndfile decodes a
+    block. Through a pipe libsndfile reads the stream as it comes and
+    never seeks ahead for its length.
+
+    Args:
+      output: callable receiving the decoded PCM bytes.
+      sample_rate: expected sample rate in hertz of the stream.
+      block_frames: number of frames passed to each output() call.
+    """
+    def __init__(self, output, sample_rate,
+                 block_frames=DEFAULT_DECODE_BLOCK_FRAMES):
+        self._output = output
+        self._sample_rate = sample_rate
+        self._block_frames = block_frames
+        self._read_fd, self._write_fd = os.pipe()
+        # Set when the stream ends before any byte was fed.
+        self._empty = False
+        self.error = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # time.monotonic() of the first decoded PCM block.
+        self.first_output_time = None
+        self._thread = threading.Thread(target=self._decode,
+                                        name='audio-decoder', daemon=True)
+        self._thread.start()
+
+    def feed(self, data):
+        """Queue encoded bytes for decoding.
+
+        Blocks while the decoder is a pipe buffer behind.
+        """
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(self._write_fd, view):]
+        except BrokenPipeError:
+            # The decoder stopped, close() reports why.
+            return
+        self.bytes_in += len(data)
+
+    def close(self):
+        """End the stream and wait until all of it has been output.
+
+        Raises:
+          Any error of output(), such as AudioDeviceError. Decoding errors
+          are logged.
+        """
+        if self._write_fd is not None:
+            self._empty = self.bytes_in == 0
+            os.close(self._write_fd)
+            self._write_fd = None
+        self._thread.join()
+        if self.error is None:
+            return
+        if not isinstance(self.error, DECODE_ERRORS):
+            raise self.error
+        logging.error('Error decoding audio: %s', self.error)
+
+    def _decode(self):
+        try:
+            # soundfile opens files under a process wide lock, wait for the
+            # stream instead of blocking every other open on an empty pipe.
+            select.select([self._read_fd], [], [])
+            if self._empty:
+                # An answer without audio, there is no stream to open.
+                return
+            with sf.SoundFile(self._read_fd, closefd=False) as f:
+                if f.samplerate != self._sample_rate:
+                    logging.warning('Decoded audio is %d Hz, expected %d Hz',
+                                    f.samplerate, self._sample_rate)
+                samples = np.empty((self._block_frames, f.channels),
+                                   dtype='<i2')
+                while True:
+                    frames = f.buffer_read_into(samples, dtype='int16')
+                    if not frames:
+                        break
+                    block = samples[:frames]
+                    if f.channels > 1:
+                        block = block.mean(axis=1).astype('<i2')
+                    pcm = block.tobytes()
+                    if self.first_output_time is None:
+                        self.first_output_time = time.monotonic()
+                    self.bytes_out += len(pcm)
+                    self._output(pcm)
+        except Exception as e:
+            self.error = e
+        finally:
+            os.close(self._read_fd)
@@ -14,15 +14,30 @@
 
 """Helper functions for audio streams."""
 
+import collections
+import io
 import logging
+import mmap
 import threading
 import time
 import wave
 import math
-import array
 
 import click
-import sounddevice as sd
+import numpy as np
+
+try:
+    import sounddevice as sd
+except OSError as e:
+    # sounddevice loads the PortAudio library on import. LoopbackStream,
+    # and so the tests, work without it.
+    sd = None
+    _sounddevice_error = e
+
+try:
+    from . import audio_pipeline
+except (SystemError, ImportError):
+    import audio_pipeline
 
 
 DEFAULT_AUDIO_SAMPLE_RATE = 16000
@@ -31,6 +46,63 @@ DEFAULT_AUDIO_ITER_SIZE = 3200
 DEFAULT_AUDIO_DEVICE_BLOCK_SIZE = 6400
 DEFAULT_AUDIO_DEVICE_FLUSH_SIZE = 25600
 
+DEFAULT_PLAYBACK_BUFFER_MS = 300
+DEFAULT_PLAYBACK_BUFFER_MIN_MS = 100
+DEFAULT_PLAYBACK_BUFFER_MAX_MS = 1500
+DEFAULT_PLAYBACK_QUEUE_MS = 5000
+
+DEFAULT_VAD_FRAME_MS = 10
+DEFAULT_VAD_ENERGY_THRESHOLD_DB = -45
+DEFAULT_VAD_ZCR_THRESHOLD = 0.35
+DEFAULT_VAD_SPEECH_START_MS = 60
+DEFAULT_VAD_ENDPOINT_MS = 800
+DEFAULT_VAD_LEADING_PAD_MS = 300
+DEFAULT_VAD_MAX_LEADING_SILENCE_MS = 8000
+
+# Zero crossings of the windowed sinc on each side, the quality of the
+# Resampler: 16 gives a transition band of about 10 % of the Nyquist
+# frequency and over 80 dB of attenuation.
+DEFAULT_RESAMPLER_ZERO_CROSSINGS = 16
+DEFAULT_RESAMPLER_KAISER_BETA = 8.6
+# Ratios decimating by up to this factor filter each phase by convolution,
+# which wastes down - 1 outputs out of down but beats gathering the taps.
+MAX_CONVOLVED_DOWN = 8
+
+DEFAULT_LEVEL_METER_RATE_HZ = 20
+LEVELS_CAPTURE = 'capture'
+LEVELS_PLAYBACK = 'playback'
+# Samples at or beyond this magnitude count as clipped.
+DEFAULT_CLIP_LEVEL = 32767
+
+# Round-trip latency of the LoopbackStream, from playing a frame to
+# capturing it.
+DEFAULT_LOOPBACK_LATENCY_MS = 20
+
+# Raised by the sound device when it fails or disappears (e.g. USB unplug).
+if sd is not None:
+    AudioDeviceError = sd.PortAudioError
+else:
+    class AudioDeviceError(Exception):
+        pass
+
+
+def _sounddevice():
+    """Returns the sounddevice module, raising why it cannot be imported."""
+    if sd is None:
+        raise _sounddevice_error
+    return sd
+
+# What ConversationStream does with audio captured while a prompt plays.
+PROMPT_OVERLAP_DROP = 'drop'
+PROMPT_OVERLAP_MUTE = 'mute'
+PROMPT_OVERLAP_KEEP = 'keep'
+PROMPT_OVERLAP_MODES = (PROMPT_OVERLAP_DROP, PROMPT_OVERLAP_MUTE,
+                        PROMPT_OVERLAP_KEEP)
+
+
+# Shared with the gain stage of the playback pipeline.
+volume_scale_factor = audio_pipeline.volume_scale_factor
+
 
 def normalize_audio_buffer(buf, volume_percentage, sample_width=2):
     """Adjusts the loudness of the audio data in the given buffer.
@@ -41,89 +113,426 @@ def normalize_audio_buffer(buf, volume_percentage, sample_width=2):
     and 75% volume scales the amplitude by a factor of 0.681.
     For now we only sample_width 2.
 
+    Runs the gain stage of the playback pipeline, buf is left as is.
+
     Args:
-      buf: byte string containing audio data to normalize.
+      buf: bytes-like object containing audio data to normalize.
       volume_percentage: volume setting as an integer percentage (1-100).
       sample_width: size of a single sample in bytes.
+
+    Returns: bytes with the normalized audio data.
     """
-    if sample_width != 2:
-        raise Exception('unsupported sample width:', sample_width)
-    scale = math.pow(2, 1.0*volume_percentage/100)-1
-    # Construct array from bytes based on sample_width, multiply by scale
-    # and convert it back to bytes
-    arr = array.array('h', buf)
-    for idx in range(0, len(arr)):
-        arr[idx] = int(arr[idx]*scale)
-    buf = arr.tostring()
-    return buf
-
-
-def align_buf(buf, sample_width):
-    """In case of buffer size not aligned to sample_width pad it with 0s"""
-    remainder = len(buf) % sample_width
-    if remainder != 0:
-        buf += b'\0' * (sample_width - remainder)
-    return buf
+    pipeline = audio_pipeline.AudioPipeline(
+        [audio_pipeline.Gain(volume_percentage)], sample_width)
+    return bytes(pipeline.process(buf))
+
+
+class VoiceActivityDetector(object):
+    """Energy and zero-crossing rate voice activity detector.
+
+    Audio is cut into frame_ms frames. A frame is speech when its RMS
+    level is above energy_threshold_db and its zero-crossing rate (share
+    of consecutive samples changing sign) is below zcr_threshold, which
+    rejects hiss and other broadband noise. Frames are classified with
+    vectorized NumPy operations, a turn is then tracked frame by frame:
+    speech starts after speech_start_ms of speech frames in a row and
+    ends after endpoint_ms of non-speech frames in a row.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      frame_ms: length of the classified frames in milliseconds.
+      energy_threshold_db: minimum speech level in dBFS.
+      zcr_threshold: maximum speech zero-crossing rate (0-1).
+      speech_start_ms: speech needed before the turn starts.
+      endpoint_ms: silence after speech that ends the turn.
+      leading_pad_ms: audio kept before the start of speech.
+      max_leading_silence_ms: silence after which a turn without speech
+        is ended.
+    """
+    def __init__(self, sample_rate, sample_width,
+                 frame_ms=DEFAULT_VAD_FRAME_MS,
+                 energy_threshold_db=DEFAULT_VAD_ENERGY_THRESHOLD_DB,
+                 zcr_threshold=DEFAULT_VAD_ZCR_THRESHOLD,
+                 speech_start_ms=DEFAULT_VAD_SPEECH_START_MS,
+                 endpoint_ms=DEFAULT_VAD_ENDPOINT_MS,
+                 leading_pad_ms=DEFAULT_VAD_LEADING_PAD_MS,
+                 max_leading_silence_ms=DEFAULT_VAD_MAX_LEADING_SILENCE_MS):
+        if sample_width != 2:
+            raise Exception('unsupported sample width:', sample_width)
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.frame_ms = frame_ms
+        self.energy_threshold_db = energy_threshold_db
+        self.zcr_threshold = zcr_threshold
+        self.speech_start_ms = speech_start_ms
+        self.endpoint_ms = endpoint_ms
+        self.leading_pad_ms = leading_pad_ms
+        self.max_leading_silence_ms = max_leading_silence_ms
+        self._frame_len = sample_rate * frame_ms // 1000
+        self.reset()
+
+    def reset(self):
+        """Start a new turn."""
+        self._remainder = np.zeros(0, dtype='<i2')
+        self._run = 0
+        self.speech_started = False
+        self.speech_ended = False
+        self.speech_frames = 0
+        self.silence_frames = 0
+        self.bytes_in = 0
+        self.bytes_dropped = 0
+
+    def classify(self, samples):
+        """Returns per-frame speech flags of whole frames of int16 samples."""
+        frames = samples.reshape(-1, self._frame_len).astype(np.float32)
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+        level_db = 20 * np.log10(np.maximum(rms, 1.0) / 32768)
+        negative = np.signbit(frames)
+        zcr = (np.count_nonzero(negative[:, 1:] != negative[:, :-1], axis=1)
+               / float(self._frame_len - 1))
+        return (level_db > self.energy_threshold_db) & \
+            (zcr < self.zcr_threshold)
+
+    def process(self, buf):
+        """Update the turn state with the next block of audio.
+
+        Returns: True once the turn has ended.
+        """
+        self.bytes_in += len(buf)
+        samples = np.concatenate((self._remainder,
+                                  np.frombuffer(buf, dtype='<i2')))
+        whole = len(samples) - len(samples) % self._frame_len
+        self._remainder = samples[whole:]
+        if not whole:
+            return self.speech_ended
+        start_frames = self.speech_start_ms // self.frame_ms
+        end_frames = self.endpoint_ms // self.frame_ms
+        max_leading_frames = self.max_leading_silence_ms // self.frame_ms
+        for is_speech in self.classify(samples[:whole]):
+            if is_speech:
+                self.speech_frames += 1
+            else:
+                self.silence_frames += 1
+            if self.speech_ended:
+                continue
+            self._run = self._run + 1 if is_speech != self.speech_started \
+                else 0
+            if not self.speech_started:
+                if self._run >= start_frames:
+                    self.speech_started = True
+                    self._run = 0
+                elif self.silence_frames >= max_leading_frames:
+                    self.speech_ended = True
+            elif self._run >= end_frames:
+                self.speech_ended = True
+        return self.speech_ended
+
+    def filter(self, chunks):
+        """Yields chunks without leading silence, up to the end of speech.
+
+        Up to leading_pad_ms of audio before the start of speech is kept.
+
+        Args:
+          chunks: iterable of audio buffers.
+        """
+        self.reset()
+        pending = collections.deque()
+        pending_size = 0
+        pad_size = (self.sample_rate * self.sample_width
+                    * self.leading_pad_ms // 1000)
+        for chunk in chunks:
+            ended = self.process(chunk)
+            if not self.speech_started:
+                pending.append(chunk)
+                pending_size += len(chunk)
+                while pending and pending_size - len(pending[0]) >= pad_size:
+                    pending_size -= len(pending[0])
+                    self.bytes_dropped += len(pending.popleft())
+            else:
+                while pending:
+                    yield pending.popleft()
+                yield chunk
+            if ended:
+                break
+        self.bytes_dropped += sum(len(chunk) for chunk in pending)
+
+    def stats(self):
+        """Returns the speech and non-speech statistics of the turn."""
+        return {
+            'speech_ms': self.speech_frames * self.frame_ms,
+            'non_speech_ms': self.silence_frames * self.frame_ms,
+            'bytes_in': self.bytes_in,
+            'bytes_dropped': self.bytes_dropped,
+            'speech_detected': self.speech_started,
+            'endpointed': self.speech_ended,
+        }
+
+
+AudioLevels = collections.namedtuple(
+    'AudioLevels', ('direction', 'rms_db', 'peak_db', 'clipped', 'samples'))
+AudioLevels.__doc__ = """Levels of the audio measured since the previous ones.
+
+Args:
+  direction: LEVELS_CAPTURE or LEVELS_PLAYBACK.
+  rms_db: RMS level in dBFS.
+  peak_db: peak level in dBFS, -inf for digital silence.
+  clipped: number of clipped samples.
+  samples: number of samples measured.
+"""
+
+
+def level_db(amplitude):
+    """Returns the level in dBFS of an int16 amplitude, -inf for 0."""
+    if amplitude <= 0:
+        return float('-inf')
+    return 20 * math.log10(amplitude / 32768.0)
+
+
+class LevelMeter(object):
+    """RMS and peak level metering of the capture and playback audio.
+
+    measure() is called on the audio path with every block. It reads the
+    block through a NumPy view, without copying it, and accumulates its
+    energy, peak and clipped samples. At most rate_hz times a second per
+    direction the accumulated levels are published as AudioLevels: they
+    are handed to a dispatcher thread calling the subscribers, so a slow
+    subscriber never blocks the audio. A subscriber still busy with
+    previous levels only gets the latest ones.
+
+    Totals since the last reset() are kept for each direction, to spot
+    clipping or a dead microphone, see stats().
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      rate_hz: maximum number of levels published per second and direction.
+      clip_level: magnitude from which a sample counts as clipped.
+    """
+    def __init__(self, sample_rate, sample_width,
+                 rate_hz=DEFAULT_LEVEL_METER_RATE_HZ,
+                 clip_level=DEFAULT_CLIP_LEVEL):
+        if sample_width != 2:
+            raise Exception('unsupported sample width:', sample_width)
+        self.sample_rate = sample_rate
+        self.interval = 1.0 / rate_hz
+        self.clip_level = clip_level
+        self._subscribers = []
+        self._pending = {}
+        self._published = threading.Condition()
+        self._dispatcher = None
+        # Per direction: [sum of squares, peak, clipped, samples], for the
+        # levels to publish and for the totals.
+        self._levels = {}
+        self._totals = {}
+        self._publish_at = {}
+        self.latest = {}
+
+    def subscribe(self, callback):
+        """Call callback(AudioLevels) from the dispatcher thread."""
+        with self._published:
+            self._subscribers.append(callback)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch, name='level-meter', daemon=True)
+                self._dispatcher.start()
+
+    def unsubscribe(self, callback):
+        with self._published:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def measure(self, direction, buf):
+        """Meter a block of audio going in direction."""
+        samples = np.frombuffer(buf, dtype='<i2', count=len(buf) // 2)
+        if not len(samples):
+            return
+        peak = max(int(samples.max()), -int(samples.min()))
+        clipped = 0
+        if peak >= self.clip_level:
+            clipped = int(np.count_nonzero(
+                (samples >= self.clip_level) | (samples <= -self.clip_level)))
+        sum_squares = float(np.einsum('i,i->', samples, samples,
+                                      dtype=np.float64))
+        for accumulator in (self._levels, self._totals):
+            levels = accumulator.get(direction)
+            if levels is None:
+                levels = accumulator[direction] = [0.0, 0, 0, 0]
+            levels[0] += sum_squares
+            levels[1] = max(levels[1], peak)
+            levels[2] += clipped
+            levels[3] += len(samples)
+        now = time.monotonic()
+        if now >= self._publish_at.get(direction, 0):
+            self._publish_at[direction] = now + self.interval
+            self._publish(self._to_levels(direction,
+                                          self._levels.pop(direction)))
+
+    @staticmethod
+    def _to_levels(direction, levels):
+        sum_squares, peak, clipped, samples = levels
+        return AudioLevels(direction, level_db(math.sqrt(sum_squares
+                                                         / samples)),
+                           level_db(peak), clipped, samples)
+
+    def _publish(self, levels):
+        self.latest[levels.direction] = levels
+        if not self._subscribers:
+            return
+        with self._published:
+            self._pending[levels.direction] = levels
+            self._published.notify()
+
+    def _dispatch(self):
+        while True:
+            with self._published:
+                while not self._pending:
+                    self._published.wait()
+                pending = list(self._pending.values())
+                self._pending.clear()
+                subscribers = list(self._subscribers)
+            for levels in pending:
+                for callback in subscribers:
+                    try:
+                        callback(levels)
+                    except Exception as e:
+                        logging.warning('Error in audio levels subscriber '
+                                        '%r: %s', callback, e)
+
+    def stats(self, direction):
+        """Returns the totals of a direction since the last reset(), or None.
+
+        digital_silence is True when every sample measured was 0, e.g. a
+        dead or muted microphone.
+        """
+        totals = self._totals.get(direction)
+        if totals is None:
+            return None
+        levels = self._to_levels(direction, totals)
+        return {
+            'rms_db': round(levels.rms_db, 1),
+            'peak_db': round(levels.peak_db, 1),
+            'clipped': levels.clipped,
+            'ms': levels.samples * 1000 // self.sample_rate,
+            'digital_silence': totals[1] == 0,
+        }
+
+    def reset(self):
+        """Clear the totals, e.g. at the start of a turn.
+
+        Levels accumulated but not published yet are dropped too.
+        """
+        self._totals = {}
+        self._levels = {}
+        self._publish_at = {}
 
 
 class WaveSource(object):
     """Audio source that reads audio data from a WAV file.
 
-    Reads are throttled to emulate the given sample rate and silence
-    is returned when the end of the file is reached.
+    The file is memory-mapped when it has a file descriptor and read in
+    whole frames, as memoryviews of the mapping. Reads are scheduled on a monotonic clock to emulate the
+    given sample rate, speed times faster. At the end of the file read()
+    returns b'' and eof is set.
 
     Args:
       fp: file-like stream object to read from.
       sample_rate: sample rate in hertz.
       sample_width: size of a single sample in bytes.
+      speed: pacing relative to real time, 1 reads in real time, N reads
+        N times faster and 0 reads as fast as possible.
     """
-    def __init__(self, fp, sample_rate, sample_width):
+    def __init__(self, fp, sample_rate, sample_width, speed=1.0):
         self._fp = fp
+        self._sample_rate = sample_rate
+        self._sample_width = sample_width
+        self._frame_size = sample_width
+        self._speed = speed
+        data_offset = 0
+        data_size = None
         try:
-            self._wavep = wave.open(self._fp, 'r')
+            wavep = wave.open(self._fp, 'r')
+            # The data chunk starts where the header parsing stopped.
+            data_offset = self._fp.tell()
+            self._frame_size = wavep.getsampwidth() * wavep.getnchannels()
+            data_size = wavep.getnframes() * self._frame_size
+            if (wavep.getframerate() != sample_rate
+                    or self._frame_size != sample_width):
+                logging.warning('WAV file is %d Hz with %d byte frames, '
+                                'expected %d Hz with %d byte frames',
+                                wavep.getframerate(), self._frame_size,
+                                sample_rate, sample_width)
+            wavep.close()
         except wave.Error as e:
             logging.warning('error opening WAV file: %s, '
                             'falling back to RAW format', e)
+        self._mmap = None
+        try:
+            self._mmap = mmap.mmap(self._fp.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            self._data = self._mmap
+        except (AttributeError, io.UnsupportedOperation, ValueError):
+            # In-memory or empty file.
             self._fp.seek(0)
-            self._wavep = None
-        self._sample_rate = sample_rate
-        self._sample_width = sample_width
-        self._sleep_until = 0
+            self._data = self._fp.read()
+        self._position = data_offset
+        self._end = len(self._data)
+        if data_size is not None:
+            self._end = min(self._end, data_offset + data_size)
+        self._clock_start = None
+        self._clock_position = 0
 
     def read(self, size):
-        """Read bytes from the stream and block until sample rate is achieved.
+        """Read whole frames, blocking until they would have been captured.
 
         Args:
           size: number of bytes to read from the stream.
+
+        Returns: read-only memoryview of up to size bytes, b'' at the end
+          of the file.
         """
-        now = time.time()
-        missing_dt = self._sleep_until - now
-        if missing_dt > 0:
-            time.sleep(missing_dt)
-        self._sleep_until = time.time() + self._sleep_time(size)
-        data = (self._wavep.readframes(size)
-                if self._wavep
-                else self._fp.read(size))
-        #  When reach end of audio stream, pad remainder with silence (zeros).
-        if not data:
-            return b'\x00' * size
-        return data
+        start = self._position
+        end = min(start + size // self._frame_size * self._frame_size,
+                  self._end)
+        if end <= start:
+            return b''
+        self._position = end
+        if self._speed:
+            if self._clock_start is None:
+                self._clock_start = time.monotonic()
+                self._clock_position = start
+            bytes_per_second = self._sample_rate * self._frame_size
+            due = self._clock_start + ((end - self._clock_position)
+                                       / bytes_per_second / self._speed)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return memoryview(self._data)[start:end]
+
+    @property
+    def eof(self):
+        """True once all the audio data has been read."""
+        return self._position >= self._end
 
     def close(self):
-        """Close the underlying stream."""
-        if self._wavep:
-            self._wavep.close()
-        self._fp.close()
+        """Close the underlying stream.
 
-    def _sleep_time(self, size):
-        sample_count = size / float(self._sample_width)
-        sample_rate_dt = sample_count / float(self._sample_rate)
-        return sample_rate_dt
+        The mapping outlives the views still held on it, e.g. by a VAD, and
+        is unmapped once they are released.
+        """
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+        self._fp.close()
 
     def start(self):
-        pass
+        # Pace the reads from the start of each recording.
+        self._clock_start = None
 
-    def stop(self):
+    def stop(self, flush=True):
         pass
 
     @property
@@ -162,10 +571,227 @@ class WaveSink(object):
     def start(self):
         pass
 
-    def stop(self):
+    def stop(self, flush=True):
         pass
 
 
+class Resampler(object):
+    """Streaming polyphase resampler between two sample rates.
+
+    The rates are converted by an up/down ratio through a Kaiser windowed
+    sinc low-pass filter, split in `up` phases so only the taps of the
+    phase of each output sample are computed. Each block is processed
+    with vectorized NumPy operations, the last input samples are kept to
+    filter the next block: a stream cut in blocks resamples exactly like
+    the whole stream. The output is aligned on the input and lags it by
+    zero_crossings input samples, see flush().
+
+    Args:
+      from_rate: sample rate in hertz of the input.
+      to_rate: sample rate in hertz of the output.
+      zero_crossings: zero crossings of the sinc on each side, the higher
+        the sharper the filter and the more CPU it takes.
+    """
+    def __init__(self, from_rate, to_rate,
+                 zero_crossings=DEFAULT_RESAMPLER_ZERO_CROSSINGS):
+        divisor = math.gcd(from_rate, to_rate)
+        self.from_rate = from_rate
+        self.to_rate = to_rate
+        self.up = to_rate // divisor
+        self.down = from_rate // divisor
+        # Center of the filter, in samples at the upsampled rate.
+        self._offset = zero_crossings * max(self.up, self.down)
+        length = 2 * self._offset + 1
+        self.taps = -(-length // self.up)
+        cutoff = 1.0 / max(self.up, self.down)
+        positions = np.arange(length) - self._offset
+        prototype = (self.up * cutoff * np.sinc(cutoff * positions)
+                     * np.kaiser(length, DEFAULT_RESAMPLER_KAISER_BETA))
+        prototype = np.concatenate(
+            (prototype, np.zeros(self.taps * self.up - length)))
+        # One row of taps per phase, in the order of the input samples.
+        self._phases = np.ascontiguousarray(
+            prototype.reshape(self.taps, self.up).T[:, ::-1],
+            dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        """Start a new stream."""
+        self._history = np.zeros(self.taps - 1, dtype=np.float32)
+        self._samples_in = 0
+        self._samples_out = 0
+
+    def resample(self, samples):
+        """Returns the float32 output samples due after the input samples.
+
+        Args:
+          samples: NumPy array of input samples, of any numeric type.
+        """
+        extended = np.concatenate((self._history,
+                                   samples.astype(np.float32, copy=False)))
+        samples_in = self._samples_in + len(samples)
+        # Output k needs the inputs up to (k * down + offset) // up.
+        end = (samples_in * self.up - 1 - self._offset) // self.down + 1
+        count = max(end - self._samples_out, 0)
+        if self.down <= MAX_CONVOLVED_DOWN:
+            resampled = self._convolve(extended, count)
+        else:
+            resampled = self._gather(extended, count)
+        self._history = extended[len(extended) - (self.taps - 1):].copy()
+        self._samples_in = samples_in
+        self._samples_out += count
+        return resampled
+
+    def _convolve(self, extended, count):
+        # Outputs k, k + up, k + 2 up... share a phase and their inputs
+        # are down samples apart: each phase is a plain FIR filter,
+        # computed for every input and kept every down outputs.
+        resampled = np.empty(count, dtype=np.float32)
+        for output in range(min(self.up, count)):
+            position = (self._samples_out + output) * self.down + self._offset
+            row = position // self.up - self._samples_in
+            filtered = np.convolve(extended[row:],
+                                   self._phases[position % self.up][::-1],
+                                   'valid')
+            outputs = resampled[output::self.up]
+            outputs[:] = filtered[::self.down][:len(outputs)]
+        return resampled
+
+    def _gather(self, extended, count):
+        # With many phases, the taps of each output are gathered instead.
+        positions = (np.arange(self._samples_out, self._samples_out + count)
+                     * self.down + self._offset)
+        windows = np.lib.stride_tricks.sliding_window_view(extended,
+                                                           self.taps)
+        return np.einsum(
+            'ij,ij->i', windows[positions // self.up - self._samples_in],
+            self._phases[positions % self.up])
+
+    def flush(self):
+        """Returns the last output samples of the stream and starts a new one.
+
+        The output then has the duration of the input.
+        """
+        missing = -(-self._samples_in * self.up // self.down) - self._samples_out
+        resampled = self.resample(np.zeros(self.taps, dtype=np.float32))
+        self.reset()
+        return resampled[:max(missing, 0)]
+
+    def process(self, buf):
+        """Resamples a block of 16-bit little endian PCM bytes."""
+        return _float_to_pcm16(self.resample(np.frombuffer(buf, dtype='<i2')))
+
+
+def _float_to_pcm16(samples):
+    """Returns float32 samples rounded to 16-bit little endian PCM bytes."""
+    np.rint(samples, out=samples)
+    np.clip(samples, -32768, 32767, out=samples)
+    return samples.astype('<i2').tobytes()
+
+
+def resample(samples, from_rate, to_rate):
+    """Returns whole float32 samples resampled, see Resampler."""
+    if from_rate == to_rate:
+        return samples.astype(np.float32, copy=False)
+    resampler = Resampler(from_rate, to_rate)
+    return np.concatenate((resampler.resample(samples), resampler.flush()))
+
+
+class ResamplingStream(object):
+    """Sound device running at its own rate, seen at another one.
+
+    Wraps a SoundDeviceStream (or CallbackSoundDeviceStream) opened at the
+    native rate of the hardware. Reads and writes are resampled from and
+    to sample_rate, each direction keeping its filter state across blocks.
+    start() begins a new stream in each direction and stop() plays the
+    end of the audio still in the playback filter. The rest is handed to
+    the device. Prompts are written from their own thread while a turn
+    starts, so the playback filter is guarded by a lock.
+
+    Args:
+      device: SoundDeviceStream opened at its native rate.
+      sample_rate: sample rate in hertz of the audio read and written.
+      sample_width: size of a single sample in bytes.
+    """
+    def __init__(self, device, sample_rate, sample_width):
+        if sample_width != 2:
+            raise Exception('unsupported sample width:', sample_width)
+        self._device = device
+        self._sample_rate = sample_rate
+        self._sample_width = sample_width
+        self._capture = Resampler(device.sample_rate, sample_rate)
+        self._playback = Resampler(sample_rate, device.sample_rate)
+        self._playback_lock = threading.Lock()
+        self._captured = bytearray()
+
+    def read(self, size):
+        """Read size bytes at sample_rate."""
+        while len(self._captured) < size:
+            missing = (size - len(self._captured)) // self._sample_width
+            frames = -(-missing * self._capture.down // self._capture.up)
+            self._captured += self._capture.process(
+                self._device.read(frames * self._sample_width))
+        buf = bytes(self._captured[:size])
+        del self._captured[:size]
+        return buf
+
+    def write(self, buf):
+        """Write bytes at sample_rate."""
+        with self._playback_lock:
+            self._device.write(self._playback.process(buf))
+        return len(buf)
+
+    def write_native(self, buf):
+        """Write bytes at device_sample_rate, past the resampler."""
+        with self._playback_lock:
+            self._device.write(buf)
+        return len(buf)
+
+    def flush(self):
+        self._device.flush()
+
+    def start(self):
+        with self._playback_lock:
+            self._playback.reset()
+        # Always-on capture reads one continuous stream, from its thread.
+        if not self.keep_active:
+            self._capture.reset()
+            del self._captured[:]
+        self._device.start()
+
+    def stop(self, flush=True):
+        if flush:
+            with self._playback_lock:
+                tail = self._playback.flush()
+                if len(tail):
+                    self._device.write(_float_to_pcm16(tail))
+        self._device.stop(flush)
+
+    def close(self):
+        self._device.close()
+
+    @property
+    def keep_active(self):
+        return self._device.keep_active
+
+    @keep_active.setter
+    def keep_active(self, keep_active):
+        self._device.keep_active = keep_active
+
+    @property
+    def xruns(self):
+        return self._device.xruns
+
+    @property
+    def device_sample_rate(self):
+        """Sample rate in hertz the hardware runs at."""
+        return self._device.sample_rate
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+
 class SoundDeviceStream(object):
     """Audio stream based on an underlying sound device.
 
@@ -182,18 +808,32 @@ class SoundDeviceStream(object):
             audio_format = 'int16'
         else:
             raise Exception('unsupported sample width:', sample_width)
-        self._audio_stream = sd.RawStream(
-            samplerate=sample_rate, dtype=audio_format, channels=1,
-            blocksize=int(block_size/2),  # blocksize is in number of frames.
-        )
         self._block_size = block_size
         self._flush_size = flush_size
         self._sample_rate = sample_rate
+        self._sample_width = sample_width
+        # Prompts and conversations may start and stop the stream
+        # from different threads.
+        self._state_lock = threading.Lock()
+        # Ignore stop() while set, for always-on capture.
+        self.keep_active = False
+        self.input_overflows = 0
+        self.output_underflows = 0
+        self._audio_stream = self._open_stream(sample_rate, audio_format,
+                                               block_size)
+
+    def _open_stream(self, sample_rate, audio_format, block_size):
+        return _sounddevice().RawStream(
+            samplerate=sample_rate, dtype=audio_format, channels=1,
+            # blocksize is in number of frames.
+            blocksize=int(block_size/self._sample_width),
+        )
 
     def read(self, size):
         """Read bytes from the stream."""
-        buf, overflow = self._audio_stream.read(size)
+        buf, overflow = self._audio_stream.read(size // self._sample_width)
         if overflow:
+            self.input_overflows += 1
             logging.warning('SoundDeviceStream read overflow (%d, %d)',
                             size, len(buf))
         return bytes(buf)
@@ -202,6 +842,7 @@ class SoundDeviceStream(object):
         """Write bytes to the stream."""
         underflow = self._audio_stream.write(buf)
         if underflow:
+            self.output_underflows += 1
             logging.warning('SoundDeviceStream write underflow (size: %d)',
                             len(buf))
         return len(buf)
@@ -212,26 +853,658 @@ class SoundDeviceStream(object):
 
     def start(self):
         """Start the underlying stream."""
-        if not self._audio_stream.active:
-            self._audio_stream.start()
+        with self._state_lock:
+            if not self._audio_stream.active:
+                self._audio_stream.start()
 
-    def stop(self):
-        """Stop the underlying stream."""
-        if self._audio_stream.active:
-            self.flush()
-            self._audio_stream.stop()
+    def stop(self, flush=True):
+        """Stop the underlying stream.
+
+        Args:
+          flush: write flush_size bytes of silence before stopping.
+        """
+        if self.keep_active:
+            return
+        with self._state_lock:
+            if self._audio_stream.active:
+                if flush:
+                    self.flush()
+                self._audio_stream.stop()
 
     def close(self):
         """Close the underlying stream and audio interface."""
         if self._audio_stream:
+            self.keep_active = False
             self.stop()
             self._audio_stream.close()
             self._audio_stream = None
 
+    @property
+    def xruns(self):
+        """Counters of the overflows and underflows seen so far."""
+        return {
+            'input_overflows': self.input_overflows,
+            'output_underflows': self.output_underflows,
+        }
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+
+class RingBuffer(object):
+    """Fixed-size circular byte buffer for one producer and one consumer.
+
+    Positions are absolute byte counts since the buffer was created, so a
+    consumer can tell how much the producer wrote past it. Once full the
+    oldest data is overwritten. Nothing is allocated per write.
+
+    Args:
+      capacity: size of the buffer in bytes.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buf = np.zeros(capacity, dtype=np.uint8)
+        self._written = 0
+
+    @property
+    def write_position(self):
+        """Absolute position of the next byte written."""
+        return self._written
+
+    @property
+    def oldest_position(self):
+        """Absolute position of the oldest byte still in the buffer."""
+        return max(0, self._written - self.capacity)
+
+    @property
+    def nbytes(self):
+        """Memory used by the buffer in bytes."""
+        return self._buf.nbytes
+
+    def write(self, data):
+        """Append data, overwriting the oldest bytes when full."""
+        data = np.frombuffer(data, dtype=np.uint8)
+        size = len(data)
+        if size > self.capacity:
+            data = data[-self.capacity:]
+        start = (self._written + size - len(data)) % self.capacity
+        head = min(len(data), self.capacity - start)
+        self._buf[start:start + head] = data[:head]
+        self._buf[:len(data) - head] = data[head:]
+        # Publish the data only once it has been copied.
+        self._written += size
+
+    def read_into(self, position, out):
+        """Copy the bytes starting at an absolute position into out.
+
+        Args:
+          position: absolute position, at least oldest_position.
+          out: writable uint8 NumPy array, at most as large as the bytes
+            available from position.
+        """
+        size = len(out)
+        if position < self.oldest_position \
+                or position + size > self._written:
+            raise ValueError('range not in buffer: %d+%d' % (position, size))
+        start = position % self.capacity
+        head = min(size, self.capacity - start)
+        out[:head] = self._buf[start:start + head]
+        out[head:] = self._buf[:size - head]
+        return out
+
+    def read(self, position, size):
+        """Returns size bytes starting at an absolute position."""
+        out = bytearray(size)
+        self.read_into(position, np.frombuffer(out, dtype=np.uint8))
+        return bytes(out)
+
+
+class CallbackSoundDeviceStream(SoundDeviceStream):
+    """Sound device stream running PortAudio in callback mode.
+
+    The PortAudio callback moves audio between the device and two
+    preallocated single-producer/single-consumer RingBuffers, read() and
+    write() only touch those buffers. A stall of the Python threads (GC,
+    gRPC) is absorbed by the buffers instead of causing a device xrun.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      block_size: size in bytes of each device callback block.
+      flush_size: size in bytes of silence data written during flush operation.
+      buffer_size: size in bytes of each ring buffer, defaults to
+        two seconds of audio.
+    """
+    def __init__(self, sample_rate, sample_width, block_size, flush_size,
+                 buffer_size=None):
+        buffer_size = buffer_size or sample_rate * sample_width * 2
+        self._input = RingBuffer(buffer_size)
+        self._output = RingBuffer(buffer_size)
+        # Positions only moved by their single consumer: read() for the
+        # input buffer, the PortAudio callback for the output buffer.
+        self._input_position = 0
+        self._output_position = 0
+        # Notified after each callback, read() and write() wait on it from
+        # their own threads, each for its own predicate.
+        self._callback_done = threading.Condition()
+        self.input_overruns = 0
+        self.output_underruns = 0
+        super(CallbackSoundDeviceStream, self).__init__(
+            sample_rate, sample_width, block_size, flush_size)
+        self._block_duration = block_size / float(sample_rate * sample_width)
+
+    def _open_stream(self, sample_rate, audio_format, block_size):
+        return _sounddevice().RawStream(
+            samplerate=sample_rate, dtype=audio_format, channels=1,
+            # blocksize is in number of frames.
+            blocksize=int(block_size/self._sample_width),
+            callback=self._callback,
+        )
+
+    def _callback(self, indata, outdata, frames, time_info, status):
+        if status.input_overflow:
+            self.input_overflows += 1
+        if status.output_underflow:
+            self.output_underflows += 1
+        self._input.write(indata)
+
+        out = np.frombuffer(outdata, dtype=np.uint8)
+        size = min(len(out),
+                   self._output.write_position - self._output_position)
+        if size:
+            self._output.read_into(self._output_position, out[:size])
+            self._output_position += size
+        if size < len(out):
+            out[size:] = 0
+            if size:
+                # Ran dry in the middle of the played audio.
+                self.output_underruns += 1
+        with self._callback_done:
+            self._callback_done.notify_all()
+
+    def _wait_for_callback(self, ready):
+        """Blocks until ready() is true, checking it after each callback."""
+        with self._callback_done:
+            while not ready():
+                if not self._callback_done.wait(self._block_duration * 2):
+                    if not self._audio_stream.active:
+                        raise AudioDeviceError('stream is not active')
+
+    def read(self, size):
+        """Read bytes captured by the device, waiting for them if needed."""
+        self._wait_for_callback(
+            lambda: self._input.write_position - self._input_position >= size)
+        if self._input_position < self._input.oldest_position:
+            self.input_overruns += 1
+            logging.warning('CallbackSoundDeviceStream read overrun, '
+                            '%d bytes lost',
+                            self._input.oldest_position
+                            - self._input_position)
+            self._input_position = self._input.oldest_position
+        buf = self._input.read(self._input_position, size)
+        self._input_position += size
+        return buf
+
+    def write(self, buf):
+        """Queue bytes for playback, waiting for room if needed."""
+        size = len(buf)
+        view = memoryview(buf).cast('B')
+        offset = 0
+        while offset < size:
+            self._wait_for_callback(self._output_free)
+            free = self._output_free()
+            chunk = view[offset:offset + free]
+            self._output.write(chunk)
+            offset += len(chunk)
+        return size
+
+    def _output_free(self):
+        return self._output.capacity - (self._output.write_position
+                                        - self._output_position)
+
+    def flush(self):
+        if self._flush_size > 0:
+            self.write(b'\x00' * self._flush_size)
+
+    def start(self):
+        """Start the underlying stream, dropping audio captured before."""
+        with self._state_lock:
+            if not self._audio_stream.active:
+                self._input_position = self._input.write_position
+                self._audio_stream.start()
+
+    def stop(self, flush=True):
+        """Stop the underlying stream once the queued audio has played.
+
+        Args:
+          flush: write flush_size bytes of silence before stopping.
+        """
+        if self.keep_active:
+            return
+        with self._state_lock:
+            if self._audio_stream.active:
+                if flush:
+                    self.flush()
+                self._wait_for_callback(
+                    lambda: (self._output_position
+                             >= self._output.write_position))
+                self._audio_stream.stop()
+
+    @property
+    def xruns(self):
+        """Counters of the overflows and underflows seen so far.
+
+        input_overflows and output_underflows are reported by the device,
+        input_overruns count reads that fell more than the ring buffer
+        behind and output_underruns callbacks running out of queued audio.
+        """
+        xruns = super(CallbackSoundDeviceStream, self).xruns
+        xruns['input_overruns'] = self.input_overruns
+        xruns['output_underruns'] = self.output_underruns
+        return xruns
+
+
+class LoopbackRawStream(object):
+    """Stand-in for a duplex sounddevice.RawStream, running in real time.
+
+    Frames come and go at sample_rate, a block at a time, like on a
+    sound card: a read waits for its frames to be captured and a write
+    waits for room in an output buffer of two blocks. Captured frames
+    are the frames played latency_ms earlier, or silence when loopback
+    is False. Reads falling two blocks behind overflow, a write after
+    the output ran dry reports an underflow.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      blocksize: number of frames per block.
+      latency_ms: time from playing a frame to capturing it.
+      loopback: capture the played frames, otherwise silence.
+    """
+    def __init__(self, sample_rate, blocksize, latency_ms, loopback=True):
+        self.samplerate = sample_rate
+        self.blocksize = blocksize
+        self._latency = latency_ms * sample_rate // 1000
+        self._loopback = loopback
+        self._capacity = 2 * blocksize
+        self._played = np.zeros(sample_rate * 2 + self._latency
+                                + self._capacity, dtype='<i2')
+        self._started_at = None
+        self._read_position = 0
+        self._write_position = 0
+
+    @property
+    def active(self):
+        return self._started_at is not None
+
+    def _clock(self):
+        """Frames played and captured since start(), in whole blocks."""
+        if self._started_at is None:
+            raise AudioDeviceError('stream is not active')
+        frames = int((time.monotonic() - self._started_at) * self.samplerate)
+        return frames - frames % self.blocksize
+
+    def _wait_for(self, frames):
+        while True:
+            clock = self._clock()
+            if clock >= frames:
+                return clock
+            time.sleep((frames - clock) / float(self.samplerate))
+
+    def start(self):
+        self._read_position = 0
+        self._write_position = 0
+        self._played[:] = 0
+        self._started_at = time.monotonic()
+
+    def stop(self):
+        """Stops once the queued frames have played, like Pa_StopStream."""
+        if self._started_at is not None:
+            self._wait_for(self._write_position)
+            self._started_at = None
+
+    def close(self):
+        self._started_at = None
+
+    def read(self, frames):
+        """Returns (frames captured, whether frames were lost)."""
+        clock = self._wait_for(self._read_position + frames)
+        overflowed = clock - self._read_position > self._capacity + frames
+        if overflowed:
+            self._read_position = clock - frames
+        positions = np.arange(self._read_position - self._latency,
+                              self._read_position - self._latency + frames)
+        self._read_position += frames
+        if not self._loopback:
+            return bytes(frames * 2), overflowed
+        captured = self._played.take(positions, mode='wrap')
+        # Nothing was played before start().
+        captured[positions < 0] = 0
+        return captured.tobytes(), overflowed
+
+    def write(self, buf):
+        """Queues frames, returns whether the output ran dry before."""
+        samples = np.frombuffer(buf, dtype='<i2')
+        clock = self._clock()
+        underflowed = False
+        if self._write_position < clock:
+            # Ran dry: the gap played silence.
+            underflowed = self._write_position > 0
+            gap = np.arange(self._write_position, clock)[-len(self._played):]
+            self._played.put(gap, 0, mode='wrap')
+            self._write_position = clock
+        self._played.put(np.arange(self._write_position,
+                                   self._write_position + len(samples)),
+                         samples, mode='wrap')
+        self._write_position += len(samples)
+        self._wait_for(self._write_position - self._capacity)
+        return underflowed
+
+
+class LoopbackStream(SoundDeviceStream):
+    """SoundDeviceStream on a LoopbackRawStream, for machines without sound.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      block_size: size in bytes of each read and write operation.
+      flush_size: size in bytes of silence data written during flush operation.
+      latency_ms: time from playing a frame to capturing it.
+      loopback: capture the played audio, otherwise silence.
+    """
+    def __init__(self, sample_rate, sample_width, block_size, flush_size,
+                 latency_ms=DEFAULT_LOOPBACK_LATENCY_MS, loopback=True):
+        self._latency_ms = latency_ms
+        self._loopback = loopback
+        super(LoopbackStream, self).__init__(sample_rate, sample_width,
+                                             block_size, flush_size)
+
+    def _open_stream(self, sample_rate, audio_format, block_size):
+        return LoopbackRawStream(sample_rate,
+                                 int(block_size/self._sample_width),
+                                 self._latency_ms, self._loopback)
+
+
+class PrerollCapture(object):
+    """Always-on capture keeping the last milliseconds before a push.
+
+    A background thread reads the sound device continuously into a
+    RingBuffer, so speech starting right at the push is not lost while
+    the conversation is set up. It is used as the source of a
+    ConversationStream: start() marks the start of a recording, preroll()
+    returns the audio captured just before it and read() returns the
+    audio captured since.
+
+    Args:
+      device: SoundDeviceStream to capture from. It is kept active until
+        close() is called.
+      preroll_ms: milliseconds of audio kept before a recording starts.
+      sample_width: size of a single sample in bytes.
+      read_size: size in bytes of each device read.
+      lag_ms: milliseconds of audio the reader may fall behind before
+        the oldest data is overwritten.
+    """
+    def __init__(self, device, preroll_ms, sample_width, read_size,
+                 lag_ms=2000):
+        self._device = device
+        self._sample_width = sample_width
+        self._read_size = read_size
+        self._sample_rate = device.sample_rate
+        bytes_per_ms = self._sample_rate * sample_width // 1000
+        self._preroll_size = preroll_ms * bytes_per_ms
+        self._ring = RingBuffer(self._preroll_size + lag_ms * bytes_per_ms
+                                + read_size)
+        self._data_available = threading.Condition()
+        self._read_position = 0
+        self._recording_position = 0
+        self._capture_error = None
+        self._closed = False
+        self._capture_thread = None
+        logging.info('Pre-roll capture of %d ms uses %d bytes',
+                     preroll_ms, self._ring.nbytes)
+
+    def start_capture(self):
+        """Start the device and the capture thread."""
+        if self._capture_thread is not None:
+            return
+        self._device.start()
+        self._device.keep_active = True
+        self._capture_thread = threading.Thread(target=self._capture,
+                                                name='preroll-capture',
+                                                daemon=True)
+        self._capture_thread.start()
+
+    def _capture(self):
+        try:
+            while not self._closed:
+                buf = self._device.read(self._read_size)
+                with self._data_available:
+                    self._ring.write(buf)
+                    self._data_available.notify_all()
+        except Exception as e:
+            if not self._closed:
+                logging.error('Pre-roll capture stopped: %s', e)
+            with self._data_available:
+                self._capture_error = e
+                self._data_available.notify_all()
+
+    def start(self):
+        """Mark the start of a recording."""
+        self.start_capture()
+        with self._data_available:
+            self._recording_position = self._ring.write_position
+            self._read_position = self._recording_position
+
+    def stop(self, flush=True):
+        pass
+
+    def preroll(self):
+        """Returns the audio captured just before the recording started."""
+        with self._data_available:
+            start = max(self._recording_position - self._preroll_size,
+                        self._ring.oldest_position)
+            start -= start % self._sample_width
+            return self._ring.read(start, self._recording_position - start)
+
+    def read(self, size):
+        """Read the next bytes captured since start()."""
+        with self._data_available:
+            while self._ring.write_position - self._read_position < size:
+                if self._capture_error is not None:
+                    raise self._capture_error
+                self._data_available.wait()
+            if self._read_position < self._ring.oldest_position:
+                logging.warning('Pre-roll reader overrun, %d bytes lost',
+                                self._ring.oldest_position
+                                - self._read_position)
+                self._read_position = self._ring.oldest_position
+            buf = self._ring.read(self._read_position, size)
+            self._read_position += size
+            return buf
+
+    def close(self):
+        """Stop capturing and release the device."""
+        self._closed = True
+        self._device.keep_active = False
+        if self._capture_thread is not None:
+            self._device.stop(flush=False)
+            self._capture_thread.join()
+            self._capture_thread = None
+
     @property
     def sample_rate(self):
         return self._sample_rate
 
+    @property
+    def nbytes(self):
+        """Memory used by the pre-roll buffer in bytes."""
+        return self._ring.nbytes
+
+
+class PlaybackBuffer(object):
+    """Adaptive jitter buffer played by a dedicated worker thread.
+
+    Audio put() by the thread reading the network is queued and written
+    to the sink by the worker, so a slow sink does not delay the network
+    and a network hiccup is absorbed by the queued audio. Playback starts
+    once target_ms of audio is queued. Each underrun raises the target
+    by half (up to max_ms), each response played without one lowers it
+    by a tenth (down to min_ms).
+
+    Args:
+      sink: audio sink to write to.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      target_ms: initial audio queued before playback starts.
+      min_ms: lowest target, at most target_ms.
+      max_ms: highest target.
+      queue_ms: audio queued before put() blocks.
+    """
+    def __init__(self, sink, sample_rate, sample_width,
+                 target_ms=DEFAULT_PLAYBACK_BUFFER_MS,
+                 min_ms=DEFAULT_PLAYBACK_BUFFER_MIN_MS,
+                 max_ms=DEFAULT_PLAYBACK_BUFFER_MAX_MS,
+                 queue_ms=DEFAULT_PLAYBACK_QUEUE_MS):
+        self._sink = sink
+        self._bytes_per_ms = sample_rate * sample_width / 1000.0
+        self.target_ms = target_ms
+        self.min_ms = min(min_ms, target_ms)
+        self.max_ms = max(max_ms, target_ms)
+        self._queue_size = queue_ms * self._bytes_per_ms
+        self._chunks = collections.deque()
+        self._queued = 0
+        self._changed = threading.Condition()
+        self._draining = False
+        self._writing = False
+        self._starved = False
+        self._closed = False
+        self._response_started = False
+        self._first_put_time = None
+        self._underrun_in_response = False
+        self.underruns = 0
+        self.max_depth_ms = 0
+        self.added_latency_ms = 0
+        self._worker = threading.Thread(target=self._play,
+                                        name='playback', daemon=True)
+        self._worker.start()
+
+    def put(self, buf, on_written=None):
+        """Queue audio, blocking while the queue is full.
+
+        Args:
+          buf: audio to play.
+          on_written: optional function called by the worker once buf has
+            been written to the sink.
+        """
+        with self._changed:
+            while self._queued >= self._queue_size and not self._closed:
+                self._changed.wait()
+            if self._first_put_time is None:
+                self._first_put_time = time.monotonic()
+            if self._starved:
+                self._starved = False
+                self.underruns += 1
+                self._underrun_in_response = True
+                self.target_ms = min(self.max_ms, self.target_ms * 1.5)
+                logging.warning('Playback buffer underrun, buffering %d ms',
+                                self.target_ms)
+            self._chunks.append((buf, on_written))
+            self._queued += len(buf)
+            self.max_depth_ms = max(self.max_depth_ms, self.depth_ms)
+            self._changed.notify_all()
+
+    @property
+    def depth_ms(self):
+        """Milliseconds of audio queued."""
+        return self._queued / self._bytes_per_ms
+
+    def drain(self):
+        """Block until all queued audio has been written to the sink."""
+        with self._changed:
+            self._draining = True
+            self._changed.notify_all()
+            while (self._chunks or self._writing) and not self._closed:
+                self._changed.wait()
+            self._end_response()
+
+    def abort(self, wait=True):
+        """Drop the queued audio.
+
+        Args:
+          wait: wait for the write in progress and end the response.
+            Otherwise only the queue is dropped, which cuts a drain() in
+            progress short, e.g. from an event loop.
+        """
+        with self._changed:
+            self._chunks.clear()
+            self._queued = 0
+            self._changed.notify_all()
+            if not wait:
+                return
+            while self._writing and not self._closed:
+                self._changed.wait()
+            self._end_response()
+
+    def close(self):
+        """Drop the queued audio and stop the worker."""
+        with self._changed:
+            self._closed = True
+            self._chunks.clear()
+            self._queued = 0
+            self._changed.notify_all()
+        self._worker.join()
+
+    def metrics(self):
+        return {
+            'depth_ms': self.depth_ms,
+            'max_depth_ms': self.max_depth_ms,
+            'target_ms': self.target_ms,
+            'underruns': self.underruns,
+            'added_latency_ms': self.added_latency_ms,
+        }
+
+    def _end_response(self):
+        if not self._underrun_in_response and self._first_put_time:
+            self.target_ms = max(self.min_ms, self.target_ms * 0.9)
+        self._draining = False
+        self._starved = False
+        self._response_started = False
+        self._first_put_time = None
+        self._underrun_in_response = False
+
+    def _play(self):
+        with self._changed:
+            while not self._closed:
+                # Prefill up to the target before (re)starting playback.
+                while not self._closed and not (
+                        self._queued >= self.target_ms * self._bytes_per_ms
+                        or (self._draining and self._chunks)):
+                    self._changed.wait()
+                if self._closed:
+                    return
+                if self._first_put_time is not None \
+                        and not self._response_started:
+                    self._response_started = True
+                    self.added_latency_ms = (
+                        time.monotonic() - self._first_put_time) * 1000
+                while self._chunks:
+                    buf, on_written = self._chunks.popleft()
+                    self._queued -= len(buf)
+                    self._writing = True
+                    self._changed.notify_all()
+                    self._changed.release()
+                    try:
+                        self._sink.write(buf)
+                        if on_written is not None:
+                            on_written()
+                    finally:
+                        self._changed.acquire()
+                        self._writing = False
+                        self._changed.notify_all()
+                # Running dry is an underrun only if more audio follows,
+                # see put().
+                self._starved = not self._draining
+
 
 class ConversationStream(object):
     """Audio stream that supports half-duplex conversation.
@@ -258,19 +1531,72 @@ class ConversationStream(object):
       sink: file-like stream object to write output audio bytes to.
       iter_size: read size in bytes for each iteration.
       sample_width: size of a single sample in bytes.
+      owns_audio: close source and sink on close(). Pass False when they
+        are shared across conversations, see AudioDeviceManager.
+      vad: optional VoiceActivityDetector trimming leading silence and
+        ending iteration at the local end of speech.
+      playback_buffer_ms: play through a PlaybackBuffer starting with this
+        many milliseconds of queued audio, 0 writes to the sink directly.
+      playback_buffer(PlaybackBuffer): play through this buffer instead,
+        shared across conversations and left open by close(), see
+        AudioDeviceManager.
+      level_meter: optional LevelMeter metering the raw audio read and the
+        audio written.
+      capture_pipeline(AudioPipeline): optional processing of the audio
+        read, pre-roll included, before the prompt masking and the VAD.
+      playback_pipeline(AudioPipeline): processing of the audio written,
+        defaults to the gain of the volume setting. The volume setting
+        only applies to a pipeline with a gain stage.
     """
-    def __init__(self, source, sink, iter_size, sample_width):
+    def __init__(self, source, sink, iter_size, sample_width,
+                 owns_audio=True, vad=None, playback_buffer_ms=0,
+                 level_meter=None, capture_pipeline=None,
+                 playback_pipeline=None, playback_buffer=None):
         self._source = source
         self._sink = sink
         self._iter_size = iter_size
         self._sample_width = sample_width
+        self._owns_audio = owns_audio
+        self._vad = vad
+        self._level_meter = level_meter
+        self._capture_pipeline = capture_pipeline
+        if playback_pipeline is None:
+            playback_pipeline = audio_pipeline.AudioPipeline(
+                [audio_pipeline.Gain()], sample_width)
+        self._playback_pipeline = playback_pipeline
         self._stop_recording = threading.Event()
         self._start_playback = threading.Event()
+        # Set by an aborted playback, writes are dropped until the next
+        # start_recording().
+        self._drop_writes = False
         self._volume_percentage = 50
+        self._set_gain()
+        # time.monotonic() of the first frame read after start_recording().
+        self.first_frame_time = None
+        self._prompt_end_time = None
+        self._prompt_overlap_mode = PROMPT_OVERLAP_KEEP
+        # Bytes captured while the last prompt was playing.
+        self.prompt_overlap_bytes = 0
+        self._preroll_taken = False
+        # Called each time audio has been written to the sink, by the
+        # worker of the PlaybackBuffer when there is one.
+        self.on_written = None
+        self._playback = playback_buffer
+        self._owns_playback = playback_buffer is None
+        if self._owns_playback and playback_buffer_ms > 0:
+            self._playback = PlaybackBuffer(
+                sink, sample_rate=self.sample_rate, sample_width=sample_width,
+                target_ms=playback_buffer_ms)
 
     def start_recording(self):
         """Start recording from the audio source."""
         self._stop_recording.clear()
+        self._start_playback.clear()
+        self._drop_writes = False
+        self.first_frame_time = None
+        # A new request, then a new answer.
+        for pipeline in self.pipelines.values():
+            pipeline.reset()
         self._source.start()
         self._sink.start()
 
@@ -282,11 +1608,34 @@ class ConversationStream(object):
         """Start playback to the audio sink."""
         self._start_playback.set()
 
-    def stop_playback(self):
-        """Stop playback from the audio sink."""
-        self._start_playback.clear()
-        self._source.stop()
-        self._sink.stop()
+    def stop_playback(self, abort=False):
+        """Stop playback from the audio sink.
+
+        Args:
+          abort: drop the audio still queued for playback instead of
+            waiting for it to play. Writes blocked until playback starts,
+            e.g. from a decoder thread, return and drop their audio, as
+            do the ones until the next start_recording().
+        """
+        if abort:
+            self._drop_writes = True
+            self._start_playback.set()
+        else:
+            self._start_playback.clear()
+        if self._playback is not None:
+            if abort:
+                self._playback.abort()
+            else:
+                self._playback.drain()
+            logging.info('Playback buffer: %s', self._playback.metrics())
+        # No silence is flushed after an aborted answer.
+        self._source.stop(flush=not abort)
+        self._sink.stop(flush=not abort)
+
+    @property
+    def xruns(self):
+        """Overflow and underflow counters of the audio sink, if it has any."""
+        return getattr(self._sink, 'xruns', {})
 
     @property
     def volume_percentage(self):
@@ -297,15 +1646,81 @@ class ConversationStream(object):
     def volume_percentage(self, new_volume_percentage):
         logging.info('Volume set to %s%%', new_volume_percentage)
         self._volume_percentage = new_volume_percentage
+        self._set_gain()
+
+    def _set_gain(self):
+        gain = self._playback_pipeline.stage(audio_pipeline.STAGE_GAIN)
+        if gain is not None:
+            gain.volume_percentage = self._volume_percentage
+
+    @property
+    def pipelines(self):
+        """The AudioPipeline of each direction, see LEVELS_CAPTURE."""
+        pipelines = {LEVELS_PLAYBACK: self._playback_pipeline}
+        if self._capture_pipeline is not None:
+            pipelines[LEVELS_CAPTURE] = self._capture_pipeline
+        return pipelines
+
+    def mask_prompt(self, end_time, mode=PROMPT_OVERLAP_DROP):
+        """Handle audio captured while a prompt is playing.
+
+        Lets recording start while a prompt (e.g. the start bleep) is
+        still playing on the sink.
+
+        Args:
+          end_time: time.monotonic() at which the prompt has played.
+          mode: PROMPT_OVERLAP_DROP to discard the overlapping audio,
+            PROMPT_OVERLAP_MUTE to replace it with silence or
+            PROMPT_OVERLAP_KEEP to only count it in prompt_overlap_bytes.
+        """
+        if mode not in PROMPT_OVERLAP_MODES:
+            raise ValueError('unsupported prompt overlap mode: %s' % mode)
+        self._prompt_end_time = end_time
+        self._prompt_overlap_mode = mode
+        self.prompt_overlap_bytes = 0
 
     def read(self, size):
         """Read bytes from the source (if currently recording).
 
         Will returns an empty byte string, if stop_recording() was called.
         """
-        if self._stop_recording.is_set():
-            return b''
-        return self._source.read(size)
+        while not self._stop_recording.is_set():
+            buf = self._source.read(size)
+            if self.first_frame_time is None:
+                self.first_frame_time = time.monotonic()
+            if self._level_meter is not None and buf:
+                # The raw audio: a dead or clipping microphone shows even
+                # when its blocks are dropped or processed.
+                self._level_meter.measure(LEVELS_CAPTURE, buf)
+            if self._capture_pipeline is not None and buf:
+                # Filtered as captured, without the gaps of the masking,
+                # and before the VAD judges the blocks. The one copy of
+                # the block: the VAD keeps blocks, the requests take
+                # bytes and the pipeline reuses its output buffer.
+                buf = bytes(self._capture_pipeline.process(buf))
+            if self._prompt_end_time is not None and buf:
+                buf = self._mask_prompt_overlap(buf)
+                if not buf:
+                    # The whole block was dropped, read the next one.
+                    continue
+            return buf
+        return b''
+
+    def _mask_prompt_overlap(self, buf):
+        bytes_per_second = self.sample_rate * self._sample_width
+        block_start_time = time.monotonic() - len(buf) / bytes_per_second
+        overlap = self._prompt_end_time - block_start_time
+        if overlap <= 0:
+            self._prompt_end_time = None
+            return buf
+        overlap_bytes = min(len(buf), int(overlap * self.sample_rate)
+                            * self._sample_width)
+        self.prompt_overlap_bytes += overlap_bytes
+        if self._prompt_overlap_mode == PROMPT_OVERLAP_DROP:
+            return buf[overlap_bytes:]
+        if self._prompt_overlap_mode == PROMPT_OVERLAP_MUTE:
+            return b'\0' * overlap_bytes + buf[overlap_bytes:]
+        return buf
 
     def write(self, buf):
         """Write bytes to the sink (if currently playing).
@@ -313,28 +1728,425 @@ class ConversationStream(object):
         Will block until start_playback() is called.
         """
         self._start_playback.wait()
-        buf = align_buf(buf, self._sample_width)
-        buf = normalize_audio_buffer(buf, self.volume_percentage)
-        return self._sink.write(buf)
+        if self._drop_writes:
+            return len(buf)
+        buf = self._playback_pipeline.process(buf)
+        if self._level_meter is not None:
+            self._level_meter.measure(LEVELS_PLAYBACK, buf)
+        if self._playback is not None:
+            # The queue keeps the blocks, the pipeline reuses its output
+            # buffer.
+            self._playback.put(bytes(buf), self.on_written)
+            return len(buf)
+        written = self._sink.write(buf)
+        if self.on_written is not None:
+            self.on_written()
+        return written
+
+    @property
+    def playback_buffer(self):
+        """The PlaybackBuffer, None when writing to the sink directly."""
+        return self._playback
 
     def close(self):
-        """Close source and sink."""
+        """Close source and sink (unless they are shared)."""
+        if self._playback is not None:
+            if self._owns_playback:
+                self._playback.close()
+            else:
+                # Audio left by a failed conversation is not played by
+                # the next one.
+                self._playback.abort()
+        if not self._owns_audio:
+            return
         self._source.close()
         self._sink.close()
 
     def __iter__(self):
         """Returns a generator reading data from the stream."""
-        return iter(lambda: self.read(self._iter_size), b'')
+        chunks = iter(lambda: self.read(self._iter_size), b'')
+        if self._vad is None:
+            return chunks
+        return self._iter_speech(chunks)
+
+    def _iter_speech(self, chunks):
+        for chunk in self._vad.filter(chunks):
+            yield chunk
+        stats = self._vad.stats()
+        if self._vad.speech_ended:
+            logging.info('Local end of speech detected')
+        logging.info('Voice activity: %(speech_ms)d ms speech, '
+                     '%(non_speech_ms)d ms non-speech, '
+                     '%(bytes_dropped)d of %(bytes_in)d bytes dropped', stats)
+
+    def iter_preroll(self):
+        """Yields the audio captured just before the first recording.
+
+        Only sources keeping a pre-roll (see PrerollCapture) yield data,
+        and only once per conversation stream, in iter_size chunks.
+        """
+        preroll = getattr(self._source, 'preroll', None)
+        if preroll is None or self._preroll_taken:
+            return
+        self._preroll_taken = True
+        buf = preroll()
+        if self._capture_pipeline is None:
+            for offset in range(0, len(buf), self._iter_size):
+                yield buf[offset:offset + self._iter_size]
+            return
+        # Processed before the live audio that follows it, from views of
+        # the pre-roll.
+        view = memoryview(buf)
+        for offset in range(0, len(buf), self._iter_size):
+            yield bytes(self._capture_pipeline.process(
+                view[offset:offset + self._iter_size]))
+
+    @property
+    def sample_rate(self):
+        return self._source.sample_rate
+
+
+def default_device_sample_rate():
+    """Sample rate in hertz of the default output device."""
+    device = _sounddevice().query_devices(kind='output')
+    return int(device['default_samplerate'])
+
+
+class AudioDeviceManager(object):
+    """Keeps one duplex SoundDeviceStream open for the life of the service.
+
+    Opening the PortAudio/ALSA device is the most expensive step of
+    starting a conversation. The manager opens it once, optionally in the
+    background, and hands it to every ConversationStream, which then only
+    starts and stops it. The PlaybackBuffer is shared the same way, so the
+    target it adapted to the network is kept from one push to the next.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      block_size: size in bytes of each read and write operation.
+      flush_size: size in bytes of silence data written during flush operation.
+      iter_size: read size in bytes for each conversation stream iteration.
+      preroll_ms: keep capturing all the time and send this many
+        milliseconds of audio captured before each push, 0 disables it.
+      callback_mode: open a CallbackSoundDeviceStream instead of a
+        blocking SoundDeviceStream.
+      device_sample_rate: rate in hertz to open the hardware at, 0 for
+        its default rate. The audio is resampled from and to sample_rate
+        by a ResamplingStream. None opens it at sample_rate, leaving any
+        conversion to ALSA.
+      device_class: class of the stream opened, overriding callback_mode,
+        e.g. LoopbackStream to run without sound hardware.
+    """
+    def __init__(self, sample_rate, sample_width, block_size, flush_size,
+                 iter_size=DEFAULT_AUDIO_ITER_SIZE, preroll_ms=0,
+                 callback_mode=False, device_sample_rate=None,
+                 device_class=None):
+        if device_class is None:
+            device_class = (CallbackSoundDeviceStream if callback_mode
+                            else SoundDeviceStream)
+        self._device_class = device_class
+        self._sample_rate = sample_rate
+        self._sample_width = sample_width
+        self._block_size = block_size
+        self._flush_size = flush_size
+        self._iter_size = iter_size
+        self._preroll_ms = preroll_ms
+        self._device_sample_rate = device_sample_rate
+        self._lock = threading.Lock()
+        self._opener = None
+        self._device = None
+        self._capture = None
+        self._playback = None
+        # Target learned by the PlaybackBuffer of a closed device.
+        self._playback_target_ms = None
+        self._open_error = None
+
+    def open(self):
+        """Open the sound device, closing any previously opened one."""
+        with self._lock:
+            self._close_device()
+            started_at = time.monotonic()
+            try:
+                self._device = self._open_device()
+                self._open_error = None
+                logging.info('Audio device opened in %.1f ms',
+                             (time.monotonic() - started_at) * 1000)
+                if self._preroll_ms > 0:
+                    self._capture = PrerollCapture(
+                        self._device,
+                        preroll_ms=self._preroll_ms,
+                        sample_width=self._sample_width,
+                        read_size=self._iter_size
+                    )
+                    self._capture.start_capture()
+            except Exception as e:
+                logging.error('Error opening audio device: %s', e)
+                self._open_error = e
+
+    def _open_device(self):
+        device_sample_rate = self._device_sample_rate
+        if device_sample_rate == 0:
+            device_sample_rate = default_device_sample_rate()
+        if device_sample_rate in (None, self._sample_rate):
+            return self._device_class(
+                sample_rate=self._sample_rate,
+                sample_width=self._sample_width,
+                block_size=self._block_size,
+                flush_size=self._flush_size
+            )
+
+        def scaled(size):
+            # Same duration at the rate of the device, in whole samples.
+            return (size * device_sample_rate // self._sample_rate
+                    // self._sample_width * self._sample_width)
+        device = self._device_class(
+            sample_rate=device_sample_rate,
+            sample_width=self._sample_width,
+            block_size=scaled(self._block_size),
+            flush_size=scaled(self._flush_size)
+        )
+        logging.info('Audio device runs at %d Hz, resampled to %d Hz',
+                     device_sample_rate, self._sample_rate)
+        return ResamplingStream(device, self._sample_rate, self._sample_width)
+
+    @property
+    def output_sample_rate(self):
+        """Sample rate in hertz of the hardware of the opened device."""
+        if isinstance(self._device, ResamplingStream):
+            return self._device.device_sample_rate
+        return self._sample_rate
+
+    def open_in_background(self):
+        """Open (or reopen) the sound device from a background thread."""
+        self._opener = threading.Thread(target=self.open,
+                                        name='audio-device-open',
+                                        daemon=True)
+        self._opener.start()
+        return self._opener
+
+    def device(self, timeout=None):
+        """Returns the opened SoundDeviceStream.
+
+        Waits for a background open to finish and retries a failed one.
+
+        Args:
+          timeout: seconds to wait for a background open, None waits forever.
+        """
+        opener = self._opener
+        if opener is not None:
+            opener.join(timeout)
+            if opener.is_alive():
+                raise AudioDeviceError('timed out opening the audio device')
+        if self._device is None:
+            self.open()
+            if self._device is None:
+                raise self._open_error
+        return self._device
 
     @property
     def sample_rate(self):
-        return self._source._sample_rate
+        return self._sample_rate
+
+    def conversation_stream(self, playback_buffer_ms=0, **kwargs):
+        """Returns a ConversationStream sharing the opened device.
+
+        Args:
+          playback_buffer_ms: initial target of the shared PlaybackBuffer,
+            0 writes to the device directly.
+          kwargs: extra ConversationStream arguments, e.g. vad.
+        """
+        device = self.device()
+        playback_buffer = None
+        if playback_buffer_ms > 0:
+            playback_buffer = self._playback_buffer(device, playback_buffer_ms)
+        return ConversationStream(
+            source=self._capture or device,
+            sink=device,
+            iter_size=self._iter_size,
+            sample_width=self._sample_width,
+            owns_audio=False,
+            playback_buffer=playback_buffer,
+            **kwargs
+        )
+
+    def _playback_buffer(self, device, target_ms):
+        with self._lock:
+            if self._playback is None:
+                self._playback = PlaybackBuffer(
+                    device, sample_rate=self._sample_rate,
+                    sample_width=self._sample_width,
+                    target_ms=self._playback_target_ms or target_ms)
+            return self._playback
+
+    def close(self):
+        """Close the sound device."""
+        with self._lock:
+            self._close_device()
+
+    def _close_device(self):
+        if self._playback is not None:
+            self._playback_target_ms = self._playback.target_ms
+            self._playback.close()
+            self._playback = None
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+        if self._device is not None:
+            try:
+                self._device.close()
+            except Exception as e:
+                logging.warning('Error closing audio device: %s', e)
+            self._device = None
+
+
+# Impulses played by measure_device(): bursts of pseudo-random full
+# scale noise, which stand out of the room noise once correlated.
+MEASURE_BURST_FRAMES = 64
+MEASURE_BURST_INTERVAL_MS = 500
+# Normalized correlation above which a captured burst is detected.
+MEASURE_DETECTION_THRESHOLD = 0.5
+
+DEVICE_SOUNDDEVICE = 'sounddevice'
+DEVICE_CALLBACK = 'callback'
+DEVICE_LOOPBACK = 'loopback'
+DEVICE_NULL = 'null'
+DEVICES = (DEVICE_SOUNDDEVICE, DEVICE_CALLBACK, DEVICE_LOOPBACK, DEVICE_NULL)
+
+
+def create_device(kind, sample_rate, sample_width, block_size, flush_size,
+                  loopback_latency_ms=DEFAULT_LOOPBACK_LATENCY_MS):
+    """Returns a duplex sound device stream of the given kind, see DEVICES.
+
+    loopback and null are LoopbackStreams, which need no sound hardware:
+    loopback captures what it played loopback_latency_ms earlier, null
+    captures silence.
+    """
+    if kind == DEVICE_SOUNDDEVICE:
+        return SoundDeviceStream(sample_rate, sample_width, block_size,
+                                 flush_size)
+    if kind == DEVICE_CALLBACK:
+        return CallbackSoundDeviceStream(sample_rate, sample_width,
+                                         block_size, flush_size)
+    if kind in (DEVICE_LOOPBACK, DEVICE_NULL):
+        return LoopbackStream(sample_rate, sample_width, block_size,
+                              flush_size, latency_ms=loopback_latency_ms,
+                              loopback=kind == DEVICE_LOOPBACK)
+    raise ValueError('unknown audio device: %s' % kind)
+
+
+def _burst():
+    rng = np.random.RandomState(0)
+    return (rng.choice((-1, 1), MEASURE_BURST_FRAMES) * 16384).astype('<i2')
+
+
+def _detect_bursts(captured, burst, offsets, window):
+    """Returns the delay in frames of each burst found in captured.
+
+    Args:
+      captured: int16 array of the captured frames.
+      burst: int16 array of the played burst.
+      offsets: frames at which the burst was played.
+      window: frames after each offset searched for the burst.
+    """
+    burst = burst.astype(np.float64)
+    burst_norm = np.sqrt(np.dot(burst, burst))
+    delays = []
+    for offset in offsets:
+        segment = captured[offset:offset + window + len(burst)]
+        if len(segment) < len(burst):
+            break
+        segment = segment.astype(np.float64)
+        correlation = np.correlate(segment, burst, 'valid')
+        energy = np.cumsum(np.concatenate(([0.0], segment * segment)))
+        norms = np.sqrt(energy[len(burst):] - energy[:-len(burst)])
+        # Silence correlates with nothing.
+        scores = np.abs(correlation) / np.maximum(norms * burst_norm, 1.0)
+        delay = int(np.argmax(scores))
+        if scores[delay] >= MEASURE_DETECTION_THRESHOLD:
+            delays.append(delay)
+    return delays
+
+
+def measure_device(device, iter_size, duration):
+    """Plays bursts through a duplex device while capturing, and measures.
+
+    The bursts are played every MEASURE_BURST_INTERVAL_MS and looked for
+    in the captured audio, which needs the speaker to reach the
+    microphone (or a loopback cable). Capture runs on its own thread into
+    a preallocated buffer, the audio is played in iter_size writes.
+
+    Args:
+      device: SoundDeviceStream or subclass, closed by the caller.
+      iter_size: size in bytes of each read and write.
+      duration: seconds of audio played.
+
+    Returns: dict with the round-trip latencies in ms (latencies_ms), the
+      number of bursts played (bursts), the xruns counted by the device
+      (overflows, underflows), the CPU use of the process in percent (cpu)
+      and the time stop() took to flush and drain the output (stop_ms).
+    """
+    sample_rate = device.sample_rate
+    frames = int(duration * sample_rate)
+    interval = MEASURE_BURST_INTERVAL_MS * sample_rate // 1000
+    burst = _burst()
+    played = np.zeros(frames, dtype='<i2')
+    offsets = list(range(interval // 2, frames - len(burst), interval))
+    for offset in offsets:
+        played[offset:offset + len(burst)] = burst
+    # The last burst is searched for up to the end of the capture.
+    captured = bytearray(frames * 2 + interval * 2)
+    read_size = iter_size - iter_size % 2
+    errors = []
+
+    def capture():
+        view = memoryview(captured)
+        try:
+            for position in range(0, len(captured) - read_size + 1,
+                                  read_size):
+                view[position:position + read_size] = device.read(read_size)
+        except Exception as e:
+            errors.append(e)
+
+    xruns_before = dict(device.xruns)
+    device.start()
+    started_at = time.monotonic()
+    cpu_started_at = time.process_time()
+    capture_thread = threading.Thread(target=capture, name='measure-capture')
+    capture_thread.start()
+    output = memoryview(played).cast('B')
+    for position in range(0, len(output), read_size):
+        device.write(output[position:position + read_size])
+    # Silence keeps the output going while the last burst is captured.
+    silence = bytes(read_size)
+    while capture_thread.is_alive() and not errors:
+        device.write(silence)
+    capture_thread.join()
+    stopping_at = time.monotonic()
+    device.stop()
+    stopped_at = time.monotonic()
+    cpu = time.process_time() - cpu_started_at
+    if errors:
+        raise errors[0]
+    xruns = device.xruns
+    delays = _detect_bursts(np.frombuffer(captured, dtype='<i2'), burst,
+                            offsets, interval - len(burst))
+    return {
+        'latencies_ms': [delay * 1000.0 / sample_rate for delay in delays],
+        'bursts': len(offsets),
+        'overflows': sum(xruns[name] - xruns_before.get(name, 0)
+                         for name in xruns if name.startswith('input')),
+        'underflows': sum(xruns[name] - xruns_before.get(name, 0)
+                          for name in xruns if name.startswith('output')),
+        'cpu': 100.0 * cpu / (stopped_at - started_at),
+        'stop_ms': (stopped_at - stopping_at) * 1000,
+    }
 
 
 @click.command()
 @click.option('--record-time', default=5,
               metavar='<record time>', show_default=True,
-              help='Record time in secs')
+              help='Seconds of audio played and captured per combination.')
 @click.option('--audio-sample-rate',
               default=DEFAULT_AUDIO_SAMPLE_RATE,
               metavar='<audio sample rate>', show_default=True,
@@ -344,55 +2156,72 @@ class ConversationStream(object):
               metavar='<audio sample width>', show_default=True,
               help='Audio sample width in bytes.')
 @click.option('--audio-iter-size',
-              default=DEFAULT_AUDIO_ITER_SIZE,
+              default=[DEFAULT_AUDIO_ITER_SIZE], multiple=True,
               metavar='<audio iter size>', show_default=True,
-              help='Size of each read during audio stream iteration in bytes.')
+              help=('Size of each read and write in bytes, repeat to '
+                    'compare several.'))
 @click.option('--audio-block-size',
-              default=DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
+              default=[DEFAULT_AUDIO_DEVICE_BLOCK_SIZE], multiple=True,
               metavar='<audio block size>', show_default=True,
               help=('Block size in bytes for each audio device '
-                    'read and write operation..'))
+                    'read and write operation, repeat to compare several.'))
 @click.option('--audio-flush-size',
-              default=DEFAULT_AUDIO_DEVICE_FLUSH_SIZE,
+              default=[DEFAULT_AUDIO_DEVICE_FLUSH_SIZE], multiple=True,
               metavar='<audio flush size>', show_default=True,
               help=('Size of silence data in bytes written '
-                    'during flush operation'))
+                    'during flush operation, repeat to compare several.'))
+@click.option('--device', type=click.Choice(DEVICES),
+              default=DEVICE_SOUNDDEVICE, show_default=True,
+              help=('Sound device stream measured, loopback and null '
+                    'stand in for a sound card on machines without one.'))
+@click.option('--loopback-latency-ms', default=DEFAULT_LOOPBACK_LATENCY_MS,
+              metavar='<loopback latency ms>', show_default=True,
+              help='Round-trip latency of the loopback device.')
 def main(record_time, audio_sample_rate, audio_sample_width,
-         audio_iter_size, audio_block_size, audio_flush_size):
-    """Helper command to test audio stream processing.
-
-    - Record 5 seconds of 16-bit samples at 16khz.
-    - Playback the recorded samples.
+         audio_iter_size, audio_block_size, audio_flush_size, device,
+         loopback_latency_ms):
+    """Benchmark the sound device for each combination of sizes.
+
+    Bursts are played while capturing, the speaker must be heard by the
+    microphone for the round-trip latency to be measured. Reports the
+    latency, the overflows and underflows, the CPU use and the time the
+    flush takes at the end of playback.
     """
-    end_time = time.time() + record_time
-    audio_device = SoundDeviceStream(sample_rate=audio_sample_rate,
-                                     sample_width=audio_sample_width,
-                                     block_size=audio_block_size,
-                                     flush_size=audio_flush_size)
-    stream = ConversationStream(source=audio_device,
-                                sink=audio_device,
-                                iter_size=audio_iter_size,
-                                sample_width=audio_sample_width)
-    samples = []
     logging.basicConfig(level=logging.INFO)
-    logging.info('Starting audio test.')
-
-    stream.start_recording()
-    logging.info('Recording samples.')
-    while time.time() < end_time:
-        samples.append(stream.read(audio_block_size))
-    logging.info('Finished recording.')
-    stream.stop_recording()
-
-    stream.start_playback()
-    logging.info('Playing back samples.')
-    while len(samples):
-        stream.write(samples.pop(0))
-    logging.info('Finished playback.')
-    stream.stop_playback()
-
-    logging.info('audio test completed.')
-    stream.close()
+    header = ('block', 'iter', 'flush', 'latency p50 ms', 'latency max ms',
+              'bursts', 'overflows', 'underflows', 'cpu %', 'stop ms')
+    rows = []
+    for block_size in audio_block_size:
+        for iter_size in audio_iter_size:
+            for flush_size in audio_flush_size:
+                logging.info('Measuring block size %d, iter size %d, '
+                             'flush size %d.', block_size, iter_size,
+                             flush_size)
+                audio_device = create_device(
+                    device, audio_sample_rate, audio_sample_width,
+                    block_size, flush_size, loopback_latency_ms)
+                try:
+                    result = measure_device(audio_device, iter_size,
+                                            record_time)
+                finally:
+                    audio_device.close()
+                latencies = result['latencies_ms']
+                rows.append((
+                    block_size, iter_size, flush_size,
+                    '%.1f' % np.median(latencies) if latencies else '-',
+                    '%.1f' % max(latencies) if latencies else '-',
+                    '%d/%d' % (len(latencies), result['bursts']),
+                    result['overflows'], result['underflows'],
+                    '%.1f' % result['cpu'], '%.0f' % result['stop_ms'],
+                ))
+    widths = [max(len(str(row[column])) for row in [header] + rows)
+              for column in range(len(header))]
+    for row in [header] + rows:
+        click.echo('  '.join(str(value).rjust(width)
+                             for value, width in zip(row, widths)))
+    if rows and all(row[3] == '-' for row in rows):
+        click.echo('No burst was captured, is the microphone in range of '
+                   'the speaker?')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,338 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Chains of processing stages for the captured and played audio."""
+
+import collections
+import functools
+import math
+import time
+
+import numpy as np
+
+
+STAGE_GAIN = 'gain'
+STAGE_DC = 'dc'
+STAGE_HIGHPASS = 'highpass'
+STAGE_LIMITER = 'limiter'
+STAGES = (STAGE_GAIN, STAGE_DC, STAGE_HIGHPASS, STAGE_LIMITER)
+
+# The answers only get the volume of the Assistant, the microphone audio
+# is sent as captured.
+DEFAULT_CAPTURE_STAGES = ''
+DEFAULT_PLAYBACK_STAGES = STAGE_GAIN
+
+DEFAULT_DC_TIME_CONSTANT_MS = 500
+DEFAULT_HIGHPASS_HZ = 100
+DEFAULT_HIGHPASS_ORDER = 2
+DEFAULT_LIMITER_THRESHOLD_DB = -1.0
+DEFAULT_LIMITER_RELEASE_MS = 200
+
+# Timing entries of the steps every pipeline with stages runs.
+CARRY = 'carry'
+CONVERT = 'convert'
+
+
+@functools.lru_cache(maxsize=128)
+def volume_scale_factor(volume_percentage):
+    """Returns the amplitude scale factor for the given volume percentage.
+
+    The factor is 2^(volume_percentage/100)-1, see
+    audio_helpers.normalize_audio_buffer(). Results are cached as the
+    volume rarely changes during a conversation.
+
+    Args:
+      volume_percentage: volume setting as an integer percentage (1-100).
+    """
+    return math.pow(2, 1.0*volume_percentage/100)-1
+
+
+class Gain(object):
+    """Scales the samples by the volume of the Assistant.
+
+    Args:
+      volume_percentage: volume setting as an integer percentage (1-100).
+    """
+    name = STAGE_GAIN
+
+    def __init__(self, volume_percentage=50):
+        self.volume_percentage = volume_percentage
+
+    def process(self, samples):
+        np.multiply(samples, volume_scale_factor(self.volume_percentage),
+                    out=samples)
+
+    def reset(self):
+        pass
+
+
+class DcRemover(object):
+    """Subtracts the DC offset of the signal, tracked block by block.
+
+    The offset follows the mean of the blocks with the given time
+    constant, which is cheaper than a recursive filter per sample and
+    enough for the offset of a cheap USB microphone.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      time_constant_ms: time the offset estimate takes to follow a change.
+    """
+    name = STAGE_DC
+
+    def __init__(self, sample_rate,
+                 time_constant_ms=DEFAULT_DC_TIME_CONSTANT_MS):
+        self.sample_rate = sample_rate
+        self.time_constant_ms = time_constant_ms
+        self.reset()
+
+    def reset(self):
+        self.offset = None
+
+    def process(self, samples):
+        mean = float(samples.mean())
+        if self.offset is None:
+            self.offset = mean
+        else:
+            block_ms = len(samples) * 1000.0 / self.sample_rate
+            weight = 1 - math.exp(-block_ms / self.time_constant_ms)
+            self.offset += weight * (mean - self.offset)
+        np.subtract(samples, self.offset, out=samples)
+
+
+class HighPass(object):
+    """Butterworth high-pass filter, e.g. against rumble and handling noise.
+
+    Needs scipy, which is optional. The filter state carries over from
+    block to block.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      cutoff_hz: cutoff frequency in hertz.
+      order: order of the filter.
+    """
+    name = STAGE_HIGHPASS
+
+    def __init__(self, sample_rate, cutoff_hz=DEFAULT_HIGHPASS_HZ,
+                 order=DEFAULT_HIGHPASS_ORDER):
+        try:
+            import scipy.signal
+        except ImportError:
+            raise ValueError('the %s stage needs scipy, install it with '
+                             'pip install scipy' % self.name)
+        self._sosfilt = scipy.signal.sosfilt
+        self.sos = scipy.signal.butter(order, cutoff_hz, btype='highpass',
+                                       fs=sample_rate,
+                                       output='sos').astype(np.float32)
+        self.reset()
+
+    def reset(self):
+        self._state = np.zeros((self.sos.shape[0], 2), dtype=np.float32)
+
+    def process(self, samples):
+        filtered, self._state = self._sosfilt(self.sos, samples,
+                                              zi=self._state)
+        np.copyto(samples, filtered, casting='unsafe')
+
+
+class Limiter(object):
+    """Lowers the gain of the blocks that would clip, instead of clipping.
+
+    The gain drops at once to keep the peak of a block under the
+    threshold and ramps back up over release_ms, without steps between
+    the blocks.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      threshold_db: highest level in dBFS let through.
+      release_ms: time the gain takes to recover.
+    """
+    name = STAGE_LIMITER
+
+    def __init__(self, sample_rate, threshold_db=DEFAULT_LIMITER_THRESHOLD_DB,
+                 release_ms=DEFAULT_LIMITER_RELEASE_MS):
+        self.sample_rate = sample_rate
+        self.threshold = 32768 * math.pow(10, threshold_db / 20.0)
+        self.release_ms = release_ms
+        self._steps = np.zeros(0, dtype=np.float32)
+        self._ramp = np.zeros(0, dtype=np.float32)
+        self.limited_blocks = 0
+        self.reset()
+
+    def reset(self):
+        self.gain = 1.0
+
+    def process(self, samples):
+        peak = max(float(samples.max()), -float(samples.min()))
+        target = 1.0 if peak <= self.threshold else self.threshold / peak
+        if target < self.gain:
+            self.gain = target
+            self.limited_blocks += 1
+            np.multiply(samples, target, out=samples)
+            return
+        if self.gain >= 1.0:
+            return
+        block_ms = len(samples) * 1000.0 / self.sample_rate
+        gain = min(target, self.gain + (1 - self.gain) * min(
+            block_ms / self.release_ms, 1.0))
+        size = len(samples)
+        if len(self._steps) < size:
+            self._steps = np.arange(1, size + 1, dtype=np.float32)
+            self._ramp = np.empty(size, dtype=np.float32)
+        ramp = self._ramp[:size]
+        # Linear ramp from the previous gain to the new one.
+        np.multiply(self._steps[:size], (gain - self.gain) / size, out=ramp)
+        np.add(ramp, self.gain, out=ramp)
+        np.multiply(samples, ramp, out=samples)
+        self.gain = gain
+
+
+class AudioPipeline(object):
+    """Chain of stages processing blocks of 16-bit audio.
+
+    A block is converted once into a float32 work buffer, the stages
+    process it in place, then it is clipped and converted back into an
+    int16 output buffer. Both buffers are allocated once and reused, the
+    output of process() is only valid until the next call.
+
+    A block ending in the middle of a sample carries the partial sample
+    over to the next block, instead of padding it.
+
+    The time spent in each stage is recorded, see timings().
+
+    Args:
+      stages: processing stages, applied in order.
+      sample_width: size of a single sample in bytes.
+    """
+    def __init__(self, stages=(), sample_width=2):
+        if sample_width != 2:
+            raise Exception('unsupported sample width:', sample_width)
+        self.stages = list(stages)
+        self._carry = b''
+        self._work = np.zeros(0, dtype=np.float32)
+        self._output = bytearray()
+        self.blocks = 0
+        self._seconds = collections.OrderedDict(
+            [(CARRY, 0.0)] + ([(CONVERT, 0.0)] if self.stages else [])
+            + [(stage.name, 0.0) for stage in self.stages])
+
+    def stage(self, name):
+        """Returns the stage with the given name, None if not in the chain."""
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def reset(self):
+        """Drop the carried partial sample and the state of the stages."""
+        self._carry = b''
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, buf):
+        """Returns the processed block as a bytes-like object.
+
+        Args:
+          buf: bytes-like object containing 16-bit little endian samples.
+        """
+        started_at = time.perf_counter()
+        samples, head = self._take_samples(buf)
+        self.blocks += 1
+        if not self.stages:
+            self._seconds[CARRY] += time.perf_counter() - started_at
+            if head is None:
+                return samples.data.cast('B')
+            return head + samples.tobytes()
+        now = time.perf_counter()
+        self._seconds[CARRY] += now - started_at
+        size = len(samples) + (head is not None)
+        if len(self._work) < size:
+            self._work = np.zeros(size, dtype=np.float32)
+            self._output = bytearray(size * 2)
+        work = self._work[:size]
+        if head is not None:
+            work[0] = np.frombuffer(head, dtype='<i2')[0]
+        work[size - len(samples):] = samples
+        started_at, now = now, time.perf_counter()
+        self._seconds[CONVERT] += now - started_at
+        for stage in self.stages:
+            stage.process(work)
+            started_at, now = now, time.perf_counter()
+            self._seconds[stage.name] += now - started_at
+        output = np.frombuffer(self._output, dtype='<i2', count=size)
+        np.clip(work, -32768, 32767, out=work)
+        # The unsafe cast truncates towards zero, like int() does.
+        np.copyto(output, work, casting='unsafe')
+        self._seconds[CONVERT] += time.perf_counter() - now
+        return memoryview(self._output)[:size * 2]
+
+    def _take_samples(self, buf):
+        """Returns (int16 view of the whole samples, carried sample or None).
+
+        The carried sample completed by the start of buf comes first.
+        """
+        size = len(buf)
+        offset = 0
+        head = None
+        if self._carry:
+            if not size:
+                return np.zeros(0, dtype='<i2'), None
+            head = self._carry + bytes(memoryview(buf)[:1])
+            offset = 1
+        whole = (size - offset) // 2
+        self._carry = bytes(memoryview(buf)[offset + whole * 2:])
+        return np.frombuffer(buf, dtype='<i2', count=whole,
+                             offset=offset), head
+
+    def timings(self):
+        """Returns the mean microseconds per block spent by each stage."""
+        return collections.OrderedDict(
+            (name, round(seconds * 1e6 / max(self.blocks, 1), 1))
+            for name, seconds in self._seconds.items())
+
+
+def parse_stages(spec):
+    """Returns the stage names of a comma separated spec, e.g. 'dc,limiter'.
+
+    Raises: ValueError for an unknown stage.
+    """
+    names = [name.strip() for name in spec.split(',') if name.strip()]
+    for name in names:
+        if name not in STAGES:
+            raise ValueError('unknown audio processing stage: %s, choose '
+                             'from %s' % (name, ', '.join(STAGES)))
+    return names
+
+
+def create_pipeline(spec, sample_rate, sample_width,
+                    highpass_hz=DEFAULT_HIGHPASS_HZ,
+                    limiter_threshold_db=DEFAULT_LIMITER_THRESHOLD_DB):
+    """Returns an AudioPipeline of the stages named in spec.
+
+    Args:
+      spec: comma separated stage names, see STAGES.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      highpass_hz: cutoff frequency of the high-pass stage.
+      limiter_threshold_db: threshold of the limiter stage in dBFS.
+
+    Raises: ValueError for an unknown stage or a missing dependency.
+    """
+    factories = {
+        STAGE_GAIN: lambda: Gain(),
+        STAGE_DC: lambda: DcRemover(sample_rate),
+        STAGE_HIGHPASS: lambda: HighPass(sample_rate, highpass_hz),
+        STAGE_LIMITER: lambda: Limiter(sample_rate, limiter_threshold_db),
+    }
+    return AudioPipeline([factories[name]() for name in parse_stages(spec)],
+                         sample_width)
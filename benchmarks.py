@@ -0,0 +1,1044 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks for the Pi-tervox hot paths.
+
+Run `python -m benchmarks --help` to list the available benchmarks.
+"""
+
+import array
+import asyncio
+import io
+import itertools
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import wave
+
+import click
+import grpc
+import numpy as np
+
+try:
+    from . import audio_codecs
+    from . import audio_helpers
+    from . import audio_pipeline
+    from . import fake_assistant
+    from . import led_animator
+    from . import push_button
+    from . import turn_tracing
+except (SystemError, ImportError):
+    import audio_codecs
+    import audio_helpers
+    import audio_pipeline
+    import fake_assistant
+    import led_animator
+    import push_button
+    import turn_tracing
+
+
+def legacy_normalize_audio_buffer(buf, volume_percentage, sample_width=2):
+    """Per-sample Python loop normalize_audio_buffer() used to run."""
+    if sample_width != 2:
+        raise Exception('unsupported sample width:', sample_width)
+    scale = math.pow(2, 1.0*volume_percentage/100)-1
+    arr = array.array('h', buf)
+    for idx in range(0, len(arr)):
+        arr[idx] = int(arr[idx]*scale)
+    return arr.tobytes()
+
+
+class LegacyBreathingLed(object):
+    """Thread per LED, ramping the duty cycle the way BreathingLed used to.
+
+    Its sleep is in seconds here, the original slept 1000 times too long.
+    """
+    def __init__(self, backend, led_pin, hertz=100, cycle_time=1):
+        self.backend = backend
+        self.led_pin = led_pin
+        self.hertz = hertz
+        self.sleep_time = cycle_time / (hertz * 2.0)
+        self.keep_breathing = False
+        self.thread = None
+
+    def start_breathing(self):
+        self.backend.setup(self.led_pin, self.hertz)
+        self.keep_breathing = True
+        self.thread = threading.Thread(target=self._breath, daemon=True)
+        self.thread.start()
+
+    def _breath(self):
+        while self.keep_breathing:
+            for i in itertools.chain(range(0, self.hertz + 1),
+                                     range(self.hertz, -1, -1)):
+                self.backend.set_duty_cycle(self.led_pin, i)
+                time.sleep(self.sleep_time)
+
+    def stop(self):
+        self.keep_breathing = False
+        self.thread.join()
+
+
+def best_of(func, repeat, number=1):
+    """Returns the best wall time in seconds of a single func() call."""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def print_table(header, rows):
+    """Prints rows of strings as a left aligned text table."""
+    widths = [max(len(str(cell)) for cell in column)
+              for column in zip(header, *rows)]
+    line = '  '.join('%%-%ds' % w for w in widths)
+    click.echo(line % tuple(header))
+    click.echo('  '.join('-' * w for w in widths))
+    for row in rows:
+        click.echo(line % tuple(row))
+
+
+def silent_wav(duration_ms, sample_rate, sample_width):
+    """Returns the bytes of a WAV file of silence."""
+    buf = io.BytesIO()
+    wav = wave.open(buf, 'wb')
+    wav.setnchannels(1)
+    wav.setsampwidth(sample_width)
+    wav.setframerate(sample_rate)
+    size = sample_rate * sample_width * duration_ms // 1000
+    wav.writeframes(b'\x00' * size)
+    wav.close()
+    return buf.getvalue()
+
+
+class UnlitLed(object):
+    """Stands in for the breathing LED while benchmarking."""
+
+    def start_breathing(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def percentile_ms(percentiles, span, percentile):
+    value = percentiles.get(span, {}).get(percentile)
+    return '-' if value is None else '%.0f' % value
+
+
+def run_conversations(turns, pushes, request_audio, speed=1.0,
+                      playback_buffer_ms=0, trace_allocations=False,
+                      vad_options=None, **assistant_options):
+    """Runs conversations with push_red_to_talk.SampleAssistant.
+
+    Each push sends request_audio through WaveSource to a FakeAssistantServer
+    replaying turns, the answers go to a WaveSink.
+
+    Args:
+      turns: list of fake_assistant.ScriptedTurn.
+      pushes: number of conversations.
+      request_audio: bytes of the WAV file sent as the request.
+      speed: pace of the request audio, see WaveSource.
+      playback_buffer_ms: playback buffer of the conversation stream.
+      trace_allocations: trace the allocations of each push.
+      vad_options: arguments of the VoiceActivityDetector of each push,
+        None sends the request audio without VAD.
+      assistant_options: extra SampleAssistant arguments.
+
+    Returns: (TurnTracer, client CPU seconds, failed pushes, peak and
+      retained bytes allocated per push).
+    """
+    # Imported here, it pulls in the modules of the device.
+    try:
+        from . import push_red_to_talk
+    except (SystemError, ImportError):
+        import push_red_to_talk
+
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    tracer = turn_tracing.TurnTracer()
+    cpu_time = 0.0
+    errors = 0
+    peaks = []
+    retained = []
+    with fake_assistant.FakeAssistantServer(turns) as server:
+        channel = server.channel()
+        for _ in range(pushes):
+            source = audio_helpers.WaveSource(
+                io.BytesIO(request_audio), sample_rate=sample_rate,
+                sample_width=sample_width, speed=speed)
+            sink = audio_helpers.WaveSink(
+                io.BytesIO(), sample_rate=sample_rate,
+                sample_width=sample_width)
+            vad = None
+            if vad_options is not None:
+                vad = audio_helpers.VoiceActivityDetector(
+                    sample_rate, sample_width, **vad_options)
+            stream = audio_helpers.ConversationStream(
+                source=source, sink=sink,
+                iter_size=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+                sample_width=sample_width,
+                playback_buffer_ms=playback_buffer_ms, vad=vad)
+            if trace_allocations:
+                tracemalloc.start()
+            server_cpu_time = server.servicer.cpu_time
+            cpu_started_at = time.process_time()
+            try:
+                with push_red_to_talk.SampleAssistant(
+                        conversation_stream=stream,
+                        channel=channel,
+                        deadline_sec=push_red_to_talk.DEFAULT_GRPC_DEADLINE,
+                        tracer=tracer,
+                        led=UnlitLed(),
+                        **assistant_options) as assistant:
+                    push_red_to_talk.trigger_assistant(assistant)
+            except grpc.RpcError as e:
+                errors += 1
+                tracer.finish_turn(error=str(e.code()))
+            cpu_time += (time.process_time() - cpu_started_at
+                         - (server.servicer.cpu_time - server_cpu_time))
+            if trace_allocations:
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                peaks.append(peak)
+                retained.append(current)
+        channel.close()
+    return tracer, cpu_time, errors, peaks, retained
+
+
+@click.group()
+def main():
+    """Micro-benchmarks for the Pi-tervox hot paths."""
+
+
+@main.command()
+@click.option('--volume-percentage', default=50, show_default=True,
+              help='Volume setting the buffers are normalized to.')
+@click.option('--repeat', default=5, show_default=True,
+              help='Number of timed runs, the best one is reported.')
+def gain(volume_percentage, repeat):
+    """Compare the NumPy gain stage with the per-sample loop."""
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    rows = []
+    for duration_ms in (100, 1000, 10000):
+        size = sample_rate * sample_width * duration_ms // 1000
+        buf = os.urandom(size)
+        legacy = best_of(
+            lambda: legacy_normalize_audio_buffer(buf, volume_percentage),
+            repeat)
+        numpy = best_of(
+            lambda: audio_helpers.normalize_audio_buffer(buf,
+                                                         volume_percentage),
+            repeat)
+        rows.append(('%d ms' % duration_ms,
+                     '%.3f' % (legacy * 1000),
+                     '%.3f' % (numpy * 1000),
+                     '%.0fx' % (legacy / numpy)))
+    print_table(('buffer', 'loop ms', 'numpy ms', 'speedup'), rows)
+
+
+@main.command('device-open')
+@click.option('--pushes', default=5, show_default=True,
+              help='Number of simulated button presses.')
+def device_open(pushes):
+    """Time from push to first captured frame, cold vs warm device.
+
+    Cold opens a new SoundDeviceStream per push (the old behaviour), warm
+    reuses the one kept open by AudioDeviceManager. Needs a sound card.
+    """
+    def first_frame_ms(create_stream):
+        pushed_at = time.monotonic()
+        stream = create_stream()
+        stream.start_recording()
+        stream.read(audio_helpers.DEFAULT_AUDIO_ITER_SIZE)
+        latency = (stream.first_frame_time - pushed_at) * 1000
+        stream.stop_recording()
+        stream.stop_playback()
+        stream.close()
+        return latency
+
+    def cold_stream():
+        device = audio_helpers.SoundDeviceStream(
+            sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+            sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+            block_size=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
+            flush_size=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE)
+        return audio_helpers.ConversationStream(
+            source=device, sink=device,
+            iter_size=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+            sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH)
+
+    manager = audio_helpers.AudioDeviceManager(
+        sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+        sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+        block_size=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
+        flush_size=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE)
+    cold = [first_frame_ms(cold_stream) for _ in range(pushes)]
+    manager.open()
+    warm = [first_frame_ms(manager.conversation_stream)
+            for _ in range(pushes)]
+    manager.close()
+    print_table(('device', 'min ms', 'median ms', 'max ms'),
+                [(name, '%.1f' % min(values),
+                  '%.1f' % sorted(values)[len(values) // 2],
+                  '%.1f' % max(values))
+                 for name, values in (('cold', cold), ('warm', warm))])
+
+
+@main.command()
+@click.option('--pushes', default=20, show_default=True,
+              help='Number of simulated button presses per mode.')
+@click.option('--idle-time', default=2.0, show_default=True,
+              help='Seconds the button is left idle to measure CPU use.')
+def button(pushes, idle_time):
+    """Trigger latency and idle CPU of edge detection vs polling.
+
+    Drives PushButton through FakeGpioBackend, so it runs on any box.
+    """
+    rows = []
+    for edge_detection in (True, False):
+        gpio = push_button.FakeGpioBackend()
+        pin = push_button.PushButton.DEFAULT_GPIO_PIN
+        button = push_button.PushButton(pin, gpio=gpio,
+                                        edge_detection=edge_detection,
+                                        long_press_time=None)
+        pushed = threading.Event()
+        pushed_at = []
+        waiter = threading.Thread(
+            target=button.wait_for_push,
+            args=(lambda: (pushed_at.append(time.monotonic()),
+                           pushed.set()),))
+        waiter.start()
+
+        cpu_started_at = time.process_time()
+        time.sleep(idle_time)
+        idle_cpu = time.process_time() - cpu_started_at
+
+        latencies = []
+        for _ in range(pushes):
+            pushed.clear()
+            started_at = time.monotonic()
+            gpio.set_input(pin, 1)
+            pushed.wait()
+            latencies.append((pushed_at[-1] - started_at) * 1000)
+            gpio.set_input(pin, 0)
+            time.sleep(button.debounce_time * 2 + button.sleep_time)
+        button.stop()
+        waiter.join()
+
+        latencies.sort()
+        rows.append(('edge' if edge_detection else 'poll',
+                     '%.2f' % latencies[len(latencies) // 2],
+                     '%.2f' % latencies[-1],
+                     '%.2f' % (idle_cpu / idle_time * 100)))
+    print_table(('mode', 'median ms', 'max ms', 'idle cpu %'), rows)
+
+
+@main.command()
+@click.argument('fixtures', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--energy-threshold',
+              default=audio_helpers.DEFAULT_VAD_ENERGY_THRESHOLD_DB,
+              show_default=True, help='Minimum speech level in dBFS.')
+@click.option('--endpoint-ms', default=audio_helpers.DEFAULT_VAD_ENDPOINT_MS,
+              show_default=True,
+              help='Silence after speech that ends the request.')
+def vad(fixtures, energy_threshold, endpoint_ms):
+    """Bytes uploaded, upload time and first answer with and without VAD.
+
+    Each 16 kHz mono WAV fixture is sent in real time through WaveSource
+    to a FakeAssistantServer, once as is and once through the VAD. The
+    server ends the utterance when the request stream ends: at the end of
+    the file without VAD, at the local end of speech with it. The upload
+    time is when the end of utterance is received, the first answer when
+    the first audio of the answer is, both from the start of the turn.
+    """
+    vad_options = dict(energy_threshold_db=energy_threshold,
+                       endpoint_ms=endpoint_ms)
+    rows = []
+    for fixture in fixtures:
+        with wave.open(fixture, 'rb') as wav:
+            duration_ms = wav.getnframes() * 1000 // wav.getframerate()
+        with open(fixture, 'rb') as f:
+            request_audio = f.read()
+        # Only the end of the request stream ends the utterance.
+        turns = [fake_assistant.ScriptedTurn(
+            end_of_utterance_ms=duration_ms + 1000, answer_ms=500)]
+        row = [os.path.basename(fixture)]
+        traces = []
+        for options in (None, vad_options):
+            tracer, _, _, _, _ = run_conversations(
+                turns, 1, request_audio, vad_options=options)
+            traces.append(tracer.last_turn)
+        raw, vad = traces
+        raw_bytes = raw.counters[turn_tracing.BYTES_SENT]
+        vad_bytes = vad.counters[turn_tracing.BYTES_SENT]
+        row += [raw_bytes, vad_bytes,
+                '%.0f%%' % (100.0 * vad_bytes / max(raw_bytes, 1))]
+        for span in (turn_tracing.END_OF_UTTERANCE,
+                     turn_tracing.FIRST_AUDIO_OUT):
+            for trace in traces:
+                ms = trace.spans_ms().get(span)
+                row.append('-' if ms is None else '%.2f' % (ms / 1000))
+        rows.append(row)
+    print_table(('fixture', 'raw bytes', 'vad bytes', 'sent',
+                 'raw upload s', 'vad upload s',
+                 'raw answer s', 'vad answer s'), rows)
+
+
+@main.command()
+@click.argument('fixtures', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--compression-level', '-c', 'compression_levels',
+              multiple=True, type=float,
+              default=(audio_codecs.DEFAULT_FLAC_COMPRESSION_LEVEL, 0.5, 1.0),
+              show_default=True, help='FLAC compression levels to compare.')
+@click.option('--repeat', default=3, show_default=True,
+              help='Number of timed runs, the best one is reported.')
+def flac(fixtures, compression_levels, repeat):
+    """CPU cost of the FLAC uplink against the bytes it saves.
+
+    Each 16 kHz mono WAV fixture is encoded in iter size chunks, as the
+    microphone stream is. cpu % is the share of one core needed to keep
+    up with real time, first frame the audio buffered before the first
+    FLAC bytes come out.
+    """
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    iter_size = audio_helpers.DEFAULT_AUDIO_ITER_SIZE
+    rows = []
+    for fixture in fixtures:
+        with wave.open(fixture, 'rb') as wav:
+            pcm = wav.readframes(wav.getnframes())
+        duration = len(pcm) / float(sample_rate * sample_width)
+        chunks = [pcm[offset:offset + iter_size]
+                  for offset in range(0, len(pcm), iter_size)]
+        for level in compression_levels:
+            def encode():
+                encoder = audio_codecs.FlacEncoder(
+                    sample_rate, sample_width, compression_level=level)
+                return [encoder.encode(chunk) for chunk in chunks] + [
+                    encoder.flush()]
+
+            cpu_time = min(
+                timeit.repeat(encode, timer=time.process_time,
+                              repeat=repeat, number=1))
+            encoded = encode()
+            flac_bytes = sum(len(data) for data in encoded)
+            # The first audio frame follows the stream header, it starts
+            # with the FLAC frame sync code.
+            first = next(i for i, data in enumerate(encoded)
+                         if b'\xff\xf8' in data)
+            rows.append((os.path.basename(fixture), level, len(pcm),
+                         flac_bytes,
+                         '%.0f%%' % (100.0 - 100.0 * flac_bytes / len(pcm)),
+                         '%.2f' % (100.0 * cpu_time / duration),
+                         '%d ms' % ((first + 1) * iter_size * 1000
+                                    // (sample_rate * sample_width))))
+    print_table(('fixture', 'level', 'raw bytes', 'flac bytes', 'saved',
+                 'cpu %', 'first frame'), rows)
+
+
+@main.command()
+@click.option('--scenario', '-s', 'scenarios', multiple=True,
+              type=click.Choice(sorted(fake_assistant.SCENARIOS)),
+              help='Scripted timeline to replay, all of them by default.')
+@click.option('--pushes', default=5, show_default=True,
+              help='Number of conversations per scenario.')
+@click.option('--fixture', default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help='16 kHz mono WAV file sent as the request, '
+                   'silence by default.')
+@click.option('--speed', default=1.0, show_default=True,
+              help='Pace of the request audio relative to real time, '
+                   '0 sends it as fast as possible.')
+@click.option('--playback-buffer-ms', default=0, show_default=True,
+              help='Playback buffer of the conversation stream.')
+@click.option('--allocations/--no-allocations', default=True,
+              show_default=True,
+              help='Trace allocations with tracemalloc in a second pass.')
+def converse(scenarios, pushes, fixture, speed, playback_buffer_ms,
+             allocations):
+    """Latency, CPU time and allocations per turn against a fake API.
+
+    Drives push_red_to_talk.SampleAssistant through WaveSource and WaveSink
+    against an in-process gRPC server replaying scripted timelines, so
+    neither the Google endpoint nor a microphone is needed. Latencies are
+    measured from the start of each turn. CPU time excludes the fake
+    server, allocations include it.
+    """
+    if fixture:
+        with open(fixture, 'rb') as f:
+            request_audio = f.read()
+    else:
+        request_audio = silent_wav(1000,
+                                   audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+                                   audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH)
+
+    rows = []
+    for scenario in scenarios or sorted(fake_assistant.SCENARIOS):
+        turns = fake_assistant.SCENARIOS[scenario]
+        tracer, cpu_time, errors, _, _ = run_conversations(
+            turns, pushes, request_audio, speed=speed,
+            playback_buffer_ms=playback_buffer_ms)
+        percentiles = tracer.percentiles()
+        peak_kib = retained_kib = '-'
+        if allocations:
+            _, _, _, peaks, retained = run_conversations(
+                turns, pushes, request_audio, speed=speed,
+                playback_buffer_ms=playback_buffer_ms,
+                trace_allocations=True)
+            peak_kib = '%.0f' % (max(peaks) / 1024.0)
+            retained_kib = '%.0f' % (max(retained) / 1024.0)
+        rows.append((scenario, tracer.turns, errors,
+                     percentile_ms(percentiles,
+                                   turn_tracing.FIRST_AUDIO_OUT, 50),
+                     percentile_ms(percentiles,
+                                   turn_tracing.FIRST_AUDIO_OUT, 95),
+                     percentile_ms(percentiles,
+                                   turn_tracing.STOP_PLAYBACK, 50),
+                     percentile_ms(percentiles,
+                                   turn_tracing.STOP_PLAYBACK, 95),
+                     '%.1f' % (cpu_time * 1000 / max(tracer.turns, 1)),
+                     peak_kib, retained_kib))
+    print_table(('scenario', 'turns', 'errors',
+                 'first audio p50', 'first audio p95',
+                 'done p50', 'done p95', 'cpu ms/turn',
+                 'peak KiB', 'retained KiB'), rows)
+
+
+@main.command()
+@click.option('--scenario', '-s', default='weak-wifi', show_default=True,
+              type=click.Choice(sorted(fake_assistant.SCENARIOS)),
+              help='Scripted timeline to replay.')
+@click.option('--pushes', default=5, show_default=True,
+              help='Number of conversations per encoding.')
+def downlink(scenario, pushes):
+    """Bytes received and time to first sound per answer encoding.
+
+    Time to first sound runs from the start of the turn to the first PCM
+    written to the conversation stream, after decoding. The weak-wifi
+    scenario carries the answer over a 96 kbit/s link.
+    """
+    request_audio = silent_wav(1000, audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+                               audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH)
+    turns = fake_assistant.SCENARIOS[scenario]
+    rows = []
+    for encoding in audio_codecs.AUDIO_OUT_ENCODINGS:
+        tracer, cpu_time, errors, _, _ = run_conversations(
+            turns, pushes, request_audio, speed=0,
+            audio_out_encoding=encoding)
+        percentiles = tracer.percentiles()
+        bytes_received = tracer.last_turn.counters[turn_tracing.BYTES_RECEIVED]
+        rows.append((encoding, errors, bytes_received,
+                     percentile_ms(percentiles,
+                                   turn_tracing.FIRST_AUDIO_WRITTEN, 50),
+                     percentile_ms(percentiles,
+                                   turn_tracing.FIRST_AUDIO_WRITTEN, 95),
+                     percentile_ms(percentiles,
+                                   turn_tracing.LAST_AUDIO_WRITTEN, 50),
+                     '%.1f' % (cpu_time * 1000 / max(tracer.turns, 1))))
+    print_table(('encoding', 'errors', 'bytes/answer',
+                 'first sound p50', 'first sound p95', 'last sound p50',
+                 'cpu ms/turn'), rows)
+
+
+@main.command()
+@click.option('--starts', default=5, show_default=True,
+              help='Number of starts per cache state.')
+@click.option('--delay-ms', default=300, show_default=True,
+              help='Time the stand-in token endpoint takes to answer.')
+def token(starts, delay_ms):
+    """Time to a valid access token at start, with and without the cache.
+
+    CredentialManager loads throwaway credentials pointing at a local
+    stand-in token endpoint, as the device does at boot.
+    """
+    try:
+        from . import credentials_manager
+    except (SystemError, ImportError):
+        import credentials_manager
+
+    rows = []
+    with fake_assistant.FakeTokenServer(delay_ms=delay_ms) as server, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        credentials_path = os.path.join(tmp_dir, 'credentials.json')
+        with open(credentials_path, 'w') as f:
+            json.dump({'refresh_token': 'fake', 'client_id': 'fake',
+                       'client_secret': 'fake',
+                       'token_uri': server.token_uri}, f)
+        cache_path = os.path.join(tmp_dir,
+                                  credentials_manager.TOKEN_CACHE_FILE)
+        for cache in ('cold', 'warm'):
+            timings = []
+            fetches = server.requests
+            for _ in range(starts):
+                if cache == 'cold' and os.path.exists(cache_path):
+                    os.remove(cache_path)
+                started_at = time.monotonic()
+                manager = credentials_manager.CredentialManager(
+                    credentials_path)
+                manager.load()
+                manager.ensure_valid()
+                timings.append((time.monotonic() - started_at) * 1000)
+            rows.append((cache, server.requests - fetches,
+                         '%.1f' % min(timings),
+                         '%.1f' % sorted(timings)[len(timings) // 2],
+                         '%.1f' % max(timings)))
+    print_table(('cache', 'fetches', 'min ms', 'median ms', 'max ms'), rows)
+
+
+@main.command()
+@click.option('--counts', default='1,4,16,64', show_default=True,
+              help='Comma separated numbers of animated LEDs.')
+@click.option('--seconds', default=5.0, show_default=True,
+              help='Time each configuration animates for.')
+@click.option('--tick-ms', default=led_animator.DEFAULT_TICK_MS,
+              show_default=True, help='Tick of the LED animator.')
+def leds(counts, seconds, tick_ms):
+    """CPU used per animated LED, animator vs a thread per LED.
+
+    The LEDs breathe on a fake PWM backend, the CPU time of the process
+    is measured while they do.
+    """
+    rows = []
+    for count in (int(c) for c in counts.split(',')):
+        for engine in ('thread per LED', 'animator'):
+            backend = led_animator.FakePwmBackend()
+            animator = None
+            if engine == 'animator':
+                animator = led_animator.LedAnimator(backend, tick_ms=tick_ms)
+                start = [lambda pin=pin: animator.animate(
+                    pin, led_animator.BREATHING, phase=pin / float(count))
+                    for pin in range(count)]
+            else:
+                legacy = [LegacyBreathingLed(backend, pin)
+                          for pin in range(count)]
+                start = [led.start_breathing for led in legacy]
+            threads = threading.active_count()
+            cpu_started_at = time.process_time()
+            started_at = time.monotonic()
+            for func in start:
+                func()
+            threads = threading.active_count() - threads
+            time.sleep(seconds)
+            cpu_time = time.process_time() - cpu_started_at
+            elapsed = time.monotonic() - started_at
+            changes = backend.changes
+            if animator is not None:
+                animator.stop()
+                animator.join()
+                late = '%d/%d' % (animator.late_ticks, animator.ticks)
+            else:
+                for led in legacy:
+                    led.stop()
+                late = '-'
+            rows.append((str(count), engine, str(threads),
+                         '%.2f' % (cpu_time / elapsed * 100),
+                         '%.3f' % (cpu_time / elapsed * 100 / count),
+                         '%.0f' % (changes / elapsed), late))
+    print_table(('LEDs', 'engine', 'threads', 'CPU %', 'CPU % per LED',
+                 'changes/s', 'late ticks'), rows)
+
+
+@main.command()
+@click.option('--repeat', default=5, show_default=True,
+              help='Number of timed runs, the best one is reported.')
+@click.option('--number', default=2000, show_default=True,
+              help='Blocks metered per timed run.')
+def levels(repeat, number):
+    """Cost of the level meter on the audio path, per 100 ms block.
+
+    The time is spent by the thread reading or writing the audio, the
+    subscribers run on the dispatcher thread of the meter.
+    """
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    block_ms = 100
+    block = os.urandom(sample_rate * sample_width * block_ms // 1000)
+    rows = []
+    for rate_hz, subscribers in ((audio_helpers.DEFAULT_LEVEL_METER_RATE_HZ,
+                                  0),
+                                 (audio_helpers.DEFAULT_LEVEL_METER_RATE_HZ,
+                                  1),
+                                 (audio_helpers.DEFAULT_LEVEL_METER_RATE_HZ,
+                                  4),
+                                 (float('inf'), 4)):
+        meter = audio_helpers.LevelMeter(sample_rate, sample_width,
+                                         rate_hz=rate_hz)
+        received = []
+        for _ in range(subscribers):
+            meter.subscribe(received.append)
+        seconds = best_of(
+            lambda: meter.measure(audio_helpers.LEVELS_CAPTURE, block),
+            repeat, number)
+        rows.append(('unthrottled' if rate_hz == float('inf')
+                     else '%g Hz' % rate_hz,
+                     str(subscribers),
+                     '%.1f' % (seconds * 1e6),
+                     '%.4f' % (seconds * 1000 / block_ms * 100)))
+    print_table(('rate', 'subscribers', 'us per block', '% of block'), rows)
+
+
+@main.command()
+@click.option('--chains',
+              default='gain,dc,highpass,limiter,dc+highpass+limiter',
+              show_default=True,
+              help='Comma separated pipelines, the stages of one joined '
+                   'with +.')
+@click.option('--repeat', default=5, show_default=True,
+              help='Number of timed runs, the best one is reported.')
+@click.option('--number', default=500, show_default=True,
+              help='Blocks processed per timed run.')
+def dsp(chains, repeat, number):
+    """Cost of the audio processing pipelines, per 100 ms block.
+
+    The stage times are the ones the pipeline records itself. The
+    per-sample loop ConversationStream.write used to run is timed for
+    reference.
+    """
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    block_ms = 100
+    block = os.urandom(sample_rate * sample_width * block_ms // 1000)
+    legacy = best_of(lambda: legacy_normalize_audio_buffer(block, 50),
+                     repeat, number)
+    rows = [('per-sample loop', '-', '%.1f' % (legacy * 1e6),
+             '%.3f' % (legacy * 1000 / block_ms * 100))]
+    for chain in chains.split(','):
+        try:
+            pipeline = audio_pipeline.create_pipeline(
+                chain.replace('+', ','), sample_rate, sample_width)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--chains')
+        seconds = best_of(lambda: pipeline.process(block), repeat, number)
+        stages = ' '.join('%s=%.1f' % item
+                          for item in pipeline.timings().items())
+        rows.append((chain, stages, '%.1f' % (seconds * 1e6),
+                     '%.3f' % (seconds * 1000 / block_ms * 100)))
+    print_table(('pipeline', 'us per block by stage', 'us per block',
+                 '% of block'), rows)
+
+
+class LinearResampler(object):
+    """Streaming linear interpolation, what ALSA's plug layer does by default.
+
+    Used as the reference of the resample benchmark.
+    """
+    def __init__(self, from_rate, to_rate):
+        self.step = from_rate / float(to_rate)
+        # Position in the block after the last sample of the previous one.
+        self._last = 0.0
+        self._position = 1.0
+
+    def resample(self, samples):
+        extended = np.concatenate(([self._last], samples))
+        positions = np.arange(self._position, len(samples), self.step)
+        self._position = (positions[-1] + self.step - len(samples)
+                          if len(positions) else self._position - len(samples))
+        self._last = extended[-1]
+        return np.interp(positions, np.arange(len(extended)), extended)
+
+
+def tone_error_db(resampler_class, from_rate, to_rate, frequency):
+    """Level in dB of the error on a resampled sine, relative to the sine.
+
+    Below both Nyquist frequencies the error is measured against the
+    ideal sine, above the output one the whole output is an error.
+    """
+    input_time = np.arange(from_rate) / float(from_rate)
+    resampler = resampler_class(from_rate, to_rate)
+    output = np.concatenate([resampler.resample(block) for block in
+                             np.array_split(np.sin(2 * np.pi * frequency
+                                                   * input_time), 10)])
+    output = output[to_rate // 10:len(output) - to_rate // 10]
+    if frequency < to_rate / 2.0:
+        output_time = (np.arange(len(output)) + to_rate // 10) / float(to_rate)
+        output = output - np.sin(2 * np.pi * frequency * output_time)
+    return 20 * math.log10(max(np.sqrt(np.mean(output ** 2)), 1e-10)
+                           / math.sqrt(0.5))
+
+
+@main.command()
+@click.option('--rates', default='16000:48000,48000:16000,16000:44100,'
+              '44100:16000', show_default=True,
+              help='Comma separated from:to sample rates.')
+@click.option('--repeat', default=3, show_default=True,
+              help='Number of timed runs, the best one is reported.')
+def resample(rates, repeat):
+    """CPU and quality of the polyphase resampler vs linear interpolation.
+
+    Linear interpolation stands in for the rate converter of ALSA's plug
+    layer, which is what opening a 48 kHz card at 16 kHz uses. The CPU is
+    the time to resample one second of 16-bit audio in 100 ms blocks.
+    The 1 kHz error measures the accuracy, the stopband error a tone
+    the conversion must remove: above the output Nyquist frequency when
+    decimating, and the images of a tone near the input one otherwise.
+    """
+    rows = []
+    for pair in rates.split(','):
+        from_rate, to_rate = (int(rate) for rate in pair.split(':'))
+        block = (np.random.randn(from_rate // 10) * 3000).astype('<i2')
+        # A tone with images above 0.6 from_rate, or between the two
+        # Nyquist frequencies.
+        stop_frequency = (0.4 * from_rate if to_rate > from_rate
+                          else to_rate / 2.0 + (from_rate - to_rate) / 5.0)
+        for name, resampler_class in (
+                ('polyphase', audio_helpers.Resampler),
+                ('linear', LinearResampler)):
+            resampler = resampler_class(from_rate, to_rate)
+            seconds = best_of(lambda: resampler.resample(block), repeat, 10)
+            rows.append(('%d -> %d' % (from_rate, to_rate), name,
+                         '%.2f' % (seconds * 10 * 1000),
+                         '%.2f' % (seconds * 10 * 100),
+                         '%.1f' % tone_error_db(resampler_class, from_rate,
+                                                to_rate, 1000),
+                         '%.1f' % tone_error_db(resampler_class, from_rate,
+                                                to_rate, stop_frequency)))
+    print_table(('rates', 'resampler', 'ms per s', 'CPU %',
+                 '1 kHz error dB', 'stopband error dB'), rows)
+
+
+class SchedulingProbe(object):
+    """Wakes up periodically, measuring how late it runs and the threads.
+
+    Args:
+      interval: seconds between the wake-ups.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.lateness = []
+        self.threads = threading.active_count()
+        self.native_threads = native_thread_count()
+        self.baseline = (self.threads, self.native_threads)
+
+    def _sample(self, expected_at):
+        self.lateness.append(time.monotonic() - expected_at)
+        self.threads = max(self.threads, threading.active_count())
+        self.native_threads = max(self.native_threads, native_thread_count())
+
+    def run(self, stopped):
+        """Samples from the calling thread until stopped is set."""
+        while not stopped.is_set():
+            expected_at = time.monotonic() + self.interval
+            time.sleep(self.interval)
+            self._sample(expected_at)
+
+    async def run_async(self):
+        """Samples from a task of the event loop until cancelled."""
+        while True:
+            expected_at = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._sample(expected_at)
+
+    def added_threads(self):
+        """Peak (Python, native) threads over the ones before the probe."""
+        return (self.threads - self.baseline[0],
+                self.native_threads - self.baseline[1])
+
+
+def native_thread_count():
+    """Threads of the process, including the ones gRPC runs in C."""
+    try:
+        return len(os.listdir('/proc/self/task'))
+    except OSError:
+        return threading.active_count()
+
+
+class ErrorCountingTracer(turn_tracing.TurnTracer):
+    """TurnTracer keeping the errors the turns finished with."""
+
+    def __init__(self):
+        super(ErrorCountingTracer, self).__init__()
+        self.errors = []
+
+    def finish_turn(self, error=None):
+        if error is not None and self.current is not None:
+            self.errors.append(error)
+        return super(ErrorCountingTracer, self).finish_turn(error)
+
+
+def push_steps(gpio, pin, tracer, pushes, stop_after, results):
+    """Yields the seconds to wait between the button pushes of a run.
+
+    Pushes the button and waits for the conversation to end, pushes
+    times. Then pushes once more and pushes again stop_after seconds
+    later, storing in results['stop_ms'] how long the conversation took
+    to end after the second push.
+    """
+    def push():
+        gpio.set_input(pin, True)
+        yield push_button.DEFAULT_DEBOUNCE_TIME * 5
+        gpio.set_input(pin, False)
+
+    # Leave the runtime the time to arm the button.
+    yield 0.2
+    for turn in range(1, pushes + 2):
+        yield from push()
+        stopping_at = None
+        if turn > pushes:
+            yield stop_after
+            stopping_at = time.monotonic()
+            yield from push()
+        while tracer.turns < turn or tracer.current is not None:
+            yield 0.01
+        if stopping_at is not None:
+            results['stop_ms'] = (time.monotonic() - stopping_at) * 1000
+        # The conversation logs and closes its stream after the turn ends,
+        # a push before that would cancel it in the asyncio runtime.
+        yield 0.2
+
+
+def run_runtime(name, server, pushes, stop_after, probe_ms,
+                playback_buffer_ms):
+    """Runs conversations on the blocking or the asyncio runtime.
+
+    Returns: (ErrorCountingTracer, SchedulingProbe, results dict with the
+      client CPU seconds and the stop_ms of push_steps()).
+    """
+    # Imported here, they pull in the modules of the device.
+    try:
+        from . import async_runtime, breathing_led, push_red_to_talk
+    except (SystemError, ImportError):
+        import async_runtime
+        import breathing_led
+        import push_red_to_talk
+
+    manager = audio_helpers.AudioDeviceManager(
+        sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+        sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+        block_size=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
+        flush_size=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE,
+        device_class=audio_helpers.LoopbackStream)
+    manager.open()
+    animator = led_animator.LedAnimator(led_animator.FakePwmBackend())
+    tracer = ErrorCountingTracer()
+    options = dict(
+        audio_device_manager=manager,
+        deadline=push_red_to_talk.DEFAULT_GRPC_DEADLINE,
+        tracer=tracer,
+        led=breathing_led.BreathingLed(
+            push_red_to_talk.RED_BREATHING_LED_PIN, animator=animator),
+        playback_buffer_ms=playback_buffer_ms)
+    gpio = push_button.FakeGpioBackend()
+    pin = push_button.PushButton.DEFAULT_GPIO_PIN
+    button = push_button.PushButton(pin, gpio=gpio, long_press_time=None)
+    results = {}
+    steps = push_steps(gpio, pin, tracer, pushes, stop_after, results)
+    probe = SchedulingProbe(probe_ms / 1000.0)
+    server_cpu_time = server.servicer.cpu_time
+    cpu_started_at = time.process_time()
+
+    if name == 'blocking':
+        channel = server.channel()
+        stopped = threading.Event()
+        prober = threading.Thread(target=probe.run, args=(stopped,))
+        prober.start()
+        waiter = threading.Thread(
+            target=button.wait_for_push,
+            args=(push_red_to_talk.converse_with_assistant,),
+            kwargs=dict(channel=channel, **options))
+        waiter.start()
+        for seconds in steps:
+            time.sleep(seconds)
+        button.stop()
+        waiter.join()
+        stopped.set()
+        prober.join()
+        channel.close()
+        animator.cleanup()
+    else:
+        async def connect():
+            return grpc.aio.insecure_channel('localhost:%d' % server.port)
+
+        async def run():
+            prober = asyncio.ensure_future(probe.run_async())
+            serving = asyncio.ensure_future(async_runtime.serve(
+                async_runtime.AsyncPushButton(button), connect,
+                animator=animator, **options))
+            for seconds in steps:
+                await asyncio.sleep(seconds)
+            for task in (serving, prober):
+                task.cancel()
+            await asyncio.gather(serving, prober, return_exceptions=True)
+
+        asyncio.run(run())
+    results['cpu_time'] = (time.process_time() - cpu_started_at
+                           - (server.servicer.cpu_time - server_cpu_time))
+    manager.close()
+    return tracer, probe, results
+
+
+@main.command()
+@click.option('--scenario', '-s', default='long-answer', show_default=True,
+              type=click.Choice(sorted(fake_assistant.SCENARIOS)),
+              help='Scripted timeline to replay.')
+@click.option('--pushes', default=3, show_default=True,
+              help='Conversations held to the end per runtime.')
+@click.option('--stop-after', default=3.0, show_default=True,
+              help='Seconds into the last conversation the button is '
+                   'pushed again to stop it.')
+@click.option('--probe-ms', default=10, show_default=True,
+              help='Interval of the wake-ups measuring the scheduling '
+                   'latency.')
+@click.option('--playback-buffer-ms',
+              default=audio_helpers.DEFAULT_PLAYBACK_BUFFER_MS,
+              show_default=True,
+              help='Playback buffer of the conversation streams.')
+def runtime(scenario, pushes, stop_after, probe_ms, playback_buffer_ms):
+    """Scheduling latency and threads of the blocking vs asyncio runtime.
+
+    Both runtimes hold conversations pushed on a fake GPIO button, with a
+    breathing LED on a fake PWM backend, a real time loopback stand-in for
+    the sound card and a local fake of the Assistant API. A probe wakes
+    up every probe-ms, from its own thread on the blocking runtime and
+    from a task of the event loop on the asyncio one, and reports how
+    late it runs. Threads are the peak over the ones running before,
+    native ones include gRPC's, the fake server's count for both. Stop is
+    the time a push during an answer takes to end it, the blocking
+    runtime ignores that push.
+    """
+    rows = []
+    for name in ('blocking', 'asyncio'):
+        with fake_assistant.FakeAssistantServer(
+                fake_assistant.SCENARIOS[scenario]) as server:
+            tracer, probe, results = run_runtime(
+                name, server, pushes, stop_after, probe_ms,
+                playback_buffer_ms)
+        lateness = np.array(probe.lateness) * 1000
+        threads, native_threads = probe.added_threads()
+        percentiles = tracer.percentiles()
+        rows.append((name, tracer.turns, len(tracer.errors),
+                     percentile_ms(percentiles,
+                                   turn_tracing.FIRST_REQUEST_SENT, 50),
+                     percentile_ms(percentiles,
+                                   turn_tracing.FIRST_AUDIO_WRITTEN, 50),
+                     '%.2f' % np.percentile(lateness, 50),
+                     '%.2f' % np.percentile(lateness, 99),
+                     '%.2f' % lateness.max(),
+                     threads, native_threads,
+                     '%.0f' % results['stop_ms'],
+                     '%.1f' % (results['cpu_time'] * 1000
+                               / max(tracer.turns, 1))))
+    print_table(('runtime', 'turns', 'errors', 'first request p50',
+                 'first sound p50', 'late p50 ms', 'late p99 ms',
+                 'late max ms', 'threads', 'native threads', 'stop ms',
+                 'cpu ms/turn'), rows)
+
+
+if __name__ == '__main__':
+    main()
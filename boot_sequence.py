@@ -0,0 +1,182 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Concurrent boot phases of the device and its time-to-ready."""
+
+import collections
+import logging
+import os
+import threading
+import time
+
+
+class BootError(Exception):
+    """Raised when a phase needed for the device to be ready failed."""
+
+
+def process_started_at():
+    """Returns the time.monotonic() the process started at, None if unknown.
+
+    Linux only, it covers the interpreter start up and the module imports
+    done before the BootSequence exists.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name can contain spaces, the fields follow ')'.
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        started_after_boot = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return time.monotonic() - (uptime - started_after_boot)
+
+
+class BootPhase(object):
+    """A step of the boot sequence, run on its own thread.
+
+    Args:
+      name: name of the phase in the logs.
+      func: callable run by the phase, its return value is the result.
+      after: names of the phases that must finish before this one starts.
+      required: the device is not ready until the phase has finished.
+    """
+    def __init__(self, name, func, after=(), required=True):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+        self.required = required
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def duration(self):
+        """Seconds the phase ran for, None until it finished."""
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+class BootSequence(object):
+    """Runs the boot phases concurrently, each once its dependencies finish.
+
+    The device is ready when all the required phases have finished. The
+    time-to-ready is measured from the start of the process when known,
+    otherwise from the creation of the sequence, and logged with the
+    timing of every phase.
+    """
+    def __init__(self):
+        self.created_at = time.monotonic()
+        self.process_started_at = process_started_at()
+        self._phases = collections.OrderedDict()
+        self.ready_at = None
+
+    def add(self, name, func, after=(), required=True):
+        """Add a phase, see BootPhase. Returns the BootPhase."""
+        for dependency in after:
+            if dependency not in self._phases:
+                raise ValueError('unknown boot phase: %s' % dependency)
+        phase = BootPhase(name, func, after, required)
+        self._phases[name] = phase
+        return phase
+
+    def start(self):
+        """Start a thread per phase."""
+        for phase in self._phases.values():
+            threading.Thread(target=self._run, args=(phase,),
+                             name='boot-%s' % phase.name,
+                             daemon=True).start()
+
+    def _run(self, phase):
+        for dependency in phase.after:
+            self._phases[dependency].done.wait()
+        failed = [dependency for dependency in phase.after
+                  if self._phases[dependency].error is not None]
+        phase.started_at = time.monotonic()
+        try:
+            if failed:
+                raise BootError('%s failed' % ', '.join(failed))
+            phase.result = phase.func()
+        except Exception as e:
+            phase.error = e
+            logging.error('Boot phase %s failed: %s', phase.name, e)
+        finally:
+            phase.finished_at = time.monotonic()
+            phase.done.set()
+        if self.ready_at is not None:
+            logging.info('Boot phase %s finished %.0f ms after ready',
+                         phase.name, (phase.finished_at - self.ready_at) * 1000)
+
+    def result(self, name, timeout=None):
+        """Returns the result of a phase, waiting for it to finish.
+
+        Raises: BootError if the phase failed or timed out.
+        """
+        phase = self._phases[name]
+        if not phase.done.wait(timeout):
+            raise BootError('boot phase %s timed out' % name)
+        if phase.error is not None:
+            raise BootError('boot phase %s failed: %s' % (name, phase.error))
+        return phase.result
+
+    def wait_ready(self, timeout=None):
+        """Wait for the required phases and log the time-to-ready.
+
+        Raises: BootError if one of them failed or timed out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            for phase in self._phases.values():
+                if phase.required:
+                    self.result(phase.name, None if deadline is None
+                                else max(deadline - time.monotonic(), 0))
+        except BootError:
+            self.log_report()
+            raise
+        self.ready_at = time.monotonic()
+        self.log_report()
+
+    def time_to_ready(self):
+        """Seconds from the start of the process to ready, None if not yet."""
+        if self.ready_at is None:
+            return None
+        return self.ready_at - (self.process_started_at or self.created_at)
+
+    def log_report(self):
+        """Log when each phase ran, relative to the start of the process."""
+        origin = self.process_started_at or self.created_at
+        lines = []
+        if self.process_started_at is not None:
+            lines.append('  %-14s %7.0f ms' % (
+                'startup', (self.created_at - origin) * 1000))
+        for phase in self._phases.values():
+            if phase.started_at is None:
+                lines.append('  %-14s waiting' % phase.name)
+            elif phase.finished_at is None:
+                lines.append('  %-14s %7.0f ms  running' % (
+                    phase.name, (phase.started_at - origin) * 1000))
+            else:
+                lines.append('  %-14s %7.0f ms  +%6.0f ms%s' % (
+                    phase.name, (phase.started_at - origin) * 1000,
+                    phase.duration * 1000,
+                    '  failed' if phase.error is not None else ''))
+        if self.ready_at is None:
+            status = 'Not ready %.0f ms' % ((time.monotonic() - origin) * 1000)
+        else:
+            status = 'Ready %.0f ms' % (self.time_to_ready() * 1000)
+        logging.info('%s after start, boot phases (start, duration):\n%s',
+                     status, '\n'.join(lines))
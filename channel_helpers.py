@@ -0,0 +1,120 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers keeping the gRPC channel to the Assistant API warm."""
+
+import logging
+import threading
+import time
+
+import grpc
+
+
+DEFAULT_KEEPALIVE_TIME_MS = 2 * 60 * 1000
+DEFAULT_KEEPALIVE_TIMEOUT_MS = 20 * 1000
+
+# Connectivity states in which new calls would fail anyway.
+DOWN_STATES = (
+    grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+    grpc.ChannelConnectivity.SHUTDOWN,
+)
+
+
+class ChannelUnavailableError(Exception):
+    """Raised instead of calling the API when the channel is known down."""
+
+
+def keepalive_options(keepalive_time_ms=DEFAULT_KEEPALIVE_TIME_MS,
+                      keepalive_timeout_ms=DEFAULT_KEEPALIVE_TIMEOUT_MS):
+    """Returns gRPC channel options sending keepalive pings while idle.
+
+    Args:
+      keepalive_time_ms: interval between pings in milliseconds.
+      keepalive_timeout_ms: time to wait for a ping ack before the
+        connection is considered dead, in milliseconds.
+    """
+    return [
+        ('grpc.keepalive_time_ms', keepalive_time_ms),
+        ('grpc.keepalive_timeout_ms', keepalive_timeout_ms),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.max_pings_without_data', 0),
+    ]
+
+
+class ChannelMonitor(object):
+    """Tracks the connectivity state of a gRPC channel in the background.
+
+    start() asks the channel to connect right away, so DNS, TCP, TLS and
+    HTTP/2 setup happen before the first Converse() call. The channel is
+    asked to reconnect whenever it goes idle.
+
+    Args:
+      channel: gRPC channel to monitor.
+    """
+    def __init__(self, channel):
+        self._channel = channel
+        self._state = None
+        self._state_changed = threading.Condition()
+        self._started_at = None
+        self._ready_logged = False
+        self._reconnect = None
+
+    def start(self):
+        """Start connecting the channel and tracking its state."""
+        self._started_at = time.monotonic()
+        self._channel.subscribe(self._on_state_change, try_to_connect=True)
+
+    def stop(self):
+        """Stop tracking the channel state."""
+        self._channel.unsubscribe(self._on_state_change)
+        if self._reconnect is not None:
+            self._reconnect.cancel()
+
+    @property
+    def state(self):
+        """Last known grpc.ChannelConnectivity, None until first reported."""
+        return self._state
+
+    def is_down(self):
+        """True if calls on the channel are known to fail right now."""
+        return self._state in DOWN_STATES
+
+    def is_ready(self):
+        return self._state == grpc.ChannelConnectivity.READY
+
+    def wait_for_ready(self, timeout=None):
+        """Block until the channel is ready.
+
+        Args:
+          timeout: seconds to wait, None waits forever.
+
+        Returns: True if the channel is ready.
+        """
+        with self._state_changed:
+            return self._state_changed.wait_for(self.is_ready, timeout)
+
+    def _on_state_change(self, state):
+        with self._state_changed:
+            self._state = state
+            self._state_changed.notify_all()
+        logging.debug('gRPC channel state: %s', state)
+        if state == grpc.ChannelConnectivity.READY and not self._ready_logged:
+            self._ready_logged = True
+            logging.info('gRPC channel ready after %.1f ms',
+                         (time.monotonic() - self._started_at) * 1000)
+        elif state == grpc.ChannelConnectivity.IDLE:
+            # Reconnect right away, instead of on the next Converse() call.
+            self._reconnect = grpc.channel_ready_future(self._channel)
+        elif state in DOWN_STATES:
+            logging.warning('gRPC channel is down: %s', state)
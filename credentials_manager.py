@@ -0,0 +1,206 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""OAuth 2.0 credentials with a cached access token refreshed ahead of time."""
+
+import calendar
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import google.auth.transport.requests
+import google.oauth2.credentials
+
+
+TOKEN_CACHE_FILE = 'access_token.json'
+
+# google-auth refreshes a token lazily, on the first call made less than
+# 3 min 45 s before it expires. Refreshing earlier keeps that off the calls.
+DEFAULT_REFRESH_MARGIN = 5 * 60
+DEFAULT_RETRY_INTERVAL = 30
+# Tokens issued for less than twice the margin are refreshed half-way
+# through their life, not right after being fetched.
+MAX_REFRESH_MARGIN_FRACTION = 0.5
+
+
+def _fingerprint(info):
+    """Identifies the credentials a cached token was issued for."""
+    key = '%s:%s' % (info.get('client_id'), info.get('refresh_token'))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+class CredentialManager(object):
+    """Loads credentials.json and keeps its access token valid.
+
+    The access token and its expiry are kept in a cache file next to
+    credentials.json, so a restart within the life of the token does not
+    fetch a new one. Once started, a background timer refreshes the token
+    refresh_margin seconds before it expires.
+
+    Args:
+      credentials_path: credentials.json written by google-oauthlib-tool.
+      cache_path: file the access token is cached in, defaults to
+        access_token.json next to credentials_path. None disables it.
+      refresh_margin: seconds before the expiry the token is refreshed, at
+        most MAX_REFRESH_MARGIN_FRACTION of the life of a fetched token.
+      retry_interval: seconds between attempts after a failed refresh.
+      token_uri: optional token endpoint overriding the one in
+        credentials.json, e.g. a local stand-in.
+      tracer(TurnTracer): optional tracer exporting the token fetch time.
+    """
+    def __init__(self, credentials_path, cache_path=TOKEN_CACHE_FILE,
+                 refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 retry_interval=DEFAULT_RETRY_INTERVAL, token_uri=None,
+                 tracer=None):
+        self.credentials_path = credentials_path
+        if cache_path == TOKEN_CACHE_FILE:
+            cache_path = os.path.join(os.path.dirname(credentials_path),
+                                      TOKEN_CACHE_FILE)
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.token_uri = token_uri
+        self.tracer = tracer
+        self.credentials = None
+        self.request = google.auth.transport.requests.Request()
+        self.fetches = 0
+        self.fetch_failures = 0
+        self.last_fetch_ms = None
+        # Seconds the last fetched token was issued for.
+        self._lifetime = None
+        self._fingerprint = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Returns the credentials, with the cached token if still valid."""
+        with open(self.credentials_path, 'r') as f:
+            info = json.load(f)
+        if self.token_uri:
+            info['token_uri'] = self.token_uri
+        self._fingerprint = _fingerprint(info)
+        token, expiry = self._read_cache()
+        self.credentials = google.oauth2.credentials.Credentials(
+            token=token, expiry=expiry, **info)
+        if token:
+            logging.info('Using the cached access token, it expires in '
+                         '%.0f s', self.expires_in())
+        return self.credentials
+
+    def expires_in(self):
+        """Seconds until the access token expires, 0 without a token."""
+        if self.credentials is None or not self.credentials.token:
+            return 0
+        if self.credentials.expiry is None:
+            return float('inf')
+        return (self.credentials.expiry
+                - datetime.datetime.utcnow()).total_seconds()
+
+    def ensure_valid(self):
+        """Fetch a token unless the current one outlives the refresh margin.
+
+        Returns: True if a token was fetched.
+        """
+        if self.expires_in() > self._refresh_margin():
+            return False
+        self.refresh()
+        return True
+
+    def refresh(self):
+        """Fetch a new access token and cache it."""
+        with self._lock:
+            started_at = time.monotonic()
+            try:
+                self.credentials.refresh(self.request)
+            except Exception:
+                self.fetch_failures += 1
+                raise
+            self.last_fetch_ms = (time.monotonic() - started_at) * 1000
+            self.fetches += 1
+            self._lifetime = self.expires_in()
+        logging.info('Access token fetched in %.1f ms, it expires in %.0f s',
+                     self.last_fetch_ms, self.expires_in())
+        if self.tracer is not None:
+            self.tracer.set_gauges({
+                'token_fetch_milliseconds': self.last_fetch_ms,
+                'token_fetches': self.fetches,
+            })
+        self._write_cache()
+
+    def start(self):
+        """Start refreshing the token in the background before it expires."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refresh_ahead,
+                                        name='token-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _refresh_margin(self):
+        if self._lifetime is None:
+            return self.refresh_margin
+        return min(self.refresh_margin,
+                   self._lifetime * MAX_REFRESH_MARGIN_FRACTION)
+
+    def _refresh_ahead(self):
+        delay = max(self.expires_in() - self._refresh_margin(), 0)
+        while not self._stopped.wait(delay):
+            try:
+                self.refresh()
+                delay = max(self.expires_in() - self._refresh_margin(),
+                            self.retry_interval)
+            except Exception as e:
+                logging.warning('Error refreshing the access token: %s, '
+                                'retrying in %d s', e, self.retry_interval)
+                delay = self.retry_interval
+
+    def _read_cache(self):
+        if not self.cache_path:
+            return None, None
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.load(f)
+            if cache.get('fingerprint') != self._fingerprint:
+                return None, None
+            expiry = datetime.datetime.utcfromtimestamp(cache['expiry'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None, None
+        if expiry <= datetime.datetime.utcnow():
+            return None, None
+        return cache['token'], expiry
+
+    def _write_cache(self):
+        if not self.cache_path or self.credentials.expiry is None:
+            return
+        cache = {
+            'token': self.credentials.token,
+            'expiry': calendar.timegm(self.credentials.expiry.utctimetuple()),
+            'fingerprint': self._fingerprint,
+        }
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            # The token is a secret, like credentials.json.
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            logging.warning('Error caching the access token: %s', e)
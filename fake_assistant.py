@@ -0,0 +1,298 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process fake of the Google Assistant API replaying scripted turns."""
+
+import functools
+import http.server
+import io
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent import futures
+
+import grpc
+import numpy as np
+import soundfile as sf
+
+from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
+
+try:
+    from . import audio_codecs
+except (SystemError, ImportError):
+    import audio_codecs
+
+
+END_OF_UTTERANCE = embedded_assistant_pb2.ConverseResponse.END_OF_UTTERANCE
+DIALOG_FOLLOW_ON = embedded_assistant_pb2.ConverseResult.DIALOG_FOLLOW_ON
+CLOSE_MICROPHONE = embedded_assistant_pb2.ConverseResult.CLOSE_MICROPHONE
+
+DEFAULT_CHUNK_SIZE = 1600
+DEFAULT_PACING = 2.0
+
+
+class ScriptedTurn(object):
+    """Timeline of the responses to one Converse() call.
+
+    Args:
+      end_of_utterance_ms: milliseconds of request audio received before
+        END_OF_UTTERANCE is sent.
+      processing_ms: delay between the end of the request stream and the
+        first audio_out chunk.
+      answer_ms: duration of the answer audio.
+      chunk_size: size in bytes of each audio_out chunk.
+      pacing: speed of the answer relative to real time, 2.0 sends the
+        chunks twice as fast as they play. 0 sends them all at once.
+      link_kbps: optional bandwidth in kilobits per second of the link,
+        the chunks are not sent faster than it carries them.
+      follow_on: ask for a follow-on query (DIALOG_FOLLOW_ON).
+      error: optional grpc.StatusCode the call is aborted with.
+      error_after_ms: milliseconds of request audio received before the
+        call is aborted with error.
+      spoken_request_text: transcript of the request.
+    """
+    def __init__(self, end_of_utterance_ms=1000, processing_ms=300,
+                 answer_ms=1500, chunk_size=DEFAULT_CHUNK_SIZE,
+                 pacing=DEFAULT_PACING, link_kbps=None, follow_on=False,
+                 error=None, error_after_ms=0,
+                 spoken_request_text='what time is it'):
+        self.end_of_utterance_ms = end_of_utterance_ms
+        self.processing_ms = processing_ms
+        self.answer_ms = answer_ms
+        self.chunk_size = chunk_size
+        self.pacing = pacing
+        self.link_kbps = link_kbps
+        self.follow_on = follow_on
+        self.error = error
+        self.error_after_ms = error_after_ms
+        self.spoken_request_text = spoken_request_text
+
+
+# Named timelines, each list is replayed in a loop, one turn per call.
+SCENARIOS = {
+    'short-answer': [ScriptedTurn()],
+    'long-answer': [ScriptedTurn(answer_ms=8000)],
+    'slow-network': [ScriptedTurn(processing_ms=1200, chunk_size=800,
+                                  pacing=1.1)],
+    'weak-wifi': [ScriptedTurn(answer_ms=8000, link_kbps=96)],
+    'follow-on': [ScriptedTurn(follow_on=True), ScriptedTurn()],
+    'unavailable': [ScriptedTurn(error=grpc.StatusCode.UNAVAILABLE,
+                                 error_after_ms=200),
+                    ScriptedTurn()],
+}
+
+
+def audio_bytes(duration_ms, sample_rate, sample_width=2):
+    """Size in bytes of duration_ms of mono audio."""
+    return int(duration_ms * sample_rate / 1000) * sample_width
+
+
+@functools.lru_cache(maxsize=16)
+def answer_audio(duration_ms, sample_rate, encoding):
+    """Returns a synthetic spoken-like answer in the given encoding."""
+    t = np.arange(int(duration_ms * sample_rate / 1000)) / float(sample_rate)
+    # Syllables of a 150 Hz voice with a few harmonics, at 4 per second.
+    envelope = np.clip(np.sin(2 * np.pi * 2 * t), 0, None)
+    voice = sum(np.sin(2 * np.pi * 150 * h * t) / h for h in range(1, 6))
+    pcm = (envelope * voice * 4000).astype('<i2')
+    if encoding == audio_codecs.AUDIO_OUT_LINEAR16:
+        return pcm.tobytes()
+    file_format, subtype = audio_codecs.AUDIO_OUT_FORMATS[encoding]
+    buf = io.BytesIO()
+    sf.write(buf, pcm, sample_rate, format=file_format, subtype=subtype)
+    return buf.getvalue()
+
+
+class FakeEmbeddedAssistant(embedded_assistant_pb2.EmbeddedAssistantServicer):
+    """EmbeddedAssistant servicer replaying scripted turns.
+
+    Args:
+      turns: list of ScriptedTurn, replayed in a loop.
+    """
+    def __init__(self, turns):
+        self._turns = itertools.cycle(turns)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # CPU seconds spent serving, to tell it apart from the client's.
+        self.cpu_time = 0.0
+
+    def Converse(self, request_iterator, context):
+        with self._lock:
+            turn = next(self._turns)
+            self.calls += 1
+        cpu_started_at = time.thread_time()
+        try:
+            for response in self._converse(turn, request_iterator, context):
+                yield response
+        finally:
+            with self._lock:
+                self.cpu_time += time.thread_time() - cpu_started_at
+
+    def _converse(self, turn, request_iterator, context):
+        config = next(request_iterator).config
+        sample_rate = config.audio_in_config.sample_rate_hertz
+        end_of_utterance = audio_bytes(turn.end_of_utterance_ms, sample_rate)
+        error_after = audio_bytes(turn.error_after_ms, sample_rate)
+
+        received = 0
+        for request in request_iterator:
+            received += len(request.audio_in)
+            if turn.error is not None and received >= error_after:
+                self._count_received(received)
+                context.abort(turn.error, 'scripted %s' % turn.error.name)
+            if received >= end_of_utterance:
+                break
+        yield embedded_assistant_pb2.ConverseResponse(
+            event_type=END_OF_UTTERANCE)
+        # The client stops recording now, take the requests in flight.
+        for request in request_iterator:
+            received += len(request.audio_in)
+        self._count_received(received)
+
+        time.sleep(turn.processing_ms / 1000.0)
+        yield embedded_assistant_pb2.ConverseResponse(
+            result=embedded_assistant_pb2.ConverseResult(
+                spoken_request_text=turn.spoken_request_text))
+
+        answer = answer_audio(
+            turn.answer_ms, config.audio_out_config.sample_rate_hertz,
+            embedded_assistant_pb2.AudioOutConfig.Encoding.Name(
+                config.audio_out_config.encoding))
+        started_at = time.monotonic()
+        sent = 0
+        while sent < len(answer):
+            data = answer[sent:sent + turn.chunk_size]
+            # A chunk goes out when its audio is due and the link has
+            # carried the previous ones.
+            send_after = 0
+            if turn.pacing:
+                send_after = (turn.answer_ms / 1000.0 * sent / len(answer)
+                              / turn.pacing)
+            if turn.link_kbps:
+                send_after = max(send_after,
+                                 sent * 8 / (turn.link_kbps * 1000.0))
+            delay = started_at + send_after - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            yield embedded_assistant_pb2.ConverseResponse(
+                audio_out=embedded_assistant_pb2.AudioOut(audio_data=data))
+            sent += len(data)
+        with self._lock:
+            self.bytes_sent += sent
+
+        yield embedded_assistant_pb2.ConverseResponse(
+            result=embedded_assistant_pb2.ConverseResult(
+                conversation_state=b'fake-state',
+                microphone_mode=(DIALOG_FOLLOW_ON if turn.follow_on
+                                 else CLOSE_MICROPHONE)))
+
+    def _count_received(self, received):
+        with self._lock:
+            self.bytes_received += received
+
+
+class FakeAssistantServer(object):
+    """Local gRPC server running a FakeEmbeddedAssistant.
+
+    Args:
+      turns: list of ScriptedTurn the server replays.
+      max_workers: number of concurrent Converse() calls.
+      servicer: optional EmbeddedAssistant servicer run instead of the
+        scripted one, turns are then ignored.
+    """
+    def __init__(self, turns, max_workers=4, servicer=None):
+        self.servicer = (servicer if servicer is not None
+                         else FakeEmbeddedAssistant(turns))
+        self._server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=max_workers))
+        embedded_assistant_pb2.add_EmbeddedAssistantServicer_to_server(
+            self.servicer, self._server)
+        self.port = self._server.add_insecure_port('localhost:0')
+
+    def start(self):
+        self._server.start()
+        logging.debug('Fake Assistant API listening on port %d', self.port)
+        return self
+
+    def stop(self):
+        self._server.stop(grace=None)
+
+    def channel(self):
+        """Returns a new channel to the server."""
+        return grpc.insecure_channel('localhost:%d' % self.port)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, etype, e, traceback):
+        self.stop()
+
+
+class FakeTokenServer(object):
+    """Local stand-in for the OAuth 2.0 token endpoint.
+
+    Every POST is answered with a new access token, after delay_ms.
+
+    Args:
+      expires_in: lifetime in seconds of the tokens.
+      delay_ms: time taken to answer, like a slow network would.
+    """
+    def __init__(self, expires_in=3600, delay_ms=0):
+        self.expires_in = expires_in
+        self.delay_ms = delay_ms
+        self.requests = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(server.delay_ms / 1000.0)
+                server.requests += 1
+                body = json.dumps({
+                    'access_token': 'fake-token-%d' % server.requests,
+                    'expires_in': server.expires_in,
+                    'token_type': 'Bearer',
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.HTTPServer(('localhost', 0), Handler)
+        self.token_uri = 'http://localhost:%d/token' % self._server.server_port
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fake-token-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, etype, e, traceback):
+        self.stop()
@@ -0,0 +1,412 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""LED animations driven from waveform tables by one scheduler thread."""
+
+import asyncio
+import functools
+import logging
+import math
+import threading
+import time
+
+
+DEFAULT_TICK_MS = 20
+DEFAULT_PWM_FREQUENCY = 100
+
+BREATHING = 'breathing'
+BLINK = 'blink'
+SPINNER = 'spinner'
+
+
+def _breathing(x):
+    # Raised cosine, squared so the dim part lasts as long as it looks.
+    return ((1 - math.cos(2 * math.pi * x)) / 2) ** 2
+
+
+def _blink(x):
+    return 1.0 if x < 0.5 else 0.0
+
+
+def _spinner(x):
+    # A bright head fading out over a third of the period. LEDs of a ring
+    # animated with evenly spread phases make it go round.
+    return max(0.0, 1 - 3 * x)
+
+
+WAVEFORMS = {
+    BREATHING: _breathing,
+    BLINK: _blink,
+    SPINNER: _spinner,
+}
+
+
+@functools.lru_cache(maxsize=64)
+def waveform_table(waveform, steps):
+    """Returns the duty cycles in percent of one period of a waveform.
+
+    Args:
+      waveform: name of the waveform, one of WAVEFORMS.
+      steps: number of ticks in the period.
+    """
+    shape = WAVEFORMS[waveform]
+    return tuple(int(round(100 * shape(step / float(steps))))
+                 for step in range(steps))
+
+
+class RPiPwmBackend(object):
+    """PWM backend using the Raspberry Pi pins through RPi.GPIO."""
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+        self._pwms = {}
+
+    def setup(self, pin, frequency):
+        if pin in self._pwms:
+            return
+        self._gpio.setmode(self._gpio.BCM)
+        self._gpio.setup(pin, self._gpio.OUT)
+        pwm = self._gpio.PWM(pin, frequency)
+        pwm.start(0)
+        self._pwms[pin] = pwm
+
+    def set_duty_cycle(self, pin, duty_cycle):
+        self._pwms[pin].ChangeDutyCycle(duty_cycle)
+
+    def cleanup(self):
+        for pwm in self._pwms.values():
+            pwm.stop()
+        self._pwms.clear()
+        self._gpio.cleanup()
+
+
+class FakePwmBackend(object):
+    """In-memory PWM backend, to animate LEDs on any Linux box.
+
+    Attributes:
+      duty_cycles: last duty cycle set on each pin.
+      changes: number of duty cycle changes made.
+    """
+
+    def __init__(self):
+        self.duty_cycles = {}
+        self.changes = 0
+
+    def setup(self, pin, frequency):
+        self.duty_cycles.setdefault(pin, 0)
+
+    def set_duty_cycle(self, pin, duty_cycle):
+        self.duty_cycles[pin] = duty_cycle
+        self.changes += 1
+
+    def cleanup(self):
+        self.duty_cycles.clear()
+
+
+class Animation(object):
+    """Waveform table played in a loop on one LED.
+
+    Args:
+      table: duty cycles of one period, one per tick.
+      period: duration in seconds of the period.
+      phase: offset into the period, as a fraction of it.
+      started_at: time.monotonic() the animation starts at.
+    """
+    def __init__(self, table, period, phase=0.0, started_at=None):
+        self.table = table
+        self.period = period
+        self.phase = phase
+        self.started_at = (time.monotonic() if started_at is None
+                           else started_at)
+        self.duty_cycle = None
+
+    def duty_cycle_at(self, now):
+        """Returns the duty cycle due at now, skipping missed ticks."""
+        position = (now - self.started_at) / self.period + self.phase
+        return self.table[int(position * len(self.table)) % len(self.table)]
+
+
+class LedAnimator(object):
+    """Drives any number of LEDs from one scheduler thread.
+
+    Every tick_ms the thread looks up the duty cycle of each animated LED
+    in its waveform table and only changes the PWM when it differs. Ticks
+    are scheduled on deadlines, a late tick skips ahead instead of
+    slowing the animations down. Without animations the thread sleeps
+    until one is started.
+
+    On an asyncio event loop, run() drives the LEDs from a task instead
+    of the thread.
+
+    Args:
+      backend: PWM backend, RPiPwmBackend by default.
+      tick_ms: milliseconds between updates of the LEDs.
+    """
+    def __init__(self, backend=None, tick_ms=DEFAULT_TICK_MS):
+        self._backend = backend
+        self.tick = tick_ms / 1000.0
+        self._animations = {}
+        self._changed = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        # Event loop running run(), and the event waking it up.
+        self._loop = None
+        self._wakeup = None
+        self.ticks = 0
+        self.late_ticks = 0
+
+    @property
+    def backend(self):
+        # Created on first use, RPi.GPIO is not needed until then.
+        if self._backend is None:
+            self._backend = RPiPwmBackend()
+        return self._backend
+
+    def animate(self, pin, waveform, period=1.0, phase=0.0,
+                frequency=DEFAULT_PWM_FREQUENCY):
+        """Play a waveform in a loop on the LED of a pin.
+
+        Replaces the animation the LED was playing.
+
+        Args:
+          pin: GPIO pin (BCM numbering) of the LED.
+          waveform: name of the waveform, one of WAVEFORMS.
+          period: duration in seconds of one period of the waveform.
+          phase: offset into the period, as a fraction of it.
+          frequency: PWM frequency in hertz.
+        """
+        steps = max(1, int(round(period / self.tick)))
+        self._play(pin, Animation(waveform_table(waveform, steps), period,
+                                  phase), frequency)
+
+    def set(self, pin, duty_cycle, frequency=DEFAULT_PWM_FREQUENCY):
+        """Light the LED of a pin steadily, 0 turns it off."""
+        self._play(pin, Animation((duty_cycle,), 1.0), frequency)
+
+    def off(self, pin):
+        """Turn the LED of a pin off, if it was ever lit."""
+        with self._changed:
+            if pin not in self._animations:
+                return
+        self.set(pin, 0)
+
+    def _play(self, pin, animation, frequency):
+        with self._changed:
+            if self._stopping:
+                return
+            previous = self._animations.get(pin)
+            if previous is None:
+                self.backend.setup(pin, frequency)
+            else:
+                animation.duty_cycle = previous.duty_cycle
+            self._animations[pin] = animation
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            elif self._thread is None:
+                self.start()
+            self._changed.notify()
+
+    def start(self):
+        """Start the scheduler thread, done by the first animation."""
+        with self._changed:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='led-animator', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Turn the LEDs off and make the scheduler thread exit.
+
+        Animations started before the thread has exited are ignored, later
+        ones start it again.
+        """
+        with self._changed:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._changed.notify()
+
+    def join(self, timeout=None):
+        """Wait for the scheduler thread to exit after stop().
+
+        Returns: True if it exited.
+        """
+        thread = self._thread
+        if thread is None:
+            return True
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def cleanup(self):
+        """Stop and release the pins."""
+        self.stop()
+        self.join()
+        if self._backend is not None:
+            self._backend.cleanup()
+
+    def _run(self):
+        deadline = time.monotonic()
+        while True:
+            with self._changed:
+                while not self._stopping and not self._is_animating():
+                    self._changed.wait()
+                    deadline = time.monotonic()
+                if self._stopping:
+                    break
+                animations = list(self._animations.items())
+            now = time.monotonic()
+            self._update(animations, now)
+            self.ticks += 1
+            deadline += self.tick
+            if deadline < now:
+                self.late_ticks += 1
+                deadline = now + self.tick
+            with self._changed:
+                if not self._stopping:
+                    self._changed.wait(max(deadline - time.monotonic(), 0))
+        self._turn_off()
+        with self._changed:
+            self._thread = None
+            self._stopping = False
+
+    async def run(self):
+        """Drive the LEDs from the running event loop until cancelled.
+
+        Ticks like the scheduler thread, which is not started while this
+        runs. The LEDs are turned off when the task is cancelled.
+        """
+        with self._changed:
+            if self._thread is not None:
+                raise RuntimeError('the LED scheduler thread is running')
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+        deadline = time.monotonic()
+        try:
+            while True:
+                # Cleared before looking, a later animation sets it again.
+                self._wakeup.clear()
+                with self._changed:
+                    animating = self._is_animating()
+                    animations = list(self._animations.items())
+                if not animating:
+                    await self._wakeup.wait()
+                    deadline = time.monotonic()
+                    continue
+                now = time.monotonic()
+                self._update(animations, now)
+                self.ticks += 1
+                deadline += self.tick
+                if deadline < now:
+                    self.late_ticks += 1
+                    deadline = now + self.tick
+                await asyncio.sleep(max(deadline - time.monotonic(), 0))
+        finally:
+            with self._changed:
+                self._loop = None
+            self._turn_off()
+
+    def _turn_off(self):
+        with self._changed:
+            animations = list(self._animations.items())
+            self._animations.clear()
+        for pin, animation in animations:
+            if animation.duty_cycle:
+                self._set_duty_cycle(pin, 0)
+
+    def _is_animating(self):
+        # Steady LEDs already set need no ticks.
+        return any(len(animation.table) > 1 or animation.duty_cycle is None
+                   for animation in self._animations.values())
+
+    def _update(self, animations, now):
+        for pin, animation in animations:
+            duty_cycle = animation.duty_cycle_at(now)
+            if duty_cycle != animation.duty_cycle:
+                self._set_duty_cycle(pin, duty_cycle)
+                animation.duty_cycle = duty_cycle
+
+    def _set_duty_cycle(self, pin, duty_cycle):
+        try:
+            self.backend.set_duty_cycle(pin, duty_cycle)
+        except Exception as e:
+            logging.warning('Error setting LED on pin %d: %s', pin, e)
+
+
+class LevelLed(object):
+    """LED whose brightness follows the audio levels of a LevelMeter.
+
+    Can stand in for a BreathingLed, it follows the levels between
+    start_breathing() and stop().
+
+    Args:
+      led_pin: GPIO pin (BCM numbering) of the LED.
+      level_meter(LevelMeter): meter publishing the audio levels.
+      direction: direction of the levels followed, 'capture' or
+        'playback', see audio_helpers.LevelMeter.
+      floor_db: RMS level in dBFS under which the LED is off, it is fully
+        lit at 0 dBFS.
+      hertz: PWM frequency.
+      animator(LedAnimator): scheduler driving the LED, defaults to the
+        one shared by the LEDs of the device.
+    """
+    def __init__(self, led_pin, level_meter, direction='capture',
+                 floor_db=-50, hertz=DEFAULT_PWM_FREQUENCY, animator=None):
+        self.led_pin = led_pin
+        self.level_meter = level_meter
+        self.direction = direction
+        self.floor_db = floor_db
+        self.hertz = hertz
+        if animator is None:
+            animator = default_animator()
+        self.animator = animator
+        self._lock = threading.Lock()
+        self._following = False
+
+    def start_breathing(self):
+        with self._lock:
+            if self._following:
+                return
+            self._following = True
+        self.level_meter.subscribe(self._follow)
+
+    def stop(self):
+        self.level_meter.unsubscribe(self._follow)
+        with self._lock:
+            self._following = False
+            self.animator.off(self.led_pin)
+
+    def _follow(self, levels):
+        if levels.direction != self.direction:
+            return
+        brightness = min(max(1 - levels.rms_db / self.floor_db, 0.0), 1.0)
+        with self._lock:
+            # Levels dispatched while stopping must not light it again.
+            if self._following:
+                self.animator.set(self.led_pin, int(round(100 * brightness)),
+                                  frequency=self.hertz)
+
+
+_default_animator = None
+_default_animator_lock = threading.Lock()
+
+
+def default_animator():
+    """Returns the LedAnimator shared by the LEDs of the device."""
+    global _default_animator
+    with _default_animator_lock:
+        if _default_animator is None:
+            _default_animator = LedAnimator()
+        return _default_animator
@@ -1,11 +1,145 @@
+from collections import OrderedDict
 from os import path
-import sounddevice as sd
+import logging
+import threading
+import time
+import numpy as np
 import soundfile as sf
 
+from audio_helpers import ResamplingStream, resample
+
+DEFAULT_PROMPT_CACHE_SIZE = 8 * 1024 * 1024
+
+
+class PromptCache(object):
+    """Size bounded LRU cache of decoded prompts.
+
+    Each prompt is decoded and converted once per sample rate to mono
+    16-bit PCM, ready to be written to an audio sink.
+
+    Args:
+      max_bytes: total size of the cached PCM data before the least
+        recently used prompts are evicted.
+    """
+    def __init__(self, max_bytes=DEFAULT_PROMPT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, file_path, sample_rate):
+        """Returns the PCM bytes of file_path at sample_rate."""
+        key = (file_path, sample_rate)
+        with self._lock:
+            pcm = self._entries.get(key)
+            if pcm is not None:
+                self._entries.move_to_end(key)
+                return pcm
+        pcm = decode_to_pcm(file_path, sample_rate)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = pcm
+                self._size += len(pcm)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+        return pcm
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def size(self):
+        """Size in bytes of the cached PCM data."""
+        return self._size
+
+
+def decode_to_pcm(file_path, sample_rate):
+    """Returns a sound file as mono 16-bit PCM bytes at the given sample rate.
+
+    Args:
+      file_path: path of the sound file.
+      sample_rate: sample rate in hertz of the audio sink.
+    """
+    data, fs = sf.read(file=file_path, dtype='float32', always_2d=True)
+    mono = resample(data.mean(axis=1), fs, sample_rate)
+    return (np.clip(mono, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+
+def default_output_sample_rate():
+    """Sample rate in hertz of the default output device."""
+    # Imported here, a sink given to play() does without PortAudio.
+    import sounddevice as sd
+    return int(sd.query_devices(kind='output')['default_samplerate'])
+
+
+prompt_cache = PromptCache()
+
+
+class PromptPlayback(object):
+    """Handle of a prompt being played.
+
+    Args:
+      end_time: estimated time.monotonic() at which the prompt has played.
+      wait: callable blocking until the prompt has been handed to the device.
+    """
+    def __init__(self, end_time, wait=None):
+        self.end_time = end_time
+        self._wait = wait
+
+    @classmethod
+    def finished(cls):
+        return cls(time.monotonic())
+
+    @classmethod
+    def to_sink(cls, sink, pcm, sample_rate, write=None):
+        """Writes pcm to an audio sink from a background thread.
+
+        Args:
+          write: callable writing pcm to the started sink, sink.write by
+            default.
+        """
+        write = write or sink.write
+
+        def play():
+            sink.start()
+            write(pcm)
+        writer = threading.Thread(target=play, name='prompt-playback',
+                                  daemon=True)
+        playback = cls(time.monotonic() + duration_of(pcm, sample_rate),
+                       writer.join)
+        writer.start()
+        return playback
+
+    @classmethod
+    def to_default_device(cls, pcm, sample_rate):
+        """Plays pcm on the default output device."""
+        # Imported here, a sink given to play() does without PortAudio.
+        import sounddevice as sd
+
+        def wait():
+            status = sd.wait()
+            if status:
+                print("error %s" % status)
+        sd.play(np.frombuffer(pcm, dtype='<i2'), samplerate=sample_rate)
+        return cls(time.monotonic() + duration_of(pcm, sample_rate), wait)
+
+    def wait(self):
+        if self._wait is not None:
+            self._wait()
+
+
+def duration_of(pcm, sample_rate):
+    """Duration in seconds of mono 16-bit PCM bytes."""
+    return len(pcm) / 2.0 / sample_rate
+
 
 class PlayableFile(object):
-    def __init__(self, file_path, silent_fail=False):
+    def __init__(self, file_path, silent_fail=False, cache=None):
         self.silent_fail = silent_fail
+        self.cache = cache if cache is not None else prompt_cache
         if file_path is None:
             raise AttributeError('missing a file to play')
 
@@ -21,14 +155,70 @@ class PlayableFile(object):
     def exists(self):
         return path.exists(self._filepath)
 
-    def play(self):
-        self.__check_for_file()
-        print("Playing %s" % self._filepath)
-        data, fs = sf.read(file=self._filepath, dtype='float32')
-        sd.play(data, samplerate=44100)
-        status = sd.wait()
-        if status:
-            print("error %s" % status)
+    def preload(self, sample_rate=None):
+        """Decodes the file into the prompt cache ahead of play().
+
+        Args:
+          sample_rate: sample rate in hertz of the sink the file will be
+            played on, the device rate of a ResamplingStream. Defaults to
+            the default output device rate.
+        """
+        self.pcm_for(sample_rate or default_output_sample_rate())
+
+    def play(self, sink=None, blocking=True):
+        """Plays the file.
+
+        Args:
+          sink: optional opened audio sink (e.g. SoundDeviceStream) to write
+            the sound to. Needed when the sound device is held open by a
+            conversation stream. Without it the default device is used.
+          blocking: wait until the sound has played. Otherwise playback
+            runs in the background and the sink is left started, so the
+            caller can record from it while the sound plays.
+
+        Returns: PromptPlayback tracking the playback.
+        """
+        write = None
+        if sink is None:
+            sample_rate = default_output_sample_rate()
+        elif isinstance(sink, ResamplingStream):
+            # Decoded once at the rate of the hardware, the prompt skips
+            # the resampler instead of going through it on every play.
+            sample_rate = sink.device_sample_rate
+            write = sink.write_native
+        else:
+            sample_rate = sink.sample_rate
+        pcm = self.pcm_for(sample_rate)
+        if pcm is None:
+            return PromptPlayback.finished()
+        logging.info("Playing %s" % self._filepath)
+        if sink is not None:
+            playback = PromptPlayback.to_sink(sink, pcm, sample_rate, write)
+            if blocking:
+                playback.wait()
+                # Stopping waits for the sound to play out, no need to flush.
+                sink.stop(flush=False)
+            return playback
+        playback = PromptPlayback.to_default_device(pcm, sample_rate)
+        if blocking:
+            playback.wait()
+        return playback
+
+    def pcm_for(self, sample_rate):
+        """Returns the file as mono 16-bit PCM bytes at the given sample rate.
+
+        Returns None if the file cannot be read and silent_fail is set.
+
+        Args:
+          sample_rate: sample rate in hertz of the audio sink.
+        """
+        try:
+            return self.cache.get(self._filepath, sample_rate)
+        except (IOError, RuntimeError) as e:
+            if not self.silent_fail:
+                raise
+            logging.warning('Cannot play %s: %s', self._filepath, e)
+            return None
 
     def __check_for_file(self):
         if not self.exists() and not self.silent_fail:
@@ -1,9 +1,12 @@
-import RPi.GPIO as GPIO
-from time import sleep
+import queue
+import threading
+from time import sleep, monotonic
 from enum import Enum
 import logging
 
 DEFAULT_SLEEP_TIME = 0.05
+DEFAULT_DEBOUNCE_TIME = 0.02
+DEFAULT_LONG_PRESS_TIME = 1.5
 
 
 class PushButtonType(Enum):
@@ -15,6 +18,65 @@ class PushButtonType(Enum):
                (self == PushButtonType.NO and not gpio_high)
 
 
+class PushButtonEvent(Enum):
+    PRESS = 1
+    RELEASE = 2
+    LONG_PRESS = 3
+
+
+class RPiGpioBackend(object):
+    """GPIO backend using the Raspberry Pi pins through RPi.GPIO."""
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+
+    def setup_input(self, pin, verbose=False):
+        self._gpio.setmode(self._gpio.BCM)
+        self._gpio.setwarnings(verbose)
+        self._gpio.setup(pin, self._gpio.IN)
+
+    def input(self, pin):
+        return self._gpio.input(pin)
+
+    def add_edge_callback(self, pin, callback):
+        """Calls callback(pin) from a GPIO thread on rising and falling edges."""
+        self._gpio.add_event_detect(pin, self._gpio.BOTH, callback=callback)
+
+    def remove_edge_callback(self, pin):
+        self._gpio.remove_event_detect(pin)
+
+
+class FakeGpioBackend(object):
+    """In-memory GPIO backend, to drive a PushButton on any Linux box."""
+
+    def __init__(self, levels=None):
+        self._levels = dict(levels or {})
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def setup_input(self, pin, verbose=False):
+        self._levels.setdefault(pin, 0)
+
+    def input(self, pin):
+        return self._levels.get(pin, 0)
+
+    def add_edge_callback(self, pin, callback):
+        self._callbacks[pin] = callback
+
+    def remove_edge_callback(self, pin):
+        self._callbacks.pop(pin, None)
+
+    def set_input(self, pin, high):
+        """Sets the level of a pin, firing its edge callback on change."""
+        with self._lock:
+            changed = self._levels.get(pin, 0) != high
+            self._levels[pin] = high
+        callback = self._callbacks.get(pin)
+        if changed and callback is not None:
+            callback(pin)
+
+
 class PushButton(object):
     DEFAULT_GPIO_PIN = 14
 
@@ -23,35 +85,168 @@ class PushButton(object):
             pin=DEFAULT_GPIO_PIN,
             button_type=PushButtonType.NC,
             sleep_time=DEFAULT_SLEEP_TIME,
-            verbose=False
+            verbose=False,
+            edge_detection=True,
+            debounce_time=DEFAULT_DEBOUNCE_TIME,
+            long_press_time=DEFAULT_LONG_PRESS_TIME,
+            gpio=None
     ):
+        """Button on a GPIO pin, triggering once per push.
+
+        Args:
+          pin: GPIO.BCM number of the pin the button is wired to.
+          button_type: PushButtonType wiring of the button.
+          sleep_time: polling interval in seconds, without edge detection.
+          verbose: enable GPIO warnings and debug logging.
+          edge_detection: wait for edge interrupts instead of polling.
+          debounce_time: seconds after a state change during which the
+            contacts are left to settle.
+          long_press_time: seconds the button is held before a long press
+            is reported, None disables long presses.
+          gpio: GPIO backend, defaults to RPiGpioBackend.
+        """
         self.sleep_time = sleep_time
         self.button_gpio_pin = pin
         self.button_type = button_type
         self.gpio_inited = False
         self.verbose = verbose
+        self.edge_detection = edge_detection
+        self.debounce_time = debounce_time
+        self.long_press_time = long_press_time
+        self.gpio = gpio
+        self._edges = queue.Queue()
+        self._stopped = threading.Event()
         logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
 
-    def wait_for_push(self, do_on_push, **kwargs):
+    def wait_for_push(self, do_on_push, on_release=None, on_long_press=None,
+                      **kwargs):
+        """Calls do_on_push(**kwargs) once per push, until stop() is called.
+
+        on_release() and on_long_press() are called when the button is
+        released and held for long_press_time. The callbacks run on the
+        calling thread, pushes made while one of them runs are ignored.
+        """
+        for event in self.events():
+            if event == PushButtonEvent.PRESS:
+                self.__trigger(event, do_on_push, **kwargs)
+            elif event == PushButtonEvent.RELEASE:
+                self.__trigger(event, on_release)
+            else:
+                self.__trigger(event, on_long_press)
+
+    def events(self):
+        """Yields PushButtonEvents until stop() is called."""
         if not self.gpio_inited:
             self.init_gpio()
+        self._stopped.clear()
 
-        while True:
-            gpio_is_high = GPIO.input(self.button_gpio_pin)
+        if self.edge_detection:
+            return self.__edge_events()
+        return self.__polled_events()
 
-            if self.button_type.is_triggered(gpio_is_high):
-                self.__trigger(do_on_push, **kwargs)
+    def stop(self):
+        """Makes wait_for_push() and events() return."""
+        self._stopped.set()
+        self._edges.put(None)
 
+    def is_pressed(self):
+        return self.button_type.is_triggered(
+            self.gpio.input(self.button_gpio_pin))
+
+    def __polled_events(self):
+        pressed = self.is_pressed()
+        pressed_at = monotonic()
+        long_press_reported = False
+        while not self._stopped.is_set():
             sleep(self.sleep_time)
+            now = monotonic()
+            if self.is_pressed() != pressed:
+                pressed = not pressed
+                pressed_at = now
+                long_press_reported = False
+                yield PushButtonEvent.PRESS if pressed \
+                    else PushButtonEvent.RELEASE
+            elif self.__is_long_press(pressed, pressed_at, now) \
+                    and not long_press_reported:
+                long_press_reported = True
+                yield PushButtonEvent.LONG_PRESS
+
+    def __edge_events(self):
+        self.gpio.add_edge_callback(self.button_gpio_pin, self.__on_edge)
+        try:
+            pressed = self.is_pressed()
+            pressed_at = monotonic()
+            long_press_reported = False
+            # State changes are reported on the leading edge, the contacts
+            # are then left to settle before the level is read again.
+            settled_at = 0
+            recheck = False
+            while not self._stopped.is_set():
+                deadlines = []
+                if recheck:
+                    deadlines.append(settled_at)
+                if pressed and self.long_press_time is not None \
+                        and not long_press_reported:
+                    deadlines.append(pressed_at + self.long_press_time)
+                timeout = None
+                if deadlines:
+                    timeout = max(0, min(deadlines) - monotonic())
+                try:
+                    self._edges.get(timeout=timeout)
+                except queue.Empty:
+                    pass
+                if self._stopped.is_set():
+                    return
+
+                now = monotonic()
+                if now < settled_at:
+                    recheck = True
+                    continue
+                recheck = False
+                if self.is_pressed() != pressed:
+                    pressed = not pressed
+                    pressed_at = now
+                    long_press_reported = False
+                    settled_at = now + self.debounce_time
+                    recheck = True
+                    yield PushButtonEvent.PRESS if pressed \
+                        else PushButtonEvent.RELEASE
+                    # Forget the edges seen while the event was handled.
+                    self.__drain_edges()
+                elif self.__is_long_press(pressed, pressed_at, now) \
+                        and not long_press_reported:
+                    long_press_reported = True
+                    yield PushButtonEvent.LONG_PRESS
+                    self.__drain_edges()
+                    recheck = True
+        finally:
+            self.gpio.remove_edge_callback(self.button_gpio_pin)
+
+    def __is_long_press(self, pressed, pressed_at, now):
+        return (pressed and self.long_press_time is not None
+                and now - pressed_at >= self.long_press_time)
+
+    def __on_edge(self, pin):
+        self._edges.put_nowait(pin)
+
+    def __drain_edges(self):
+        try:
+            while True:
+                if self._edges.get_nowait() is None:
+                    # Keep the stop() wake-up.
+                    self._edges.put_nowait(None)
+                    return
+        except queue.Empty:
+            pass
 
-    def __trigger(self, do_on_push, **kwargs):
-        if do_on_push is not None:
-            logging.debug('Push button at %s activated' % self.button_gpio_pin)
-            do_on_push(**kwargs)
+    def __trigger(self, event, handler, **kwargs):
+        if handler is not None:
+            logging.debug('Push button at %s: %s' % (self.button_gpio_pin, event.name))
+            handler(**kwargs)
 
     def init_gpio(self):
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(self.verbose)
-        GPIO.setup(self.button_gpio_pin, GPIO.IN)
+        if self.gpio is None:
+            self.gpio = RPiGpioBackend()
+        self.gpio.setup_input(self.button_gpio_pin, self.verbose)
         self.gpio_inited = True
         return
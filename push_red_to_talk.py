@@ -14,22 +14,24 @@
 
 """Sample that implements gRPC client for Google Assistant API."""
 
-import json
+import itertools
 import logging
 import os.path
+import signal
+import sys
+import time
 
 import click
 
 import grpc
-import google.auth.transport.grpc
-import google.auth.transport.requests
-import google.oauth2.credentials
 
 from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
 from google.rpc import code_pb2
 from tenacity import retry, stop_after_attempt, retry_if_exception
 
 from breathing_led import BreathingLed
+from led_animator import LevelLed
+import push_button
 from push_button import PushButton
 from push_button import PushButtonType
 from boot_sound import BootSound
@@ -38,20 +40,33 @@ from playable_file import PlayableFile
 try:
     from . import (
         assistant_helpers,
-        audio_helpers
+        audio_codecs,
+        audio_helpers,
+        audio_pipeline,
+        boot_sequence,
+        channel_helpers,
+        turn_tracing
     )
-except SystemError:
+except (SystemError, ImportError):
     import assistant_helpers
+    import audio_codecs
     import audio_helpers
+    import audio_pipeline
+    import boot_sequence
+    import channel_helpers
+    import turn_tracing
 
 ASSISTANT_API_ENDPOINT = 'embeddedassistant.googleapis.com'
 END_OF_UTTERANCE = embedded_assistant_pb2.ConverseResponse.END_OF_UTTERANCE
 DIALOG_FOLLOW_ON = embedded_assistant_pb2.ConverseResult.DIALOG_FOLLOW_ON
 CLOSE_MICROPHONE = embedded_assistant_pb2.ConverseResult.CLOSE_MICROPHONE
 DEFAULT_GRPC_DEADLINE = 60 * 3 + 5
+# Seconds the boot waits for the channel to connect before arming the
+# button anyway, the first call then waits for the connection.
+DEFAULT_CHANNEL_CONNECT_TIMEOUT = 10
 
 PUSH_TO_TALK_BUTTON_PIN = 14
-PUSH_TO_TALK_BUTTON_SLEEP = 0.05
+PUSH_TO_TALK_BUTTON_SLEEP = push_button.DEFAULT_SLEEP_TIME
 
 RED_BREATHING_LED_PIN = 18
 red_breathing_led = BreathingLed(RED_BREATHING_LED_PIN)
@@ -67,10 +82,32 @@ class SampleAssistant(object):
       channel: authorized gRPC channel for connection to the
         Google Assistant API.
       deadline_sec: gRPC deadline in seconds for Google Assistant API call.
+      channel_monitor(ChannelMonitor): optional connectivity tracker of the
+        channel, used to fail fast while the channel is known to be down.
+      tracer(TurnTracer): optional collector of the timing of each turn.
+      led(BreathingLed): LED breathing while recording, defaults to the
+        red LED.
+      audio_in_encoding: encoding of the request audio, LINEAR16 or FLAC.
+      audio_out_encoding: encoding of the answer audio, LINEAR16 or
+        OPUS_IN_OGG.
+      recorder(SessionRecorder): optional recorder of the requests and
+        responses of each call.
     """
 
-    def __init__(self, conversation_stream, channel, deadline_sec):
+    def __init__(self, conversation_stream, channel, deadline_sec,
+                 channel_monitor=None, tracer=None, led=None,
+                 audio_in_encoding=audio_codecs.AUDIO_IN_LINEAR16,
+                 audio_out_encoding=audio_codecs.AUDIO_OUT_LINEAR16,
+                 recorder=None):
         self.conversation_stream = conversation_stream
+        # Audio is written to the device after the stream has queued it.
+        self.conversation_stream.on_written = self.audio_written
+        self.recorder = recorder
+        self.audio_in_encoding = audio_in_encoding
+        self.audio_out_encoding = audio_out_encoding
+        self.channel_monitor = channel_monitor
+        self.led = led if led is not None else red_breathing_led
+        self.tracer = tracer if tracer is not None else turn_tracing.TurnTracer()
 
         # Opaque blob provided in ConverseResponse that,
         # when provided in a follow-up ConverseRequest,
@@ -88,9 +125,10 @@ class SampleAssistant(object):
         return self
 
     def __exit__(self, etype, e, traceback):
+        # Also on errors, to stop the playback worker of a shared device.
+        self.conversation_stream.close()
         if e:
             return False
-        self.conversation_stream.close()
 
     def is_grpc_error_unavailable(e):
         is_grpc_error = isinstance(e, grpc.RpcError)
@@ -108,49 +146,108 @@ class SampleAssistant(object):
         """
         continue_conversation = False
 
+        # Retrying a call on a channel known to be down only burns time.
+        if self.channel_monitor and self.channel_monitor.is_down():
+            raise channel_helpers.ChannelUnavailableError(
+                'gRPC channel is %s' % self.channel_monitor.state)
+
+        # Follow-on turns are traced from here, the first one from the push.
+        if self.tracer.current is None:
+            self.tracer.start_turn()
+        xruns_before = sum(self.conversation_stream.xruns.values())
+
         self.conversation_stream.start_recording()
-        red_breathing_led.start_breathing()
+        self.led.start_breathing()
         logging.info('Recording audio request.')
 
         def iter_converse_requests():
             for c in self.gen_converse_requests():
                 assistant_helpers.log_converse_request_without_audio(c)
+                if self.recorder is not None:
+                    self.recorder.record_request(call, c)
+                self.tracer.mark(turn_tracing.FIRST_REQUEST_SENT)
+                if c.audio_in:
+                    self.tracer.count(turn_tracing.BYTES_SENT, len(c.audio_in))
                 yield c
 
             self.conversation_stream.start_playback()
 
-        # This generator yields ConverseResponse proto messages
-        # received from the gRPC Google Assistant API.
-        for resp in self.assistant.Converse(iter_converse_requests(), self.deadline):
-            assistant_helpers.log_converse_response_without_audio(resp)
-            if resp.error.code != code_pb2.OK:
-                logging.error('server error: %s', resp.error.message)
-                break
-            if resp.event_type == END_OF_UTTERANCE:
-                logging.info('End of audio request detected')
-                self.conversation_stream.stop_recording()
-                red_breathing_led.stop()
-            if resp.result.spoken_request_text:
-                self.print_spoken_request(resp)
-            if len(resp.audio_out.audio_data) > 0:
-                self.conversation_stream.write(resp.audio_out.audio_data)
-            if resp.result.spoken_response_text:
-                self.print_response(resp)
-            if resp.result.conversation_state:
-                self.conversation_state = resp.result.conversation_state
-            if resp.result.volume_percentage != 0:
-                self.conversation_stream.volume_percentage = (
-                    resp.result.volume_percentage
-                )
-            if resp.result.microphone_mode == DIALOG_FOLLOW_ON:
-                continue_conversation = True
-                logging.info('Expecting follow-on query from user.')
-            elif resp.result.microphone_mode == CLOSE_MICROPHONE:
-                continue_conversation = False
+        # Compressed answers are decoded as they arrive.
+        decoder = None
+        if self.audio_out_encoding != audio_codecs.AUDIO_OUT_LINEAR16:
+            decoder = audio_codecs.StreamDecoder(
+                self.play_audio, self.conversation_stream.sample_rate)
+        call = None
+        if self.recorder is not None:
+            call = self.recorder.start_call()
+        error = None
+        try:
+            # This generator yields ConverseResponse proto messages
+            # received from the gRPC Google Assistant API.
+            for resp in self.assistant.Converse(iter_converse_requests(), self.deadline):
+                assistant_helpers.log_converse_response_without_audio(resp)
+                if self.recorder is not None:
+                    self.recorder.record_response(call, resp)
+                if resp.error.code != code_pb2.OK:
+                    logging.error('server error: %s', resp.error.message)
+                    break
+                if resp.event_type == END_OF_UTTERANCE:
+                    logging.info('End of audio request detected')
+                    self.tracer.mark(turn_tracing.END_OF_UTTERANCE)
+                    self.conversation_stream.stop_recording()
+                    self.led.stop()
+                if resp.result.spoken_request_text:
+                    self.print_spoken_request(resp)
+                if len(resp.audio_out.audio_data) > 0:
+                    self.tracer.mark(turn_tracing.FIRST_AUDIO_OUT)
+                    self.tracer.count(turn_tracing.BYTES_RECEIVED,
+                                      len(resp.audio_out.audio_data))
+                    if decoder is not None:
+                        decoder.feed(resp.audio_out.audio_data)
+                    else:
+                        self.play_audio(resp.audio_out.audio_data)
+                if resp.result.spoken_response_text:
+                    self.print_response(resp)
+                if resp.result.conversation_state:
+                    self.conversation_state = resp.result.conversation_state
+                if resp.result.volume_percentage != 0:
+                    self.conversation_stream.volume_percentage = (
+                        resp.result.volume_percentage
+                    )
+                if resp.result.microphone_mode == DIALOG_FOLLOW_ON:
+                    continue_conversation = True
+                    logging.info('Expecting follow-on query from user.')
+                elif resp.result.microphone_mode == CLOSE_MICROPHONE:
+                    continue_conversation = False
+        except grpc.RpcError as e:
+            error = str(e.code())
+            raise
+        finally:
+            if decoder is not None:
+                if error is not None:
+                    # The answer will not play, release the decoder thread
+                    # if it waits for playback to start.
+                    self.conversation_stream.stop_playback(abort=True)
+                decoder.close()
+            if self.recorder is not None:
+                self.recorder.end_call(call, error)
         logging.info('Finished playing assistant response.')
         self.conversation_stream.stop_playback()
+        self.tracer.mark(turn_tracing.STOP_PLAYBACK)
+        self.tracer.count(turn_tracing.XRUNS,
+                          sum(self.conversation_stream.xruns.values()) - xruns_before)
+        self.tracer.finish_turn()
         return continue_conversation
 
+    def play_audio(self, data):
+        """Writes PCM audio of the answer to the conversation stream."""
+        self.conversation_stream.write(data)
+
+    def audio_written(self):
+        """Marks audio of the answer written to the sound device."""
+        self.tracer.mark(turn_tracing.FIRST_AUDIO_WRITTEN)
+        self.tracer.mark(turn_tracing.LAST_AUDIO_WRITTEN, overwrite=True)
+
     @staticmethod
     def print_spoken_request(resp):
         logging.info('Transcript of user request: "%s".', resp.result.spoken_request_text)
@@ -172,11 +269,11 @@ class SampleAssistant(object):
             )
         config = embedded_assistant_pb2.ConverseConfig(
             audio_in_config=embedded_assistant_pb2.AudioInConfig(
-                encoding='LINEAR16',
+                encoding=self.audio_in_encoding,
                 sample_rate_hertz=self.conversation_stream.sample_rate,
             ),
             audio_out_config=embedded_assistant_pb2.AudioOutConfig(
-                encoding='LINEAR16',
+                encoding=self.audio_out_encoding,
                 sample_rate_hertz=self.conversation_stream.sample_rate,
                 volume_percentage=self.conversation_stream.volume_percentage,
             ),
@@ -185,9 +282,16 @@ class SampleAssistant(object):
         # The first ConverseRequest must contain the ConverseConfig
         # and no audio data.
         yield embedded_assistant_pb2.ConverseRequest(config=config)
-        for data in self.conversation_stream:
-            # Subsequent requests need audio data, but not config.
-            yield embedded_assistant_pb2.ConverseRequest(audio_in=data)
+        # Speech captured before the push comes first.
+        audio_in = itertools.chain(self.conversation_stream.iter_preroll(),
+                                   self.conversation_stream)
+        if self.audio_in_encoding == audio_codecs.AUDIO_IN_FLAC:
+            audio_in = audio_codecs.FlacEncoder(
+                self.conversation_stream.sample_rate).iter_encoded(audio_in)
+        for data in audio_in:
+            # Subsequent requests need audio data, but not config. The
+            # field takes bytes, sources may return views.
+            yield embedded_assistant_pb2.ConverseRequest(audio_in=bytes(data))
 
 
 @click.command()
@@ -204,6 +308,12 @@ class SampleAssistant(object):
 @click.option('--button-normally-open', '-bno',
               metavar='<button normally open>', default=False, show_default=True, is_flag=True,
               help='Circuit specific ')
+@click.option('--button-polling', '-bp',
+              is_flag=True, default=False,
+              help='Poll the button GPIO instead of waiting for edge interrupts.')
+@click.option('--button-debounce-time', '-bdt',
+              metavar='<button debounce time>', default=push_button.DEFAULT_DEBOUNCE_TIME, show_default=True,
+              help='Seconds the button contacts are left to settle after a push or release')
 @click.option('--verbose', '-v',
               is_flag=True, default=False,
               help='Verbose logging.')
@@ -219,115 +329,469 @@ class SampleAssistant(object):
 @click.option('--conversation-bleep-end', '-cbe',
               metavar='<conversation bleep end>', default=None,
               help='Sound to play when device has finished the conversation')
+@click.option('--bleep-overlap', '-bo',
+              type=click.Choice(audio_helpers.PROMPT_OVERLAP_MODES),
+              default=audio_helpers.PROMPT_OVERLAP_DROP, show_default=True,
+              help='What to do with audio recorded while the start bleep plays')
+@click.option('--preroll-ms', '-pr',
+              metavar='<preroll ms>', default=0, show_default=True,
+              help='Keep the microphone on and send this many milliseconds of audio '
+                   'captured before the push (0 disables it)')
+@click.option('--audio-callback-mode', '-acm',
+              is_flag=True, default=False,
+              help='Run the sound device in callback mode backed by ring buffers')
+@click.option('--playback-buffer-ms', '-pbm',
+              metavar='<playback buffer ms>', default=audio_helpers.DEFAULT_PLAYBACK_BUFFER_MS,
+              show_default=True,
+              help='Audio buffered before the answer starts playing, grows on underruns '
+                   '(0 plays from the network loop directly)')
+@click.option('--audio-in-encoding', '-aie',
+              type=click.Choice(audio_codecs.AUDIO_IN_ENCODINGS),
+              default=audio_codecs.AUDIO_IN_LINEAR16, show_default=True,
+              help='Encoding of the audio sent to the Assistant, FLAC sends about half the bytes')
+@click.option('--audio-out-encoding', '-aoe',
+              type=click.Choice(audio_codecs.AUDIO_OUT_ENCODINGS),
+              default=audio_codecs.AUDIO_OUT_LINEAR16, show_default=True,
+              help='Encoding of the answers, OPUS_IN_OGG is decoded as it arrives')
+@click.option('--vad', is_flag=True, default=False,
+              help='Trim leading silence and stop streaming at the local end of speech')
+@click.option('--vad-energy-threshold',
+              metavar='<vad energy threshold>', show_default=True,
+              default=audio_helpers.DEFAULT_VAD_ENERGY_THRESHOLD_DB,
+              help='Minimum speech level in dBFS')
+@click.option('--vad-endpoint-ms',
+              metavar='<vad endpoint ms>', show_default=True,
+              default=audio_helpers.DEFAULT_VAD_ENDPOINT_MS,
+              help='Milliseconds of silence after speech that end the request')
+@click.option('--connection-error-sound', '-ces',
+              metavar='<connection error sound>', default=None,
+              help='Sound to play when the Assistant API cannot be reached')
+@click.option('--grpc-keepalive-time',
+              metavar='<grpc keepalive time>', show_default=True,
+              default=channel_helpers.DEFAULT_KEEPALIVE_TIME_MS,
+              help='Interval in milliseconds between keepalive pings on the idle channel')
+@click.option('--trace-jsonl',
+              metavar='<trace jsonl>', default=None,
+              help='File the timing spans of each conversation turn are appended to as JSON lines')
+@click.option('--trace-prometheus',
+              metavar='<trace prometheus>', default=None,
+              help='Prometheus text file the p50/p95 of the turn timing spans are written to')
+@click.option('--token-uri',
+              metavar='<token uri>', default=None,
+              help='OAuth 2.0 token endpoint overriding the one in the credentials, e.g. a local stand-in')
+@click.option('--record-session',
+              metavar='<record session>', default=None,
+              help='Directory the requests and responses of each call are recorded to, '
+                   'replay them with python -m session_recording replay')
+@click.option('--level-meter-rate',
+              metavar='<level meter rate>', show_default=True,
+              default=audio_helpers.DEFAULT_LEVEL_METER_RATE_HZ,
+              help='Audio levels published per second for the LED and the logs, 0 disables metering')
+@click.option('--level-led', is_flag=True, default=False,
+              help='Make the red LED follow the microphone level instead of breathing')
+@click.option('--capture-dsp',
+              metavar='<capture dsp>', show_default=True,
+              default=audio_pipeline.DEFAULT_CAPTURE_STAGES,
+              help='Comma separated processing stages of the microphone audio, from %s, '
+                   'e.g. dc,highpass,limiter' % ', '.join(audio_pipeline.STAGES))
+@click.option('--playback-dsp',
+              metavar='<playback dsp>', show_default=True,
+              default=audio_pipeline.DEFAULT_PLAYBACK_STAGES,
+              help='Comma separated processing stages of the answers, gain applies the Assistant volume')
+@click.option('--highpass-hz',
+              metavar='<highpass hz>', show_default=True,
+              default=audio_pipeline.DEFAULT_HIGHPASS_HZ,
+              help='Cutoff frequency of the highpass stage, which needs scipy')
+@click.option('--device-sample-rate', type=int,
+              metavar='<device sample rate>', default=None,
+              help='Run the sound device at this rate, e.g. 48000, 0 for its default rate. '
+                   'The audio is resampled to %d Hz for the Assistant. '
+                   'By default the device is opened at %d Hz and ALSA converts'
+                   % (audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE, audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE))
+@click.option('--asyncio', 'use_asyncio', is_flag=True, default=False,
+              help='Run the button, the LEDs and the conversations on one asyncio event loop, '
+                   'talking to the Assistant API with grpc.aio. A push during a conversation '
+                   'cancels it')
 def main(
         push_gpio_pin,
         button_normally_open,
+        button_polling,
+        button_debounce_time,
         verbose,
         no_boot_sound,
         boot_sound,
         conversation_bleep_start,
         conversation_bleep_end,
+        bleep_overlap,
+        preroll_ms,
+        audio_callback_mode,
+        playback_buffer_ms,
+        audio_in_encoding,
+        audio_out_encoding,
+        vad,
+        vad_energy_threshold,
+        vad_endpoint_ms,
+        connection_error_sound,
+        grpc_keepalive_time,
+        trace_jsonl,
+        trace_prometheus,
+        token_uri,
+        record_session,
+        level_meter_rate,
+        level_led,
+        capture_dsp,
+        playback_dsp,
+        highpass_hz,
+        device_sample_rate,
+        use_asyncio,
         *args, **kwargs
 ):
     # Setup logging.
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
 
-    # Button setup
-    trigger_conversation_button = PushButton(
+    pipelines = {}
+    for direction, spec, option in ((audio_helpers.LEVELS_CAPTURE, capture_dsp, '--capture-dsp'),
+                                    (audio_helpers.LEVELS_PLAYBACK, playback_dsp, '--playback-dsp')):
+        try:
+            pipelines[direction] = audio_pipeline.create_pipeline(
+                spec,
+                sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+                sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+                highpass_hz=highpass_hz
+            )
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint=option)
+    # Raw microphone audio is read without going through a pipeline.
+    if not pipelines[audio_helpers.LEVELS_CAPTURE].stages:
+        del pipelines[audio_helpers.LEVELS_CAPTURE]
+
+    # The boot phases run concurrently, the button is armed as soon as a
+    # push can hold a conversation. The boot sound may still be playing.
+    boot = boot_sequence.BootSequence()
+    audio_device_manager = create_audio_device_manager(preroll_ms, audio_callback_mode, device_sample_rate)
+    credentials_path = os.path.join(click.get_app_dir('google-oauthlib-tool'), 'credentials.json')
+    prompt_files = (conversation_bleep_start, conversation_bleep_end, connection_error_sound)
+    tracer = turn_tracing.TurnTracer(trace_jsonl, trace_prometheus)
+
+    boot.add('button', lambda: PushButton(
         push_gpio_pin,
         button_type=PushButtonType.NO if button_normally_open else PushButtonType.NC,
-        verbose=verbose
-    )
-
-    # play on boot
+        verbose=verbose,
+        edge_detection=not button_polling,
+        debounce_time=button_debounce_time
+    ))
+    # Keep the sound device open across button presses. Errors are logged
+    # and the device is opened again on the next push.
+    boot.add('audio_device', audio_device_manager.open)
     if no_boot_sound:
         logging.info('Not playing a boot sound')
+        boot_sound_played = None
     else:
-        BootSound(boot_sound).play()
+        # Played through the opened device, which the conversations share.
+        boot_sound_played = boot.add(
+            'boot_sound', lambda: BootSound(boot_sound).play(sink=audio_device_manager.device()),
+            after=('audio_device',), required=False).done
+    # Decode the prompts now, to keep file I/O off the push path, at the
+    # rate of the hardware they are played at.
+    boot.add('prompts', lambda: preload_prompts(prompt_files, audio_device_manager.output_sample_rate),
+             after=('audio_device',))
+    boot.add('credentials', lambda: load_credentials(credentials_path, token_uri, tracer))
+    # A token still valid in the cache is used as is, otherwise it is
+    # fetched while the channel connects.
+    boot.add('token', lambda: start_token_refresh(boot.result('credentials')),
+             after=('credentials',))
+    if not use_asyncio:
+        # The grpc.aio channel is connected on the event loop instead.
+        boot.add('channel', lambda: connect_channel(boot.result('credentials'), grpc_keepalive_time),
+                 after=('credentials',))
+    boot.start()
+
+    voice_activity_detector = None
+    if vad:
+        voice_activity_detector = audio_helpers.VoiceActivityDetector(
+            sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+            sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+            energy_threshold_db=vad_energy_threshold,
+            endpoint_ms=vad_endpoint_ms
+        )
+    recorder = None
+    if record_session:
+        # Imported here, only needed to record.
+        try:
+            from . import session_recording
+        except (SystemError, ImportError):
+            import session_recording
+        recorder = session_recording.SessionRecorder(record_session)
+    level_meter = None
+    led = None
+    if level_meter_rate > 0:
+        level_meter = audio_helpers.LevelMeter(
+            sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+            sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+            rate_hz=level_meter_rate
+        )
+        if level_led:
+            led = LevelLed(RED_BREATHING_LED_PIN, level_meter)
+    elif level_led:
+        logging.warning('--level-led needs --level-meter-rate above 0, the LED breathes')
+
+    try:
+        boot.wait_ready()
+    except boot_sequence.BootError as e:
+        logging.error('Device not ready: %s', e)
+        return
+    conversation_start_bleep, conversation_end_bleep, connection_error_cue = boot.result('prompts')
+    conversation_options = dict(
+        audio_device_manager=audio_device_manager,
+        deadline=DEFAULT_GRPC_DEADLINE,
+        bleep_start=conversation_start_bleep,
+        bleep_end=conversation_end_bleep,
+        bleep_overlap=bleep_overlap,
+        vad=voice_activity_detector,
+        playback_buffer_ms=playback_buffer_ms,
+        audio_in_encoding=audio_in_encoding,
+        audio_out_encoding=audio_out_encoding,
+        connection_error_cue=connection_error_cue,
+        tracer=tracer,
+        recorder=recorder,
+        device_free=boot_sound_played,
+        level_meter=level_meter,
+        led=led,
+        capture_pipeline=pipelines.get(audio_helpers.LEVELS_CAPTURE),
+        playback_pipeline=pipelines[audio_helpers.LEVELS_PLAYBACK]
+    )
+
+    try:
+        if use_asyncio:
+            # Imported here, only needed by the asyncio runtime.
+            try:
+                from . import async_runtime
+            except (SystemError, ImportError):
+                import async_runtime
+            async_runtime.run(async_runtime.serve(
+                async_runtime.AsyncPushButton(boot.result('button')),
+                connect=lambda: async_runtime.connect_channel(boot.result('credentials'),
+                                                              grpc_keepalive_time),
+                **conversation_options
+            ))
+        else:
+            # SIGTERM (systemd stopping the service) unwinds like Ctrl-C,
+            # async_runtime.run() does the same.
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            grpc_channel, channel_monitor = boot.result('channel')
+            boot.result('button').wait_for_push(
+                converse_with_assistant,
+                channel=grpc_channel,
+                channel_monitor=channel_monitor,
+                **conversation_options
+            )
+    finally:
+        # Writes the events still queued and reports the dropped ones.
+        if recorder is not None:
+            recorder.close()
+
 
-    # Load OAuth 2.0 credentials.
-    credentials = os.path.join(click.get_app_dir('google-oauthlib-tool'), 'credentials.json')
+def load_credentials(path, token_uri=None, tracer=None):
+    """Returns a CredentialManager with the credentials loaded from path."""
+    # Imported here, google-auth takes a while to import on a Pi Zero and
+    # this runs concurrently with the other boot phases.
     try:
-        with open(credentials, 'r') as credential_files:
-            credentials = google.oauth2.credentials.Credentials(token=None, **json.load(credential_files))
-            http_request = google.auth.transport.requests.Request()
-            credentials.refresh(http_request)
+        from . import credentials_manager
+    except (SystemError, ImportError):
+        import credentials_manager
+    manager = credentials_manager.CredentialManager(path, token_uri=token_uri, tracer=tracer)
+    try:
+        manager.load()
     except Exception as e:
         print_credentials_error(e)
-        return
+        raise
+    return manager
+
+
+def start_token_refresh(manager):
+    """Fetches an access token unless a cached one is valid, then keeps it fresh."""
+    try:
+        manager.ensure_valid()
+    except Exception as e:
+        print_credentials_error(e)
+        raise
+    manager.start()
 
-    # Create an authorized gRPC channel.
+
+def connect_channel(manager, keepalive_time_ms, timeout=DEFAULT_CHANNEL_CONNECT_TIMEOUT):
+    """Creates a gRPC channel authorized by a CredentialManager and connects it.
+
+    Returns: (channel, ChannelMonitor).
+    """
+    import google.auth.transport.grpc
     grpc_channel = google.auth.transport.grpc.secure_authorized_channel(
-        credentials, http_request,
-        ASSISTANT_API_ENDPOINT
+        manager.credentials, manager.request,
+        ASSISTANT_API_ENDPOINT,
+        options=channel_helpers.keepalive_options(keepalive_time_ms)
     )
+    channel_monitor = channel_helpers.ChannelMonitor(grpc_channel)
+    channel_monitor.start()
     logging.info('Connecting to %s', ASSISTANT_API_ENDPOINT)
+    if not channel_monitor.wait_for_ready(timeout):
+        logging.warning('gRPC channel not ready after %d s, still connecting', timeout)
+    return grpc_channel, channel_monitor
 
-    conversation_start_bleep = playable_file_for(conversation_bleep_start)
-    conversation_end_bleep = playable_file_for(conversation_bleep_end)
 
-    trigger_conversation_button.wait_for_push(
-        converse_with_assistant,
-        create_stream=create_conversation_stream,
-        channel=grpc_channel,
-        deadline=DEFAULT_GRPC_DEADLINE,
-        bleep_start=conversation_start_bleep,
-        bleep_end=conversation_end_bleep
-    )
+def preload_prompts(files, sample_rate):
+    """Returns a PlayableFile (or None) per file, decoded at sample_rate."""
+    prompts = [playable_file_for(file) for file in files]
+    for prompt in prompts:
+        if prompt:
+            prompt.preload(sample_rate)
+    return prompts
 
 
 def playable_file_for(file):
     return PlayableFile(file, silent_fail=True) if file is not None else None
 
 
-def create_conversation_stream():
-    # Configure audio source and sink.
-    audio_device = None
-    audio_source = audio_device = (
-        audio_device or audio_helpers.SoundDeviceStream(
-            sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
-            sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
-            block_size=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
-            flush_size=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE
-        )
-    )
-    audio_sink = (
-        audio_device or audio_helpers.SoundDeviceStream(
-            sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
-            sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
-            block_size=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
-            flush_size=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE
-        )
-    )
-    # Create conversation stream with the given audio source and sink.
-    conversation_stream = audio_helpers.ConversationStream(
-        source=audio_source,
-        sink=audio_sink,
-        iter_size=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+def create_audio_device_manager(preroll_ms=0, callback_mode=False, device_sample_rate=None):
+    return audio_helpers.AudioDeviceManager(
+        sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
         sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+        block_size=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
+        flush_size=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE,
+        iter_size=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+        preroll_ms=preroll_ms,
+        callback_mode=callback_mode,
+        device_sample_rate=device_sample_rate
     )
-    return conversation_stream
 
 
 def converse_with_assistant(
-        create_stream,
+        audio_device_manager,
         channel,
         deadline,
         bleep_start=None,
-        bleep_end=None
+        bleep_end=None,
+        channel_monitor=None,
+        connection_error_cue=None,
+        bleep_overlap=audio_helpers.PROMPT_OVERLAP_DROP,
+        vad=None,
+        playback_buffer_ms=0,
+        audio_in_encoding=audio_codecs.AUDIO_IN_LINEAR16,
+        audio_out_encoding=audio_codecs.AUDIO_OUT_LINEAR16,
+        tracer=None,
+        recorder=None,
+        device_free=None,
+        level_meter=None,
+        led=None,
+        capture_pipeline=None,
+        playback_pipeline=None
 ):
-    if bleep_start:
-        bleep_start.play()
-
-    with SampleAssistant(
-            conversation_stream=create_stream(),
-            channel=channel,
-            deadline_sec=deadline
-    ) as assistant:
-        trigger_assistant(assistant)
-
-    if bleep_end:
-        bleep_end.play()
+    pushed_at = time.monotonic()
+    if device_free is not None:
+        # A push during the boot sound waits for it to end.
+        device_free.wait()
+    tracer = tracer if tracer is not None else turn_tracing.TurnTracer()
+    tracer.start_turn(pushed_at)
+    try:
+        audio_device = audio_device_manager.device()
+        tracer.mark(turn_tracing.DEVICE_OPEN)
+        if channel_monitor and channel_monitor.is_down():
+            raise channel_helpers.ChannelUnavailableError(
+                'gRPC channel is %s' % channel_monitor.state)
+
+        if level_meter is not None:
+            level_meter.reset()
+        conversation_stream = audio_device_manager.conversation_stream(
+            vad=vad, playback_buffer_ms=playback_buffer_ms,
+            level_meter=level_meter, capture_pipeline=capture_pipeline,
+            playback_pipeline=playback_pipeline)
+        if bleep_start:
+            # Start the microphone and the call while the bleep plays.
+            tracer.mark(turn_tracing.BLEEP_START)
+            bleep = bleep_start.play(sink=audio_device, blocking=False)
+            tracer.mark(turn_tracing.BLEEP_END, at=bleep.end_time)
+            conversation_stream.mask_prompt(bleep.end_time, bleep_overlap)
+        with SampleAssistant(
+                conversation_stream=conversation_stream,
+                channel=channel,
+                deadline_sec=deadline,
+                channel_monitor=channel_monitor,
+                tracer=tracer,
+                audio_in_encoding=audio_in_encoding,
+                audio_out_encoding=audio_out_encoding,
+                recorder=recorder,
+                led=led
+        ) as assistant:
+            trigger_assistant(assistant)
+
+        if level_meter is not None:
+            log_audio_levels(level_meter, tracer)
+        log_dsp_timings(conversation_stream, tracer)
+
+        if conversation_stream.first_frame_time is not None:
+            logging.info('First audio frame captured %.1f ms after push',
+                         (conversation_stream.first_frame_time - pushed_at) * 1000)
+        logging.info('Audio xruns so far: %s', audio_device.xruns)
+
+        if bleep_end:
+            bleep_end.play(sink=audio_device)
+    except audio_helpers.AudioDeviceError as e:
+        logging.error('Audio device error: %s, reopening the device', e)
+        tracer.finish_turn(error='audio device error: %s' % e)
+        audio_device_manager.open_in_background()
+    except channel_helpers.ChannelUnavailableError as e:
+        logging.error('Assistant API unreachable: %s', e)
+        tracer.finish_turn(error='channel unavailable: %s' % e)
+        play_connection_error_cue(audio_device_manager, connection_error_cue, led)
+    except grpc.RpcError as e:
+        # Unavailable errors have been retried by SampleAssistant.converse().
+        logging.error('Assistant API call failed: %s', e)
+        tracer.finish_turn(error='rpc error: %s' % e.code().name)
+        play_connection_error_cue(audio_device_manager, connection_error_cue, led)
+
+
+def play_connection_error_cue(audio_device_manager, connection_error_cue, led=None):
+    """Stops the LED and plays the cue of a conversation the API failed."""
+    (led or red_breathing_led).stop()
+    try:
+        audio_device = audio_device_manager.device()
+        if connection_error_cue:
+            connection_error_cue.play(sink=audio_device)
+        else:
+            audio_device.stop(flush=False)
+    except Exception as e:
+        # Keeps the button armed, the next push opens the device again.
+        logging.error('Error playing the connection error cue: %s', e)
+
+
+def log_audio_levels(level_meter, tracer):
+    """Logs the audio levels of the conversation, warns of a dead or clipping microphone."""
+    gauges = {}
+    for direction in (audio_helpers.LEVELS_CAPTURE, audio_helpers.LEVELS_PLAYBACK):
+        stats = level_meter.stats(direction)
+        if stats is None:
+            continue
+        logging.info('Audio %s levels: %s', direction, stats)
+        gauges['%s_peak_dbfs' % direction] = stats['peak_db']
+        gauges['%s_clipped_samples' % direction] = stats['clipped']
+    tracer.set_gauges(gauges)
+    capture = level_meter.stats(audio_helpers.LEVELS_CAPTURE)
+    if capture is None:
+        return
+    if capture['digital_silence']:
+        logging.warning('The microphone captured %d ms of digital silence, is it muted or dead?',
+                        capture['ms'])
+    elif capture['clipped']:
+        logging.warning('The microphone clipped %d samples, lower its gain', capture['clipped'])
+
+
+def log_dsp_timings(conversation_stream, tracer):
+    """Logs and exports the mean time per block of each audio processing stage."""
+    gauges = {}
+    for direction, pipeline in sorted(conversation_stream.pipelines.items()):
+        timings = pipeline.timings()
+        logging.info('Audio %s processing, us per block: %s', direction, dict(timings))
+        for stage, microseconds in timings.items():
+            gauges['dsp_%s_%s_microseconds' % (direction, stage)] = microseconds
+    tracer.set_gauges(gauges)
 
 
 def trigger_assistant(assistant):
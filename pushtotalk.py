@@ -14,15 +14,15 @@
 
 """Sample that implements gRPC client for Google Assistant API."""
 
-import json
+import collections
+import concurrent.futures
 import logging
 import os.path
+import time
 
 import click
 import grpc
 import google.auth.transport.grpc
-import google.auth.transport.requests
-import google.oauth2.credentials
 
 from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
 from google.rpc import code_pb2
@@ -31,11 +31,19 @@ from tenacity import retry, stop_after_attempt, retry_if_exception
 try:
     from . import (
         assistant_helpers,
-        audio_helpers
+        audio_codecs,
+        audio_helpers,
+        credentials_manager,
+        session_recording,
+        turn_tracing
     )
-except SystemError:
+except (SystemError, ImportError):
     import assistant_helpers
+    import audio_codecs
     import audio_helpers
+    import credentials_manager
+    import session_recording
+    import turn_tracing
 
 
 ASSISTANT_API_ENDPOINT = 'embeddedassistant.googleapis.com'
@@ -43,6 +51,11 @@ END_OF_UTTERANCE = embedded_assistant_pb2.ConverseResponse.END_OF_UTTERANCE
 DIALOG_FOLLOW_ON = embedded_assistant_pb2.ConverseResult.DIALOG_FOLLOW_ON
 CLOSE_MICROPHONE = embedded_assistant_pb2.ConverseResult.CLOSE_MICROPHONE
 DEFAULT_GRPC_DEADLINE = 60 * 3 + 5
+DEFAULT_BATCH_WORKERS = 4
+BATCH_RESPONSES_DIR = 'responses'
+
+BatchResult = collections.namedtuple(
+    'BatchResult', ['input_path', 'output_path', 'trace', 'elapsed', 'error'])
 
 
 class SampleAssistant(object):
@@ -54,10 +67,27 @@ class SampleAssistant(object):
       channel: authorized gRPC channel for connection to the
         Google Assistant API.
       deadline_sec: gRPC deadline in seconds for Google Assistant API call.
+      tracer(TurnTracer): optional collector of the timing of each turn.
+      audio_in_encoding: encoding of the request audio, LINEAR16 or FLAC.
+      audio_out_encoding: encoding of the answer audio, LINEAR16 or
+        OPUS_IN_OGG.
+      recorder(SessionRecorder): optional recorder of the requests and
+        responses of each call.
     """
 
-    def __init__(self, conversation_stream, channel, deadline_sec):
+    def __init__(self, conversation_stream, channel, deadline_sec,
+                 tracer=None, audio_in_encoding=audio_codecs.AUDIO_IN_LINEAR16,
+                 audio_out_encoding=audio_codecs.AUDIO_OUT_LINEAR16,
+                 recorder=None):
         self.conversation_stream = conversation_stream
+        # Audio is written to the device after the stream has queued it.
+        self.conversation_stream.on_written = self.audio_written
+        self.recorder = recorder
+        self.audio_in_encoding = audio_in_encoding
+        self.audio_out_encoding = audio_out_encoding
+        if tracer is None:
+            tracer = turn_tracing.TurnTracer()
+        self.tracer = tracer
 
         # Opaque blob provided in ConverseResponse that,
         # when provided in a follow-up ConverseRequest,
@@ -94,6 +124,8 @@ class SampleAssistant(object):
         Returns: True if conversation should continue.
         """
         continue_conversation = False
+        if self.tracer.current is None:
+            self.tracer.start_turn()
 
         self.conversation_stream.start_recording()
         logging.info('Recording audio request.')
@@ -101,46 +133,94 @@ class SampleAssistant(object):
         def iter_converse_requests():
             for c in self.gen_converse_requests():
                 assistant_helpers.log_converse_request_without_audio(c)
+                if self.recorder is not None:
+                    self.recorder.record_request(call, c)
+                self.tracer.mark(turn_tracing.FIRST_REQUEST_SENT)
+                if c.audio_in:
+                    self.tracer.count(turn_tracing.BYTES_SENT,
+                                      len(c.audio_in))
                 yield c
             self.conversation_stream.start_playback()
 
-        # This generator yields ConverseResponse proto messages
-        # received from the gRPC Google Assistant API.
-        for resp in self.assistant.Converse(iter_converse_requests(),
-                                            self.deadline):
-            assistant_helpers.log_converse_response_without_audio(resp)
-            if resp.error.code != code_pb2.OK:
-                logging.error('server error: %s', resp.error.message)
-                break
-            if resp.event_type == END_OF_UTTERANCE:
-                logging.info('End of audio request detected')
-                self.conversation_stream.stop_recording()
-            if resp.result.spoken_request_text:
-                logging.info('Transcript of user request: "%s".',
-                             resp.result.spoken_request_text)
-                logging.info('Playing assistant response.')
-            if len(resp.audio_out.audio_data) > 0:
-                self.conversation_stream.write(resp.audio_out.audio_data)
-            if resp.result.spoken_response_text:
-                logging.info(
-                    'Transcript of TTS response '
-                    '(only populated from IFTTT): "%s".',
-                    resp.result.spoken_response_text)
-            if resp.result.conversation_state:
-                self.conversation_state = resp.result.conversation_state
-            if resp.result.volume_percentage != 0:
-                self.conversation_stream.volume_percentage = (
-                    resp.result.volume_percentage
-                )
-            if resp.result.microphone_mode == DIALOG_FOLLOW_ON:
-                continue_conversation = True
-                logging.info('Expecting follow-on query from user.')
-            elif resp.result.microphone_mode == CLOSE_MICROPHONE:
-                continue_conversation = False
+        # Compressed answers are decoded as they arrive.
+        decoder = None
+        if self.audio_out_encoding != audio_codecs.AUDIO_OUT_LINEAR16:
+            decoder = audio_codecs.StreamDecoder(
+                self.play_audio, self.conversation_stream.sample_rate)
+        call = None
+        if self.recorder is not None:
+            call = self.recorder.start_call()
+        error = None
+        try:
+            # This generator yields ConverseResponse proto messages
+            # received from the gRPC Google Assistant API.
+            for resp in self.assistant.Converse(iter_converse_requests(),
+                                                self.deadline):
+                assistant_helpers.log_converse_response_without_audio(resp)
+                if self.recorder is not None:
+                    self.recorder.record_response(call, resp)
+                if resp.error.code != code_pb2.OK:
+                    logging.error('server error: %s', resp.error.message)
+                    break
+                if resp.event_type == END_OF_UTTERANCE:
+                    logging.info('End of audio request detected')
+                    self.tracer.mark(turn_tracing.END_OF_UTTERANCE)
+                    self.conversation_stream.stop_recording()
+                if resp.result.spoken_request_text:
+                    logging.info('Transcript of user request: "%s".',
+                                 resp.result.spoken_request_text)
+                    logging.info('Playing assistant response.')
+                if len(resp.audio_out.audio_data) > 0:
+                    self.tracer.mark(turn_tracing.FIRST_AUDIO_OUT)
+                    self.tracer.count(turn_tracing.BYTES_RECEIVED,
+                                      len(resp.audio_out.audio_data))
+                    if decoder is not None:
+                        decoder.feed(resp.audio_out.audio_data)
+                    else:
+                        self.play_audio(resp.audio_out.audio_data)
+                if resp.result.spoken_response_text:
+                    logging.info(
+                        'Transcript of TTS response '
+                        '(only populated from IFTTT): "%s".',
+                        resp.result.spoken_response_text)
+                if resp.result.conversation_state:
+                    self.conversation_state = resp.result.conversation_state
+                if resp.result.volume_percentage != 0:
+                    self.conversation_stream.volume_percentage = (
+                        resp.result.volume_percentage
+                    )
+                if resp.result.microphone_mode == DIALOG_FOLLOW_ON:
+                    continue_conversation = True
+                    logging.info('Expecting follow-on query from user.')
+                elif resp.result.microphone_mode == CLOSE_MICROPHONE:
+                    continue_conversation = False
+        except grpc.RpcError as e:
+            error = str(e.code())
+            raise
+        finally:
+            if decoder is not None:
+                if error is not None:
+                    # The answer will not play, release the decoder thread
+                    # if it waits for playback to start.
+                    self.conversation_stream.stop_playback(abort=True)
+                decoder.close()
+            if self.recorder is not None:
+                self.recorder.end_call(call, error)
         logging.info('Finished playing assistant response.')
         self.conversation_stream.stop_playback()
+        self.tracer.mark(turn_tracing.STOP_PLAYBACK)
+        self.tracer.finish_turn()
         return continue_conversation
 
+    def play_audio(self, data):
+        """Writes PCM audio of the answer to the conversation stream."""
+        self.conversation_stream.write(data)
+
+    def audio_written(self):
+        """Marks audio of the answer written to the sound device."""
+        self.tracer.mark(turn_tracing.FIRST_AUDIO_WRITTEN)
+        self.tracer.mark(turn_tracing.LAST_AUDIO_WRITTEN, overwrite=True)
+
     def gen_converse_requests(self):
         """Yields: ConverseRequest messages to send to the API."""
 
@@ -153,11 +233,11 @@ class SampleAssistant(object):
             )
         config = embedded_assistant_pb2.ConverseConfig(
             audio_in_config=embedded_assistant_pb2.AudioInConfig(
-                encoding='LINEAR16',
+                encoding=self.audio_in_encoding,
                 sample_rate_hertz=self.conversation_stream.sample_rate,
             ),
             audio_out_config=embedded_assistant_pb2.AudioOutConfig(
-                encoding='LINEAR16',
+                encoding=self.audio_out_encoding,
                 sample_rate_hertz=self.conversation_stream.sample_rate,
                 volume_percentage=self.conversation_stream.volume_percentage,
             ),
@@ -166,9 +246,14 @@ class SampleAssistant(object):
         # The first ConverseRequest must contain the ConverseConfig
         # and no audio data.
         yield embedded_assistant_pb2.ConverseRequest(config=config)
-        for data in self.conversation_stream:
-            # Subsequent requests need audio data, but not config.
-            yield embedded_assistant_pb2.ConverseRequest(audio_in=data)
+        audio_in = self.conversation_stream
+        if self.audio_in_encoding == audio_codecs.AUDIO_IN_FLAC:
+            audio_in = audio_codecs.FlacEncoder(
+                self.conversation_stream.sample_rate).iter_encoded(audio_in)
+        for data in audio_in:
+            # Subsequent requests need audio data, but not config. The
+            # field takes bytes, sources may return views.
+            yield embedded_assistant_pb2.ConverseRequest(audio_in=bytes(data))
 
 
 @click.command()
@@ -190,6 +275,10 @@ class SampleAssistant(object):
               metavar='<output file>',
               help='Path to output audio file. '
               'If missing, uses audio playback')
+@click.option('--input-audio-speed',
+              default=1.0, metavar='<input audio speed>', show_default=True,
+              help='Pace of the input audio file relative to real time, '
+              '0 sends it as fast as possible.')
 @click.option('--audio-sample-rate',
               default=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
               metavar='<audio sample rate>', show_default=True,
@@ -198,6 +287,15 @@ class SampleAssistant(object):
               default=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
               metavar='<audio sample width>', show_default=True,
               help='Audio sample width in bytes.')
+@click.option('--audio-in-encoding',
+              type=click.Choice(audio_codecs.AUDIO_IN_ENCODINGS),
+              default=audio_codecs.AUDIO_IN_LINEAR16, show_default=True,
+              help='Encoding of the audio sent to the Assistant.')
+@click.option('--audio-out-encoding',
+              type=click.Choice(audio_codecs.AUDIO_OUT_ENCODINGS),
+              default=audio_codecs.AUDIO_OUT_LINEAR16, show_default=True,
+              help='Encoding of the answers, compressed ones are decoded '
+              'as they arrive.')
 @click.option('--audio-iter-size',
               default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
               metavar='<audio iter size>', show_default=True,
@@ -212,16 +310,37 @@ class SampleAssistant(object):
               metavar='<audio flush size>', show_default=True,
               help=('Size of silence data in bytes written '
                     'during flush operation'))
+@click.option('--batch-input', '-b',
+              metavar='<batch input>',
+              type=click.Path(exists=True),
+              help='Directory of input WAV files, or manifest listing one '
+              'input WAV and optionally its output WAV per line, '
+              'separated by a tab, to run as a batch of independent '
+              'queries.')
+@click.option('--batch-output-dir',
+              metavar='<batch output dir>',
+              help='Directory the batch responses are written to. '
+              'Defaults to a responses directory next to the batch input.')
+@click.option('--batch-workers', default=DEFAULT_BATCH_WORKERS,
+              metavar='<batch workers>', show_default=True,
+              help='Number of batch queries sent concurrently '
+              'over the channel.')
 @click.option('--grpc-deadline', default=DEFAULT_GRPC_DEADLINE,
               metavar='<grpc deadline>', show_default=True,
               help='gRPC deadline in seconds')
 @click.option('--once', default=False, is_flag=True,
               help='Force termination after a single conversation.')
+@click.option('--record-session',
+              metavar='<record session>', default=None,
+              help='Directory the requests and responses are recorded to, '
+              'see session_recording.')
 def main(api_endpoint, credentials, verbose,
-         input_audio_file, output_audio_file,
+         input_audio_file, output_audio_file, input_audio_speed,
          audio_sample_rate, audio_sample_width,
+         audio_in_encoding, audio_out_encoding,
          audio_iter_size, audio_block_size, audio_flush_size,
-         grpc_deadline, once, *args, **kwargs):
+         batch_input, batch_output_dir, batch_workers,
+         grpc_deadline, once, record_session, *args, **kwargs):
     """Samples for the Google Assistant API.
 
     Examples:
@@ -236,35 +355,62 @@ def main(api_endpoint, credentials, verbose,
       Run the sample with file input and output:
 
         $ python -m googlesamples.assistant -i <input file> -o <output file>
+
+      Run every WAV file of a directory as a query, 8 at a time:
+
+        $ python -m googlesamples.assistant -b <input dir> --batch-workers 8
     """
     # Setup logging.
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
 
-    # Load OAuth 2.0 credentials.
+    # Load OAuth 2.0 credentials, the access token is cached next to them.
+    credential_manager = credentials_manager.CredentialManager(credentials)
     try:
-        with open(credentials, 'r') as f:
-            credentials = google.oauth2.credentials.Credentials(token=None,
-                                                                **json.load(f))
-            http_request = google.auth.transport.requests.Request()
-            credentials.refresh(http_request)
+        credential_manager.load()
+        credential_manager.ensure_valid()
     except Exception as e:
         logging.error('Error loading credentials: %s', e)
         logging.error('Run google-oauthlib-tool to initialize '
                       'new OAuth 2.0 credentials.')
         return
+    credential_manager.start()
 
     # Create an authorized gRPC channel.
     grpc_channel = google.auth.transport.grpc.secure_authorized_channel(
-        credentials, http_request, api_endpoint)
+        credential_manager.credentials, credential_manager.request,
+        api_endpoint)
     logging.info('Connecting to %s', api_endpoint)
 
+    recorder = None
+    if record_session:
+        recorder = session_recording.SessionRecorder(record_session)
+
+    if batch_input:
+        queries = find_batch_queries(batch_input, batch_output_dir)
+        started_at = time.monotonic()
+        try:
+            results = run_batch(queries, grpc_channel, grpc_deadline,
+                                batch_workers, recorder=recorder,
+                                sample_rate=audio_sample_rate,
+                                sample_width=audio_sample_width,
+                                iter_size=audio_iter_size,
+                                speed=input_audio_speed,
+                                audio_in_encoding=audio_in_encoding,
+                                audio_out_encoding=audio_out_encoding)
+        finally:
+            if recorder is not None:
+                recorder.close()
+        print_batch_summary(results, time.monotonic() - started_at)
+        return
+
     # Configure audio source and sink.
     audio_device = None
     if input_audio_file:
         audio_source = audio_helpers.WaveSource(
             open(input_audio_file, 'rb'),
             sample_rate=audio_sample_rate,
-            sample_width=audio_sample_width
+            sample_width=audio_sample_width,
+            speed=input_audio_speed
         )
     else:
         audio_source = audio_device = (
@@ -298,30 +444,213 @@ def main(api_endpoint, credentials, verbose,
         sample_width=audio_sample_width,
     )
 
-    with SampleAssistant(conversation_stream,
-                         grpc_channel, grpc_deadline) as assistant:
-        # If file arguments are supplied:
-        # exit after the first turn of the conversation.
-        if input_audio_file or output_audio_file:
-            assistant.converse()
-            return
-
-        # If no file arguments supplied:
-        # keep recording voice requests using the microphone
-        # and playing back assistant response using the speaker.
-        # When the once flag is set, don't wait for a trigger. Otherwise, wait.
-        wait_for_user_trigger = not once
-        while True:
-            if wait_for_user_trigger:
-                click.pause(info='Press Enter to send a new request...')
-            continue_conversation = assistant.converse()
-            # wait for user trigger if there is no follow-up turn in
-            # the conversation.
-            wait_for_user_trigger = not continue_conversation
-
-            # If we only want one conversation, break.
-            if once and (not continue_conversation):
-                break
+    try:
+        with SampleAssistant(conversation_stream,
+                             grpc_channel, grpc_deadline,
+                             audio_in_encoding=audio_in_encoding,
+                             audio_out_encoding=audio_out_encoding,
+                             recorder=recorder) as assistant:
+            # If file arguments are supplied:
+            # exit after the first turn of the conversation.
+            if input_audio_file or output_audio_file:
+                assistant.converse()
+                return
+
+            # If no file arguments supplied:
+            # keep recording voice requests using the microphone
+            # and playing back assistant response using the speaker.
+            # When the once flag is set, don't wait for a trigger. Otherwise, wait.
+            wait_for_user_trigger = not once
+            while True:
+                if wait_for_user_trigger:
+                    click.pause(info='Press Enter to send a new request...')
+                continue_conversation = assistant.converse()
+                # wait for user trigger if there is no follow-up turn in
+                # the conversation.
+                wait_for_user_trigger = not continue_conversation
+
+                # If we only want one conversation, break.
+                if once and (not continue_conversation):
+                    break
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+
+def find_batch_queries(batch_input, output_dir=None):
+    """Returns the (input, output) WAV paths of a batch of queries.
+
+    Args:
+      batch_input: directory of input WAV files, or manifest listing one
+        input WAV per line, optionally followed by a tab and its output
+        WAV. Paths are relative to the manifest and may contain spaces,
+        lines starting with # are ignored.
+      output_dir: directory of the responses without an explicit output,
+        defaults to a responses directory next to the batch input. Inputs
+        of the same name in different directories get numbered outputs,
+        e.g. query-2.wav.
+    """
+    if os.path.isdir(batch_input):
+        base_dir = batch_input
+        entries = [[name] for name in sorted(os.listdir(batch_input))
+                   if name.lower().endswith('.wav')]
+    else:
+        base_dir = os.path.dirname(batch_input)
+        with open(batch_input, 'r') as f:
+            entries = [[field.strip() for field in line.split('\t')
+                        if field.strip()]
+                       for line in f
+                       if line.strip() and not line.startswith('#')]
+    output_dir = output_dir or os.path.join(base_dir, BATCH_RESPONSES_DIR)
+    explicit_outputs = set(os.path.join(base_dir, entry[1])
+                           for entry in entries if len(entry) > 1)
+    used_outputs = set()
+    queries = []
+    for entry in entries:
+        input_path = os.path.join(base_dir, entry[0])
+        if len(entry) > 1:
+            output_path = os.path.join(base_dir, entry[1])
+        else:
+            root, ext = os.path.splitext(os.path.basename(entry[0]))
+            output_path = os.path.join(output_dir, root + ext)
+            number = 1
+            while (output_path in used_outputs
+                   or output_path in explicit_outputs):
+                number += 1
+                output_path = os.path.join(output_dir,
+                                           '%s-%d%s' % (root, number, ext))
+        used_outputs.add(output_path)
+        queries.append((input_path, output_path))
+    # Only the directories written to, output_dir may be unused.
+    for directory in set(os.path.dirname(path) for path in used_outputs):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    return queries
+
+
+def run_batch_query(input_path, output_path, channel, deadline,
+                    sample_rate, sample_width, iter_size, speed,
+                    audio_in_encoding=audio_codecs.AUDIO_IN_LINEAR16,
+                    audio_out_encoding=audio_codecs.AUDIO_OUT_LINEAR16,
+                    recorder=None):
+    """Sends one input WAV file as a query and writes the response.
+
+    Errors, e.g. a missing or corrupt input file, fail the query only and
+    are recorded in its BatchResult. The call is recorded by the optional
+    SessionRecorder, which may be shared by concurrent queries.
+
+    Returns: BatchResult of the query.
+    """
+    tracer = turn_tracing.TurnTracer()
+    started_at = time.monotonic()
+    files = []
+    conversation_stream = None
+    error = None
+    try:
+        files.append(open(input_path, 'rb'))
+        source = audio_helpers.WaveSource(
+            files[-1],
+            sample_rate=sample_rate,
+            sample_width=sample_width,
+            speed=speed
+        )
+        files.append(open(output_path, 'wb'))
+        sink = audio_helpers.WaveSink(
+            files[-1],
+            sample_rate=sample_rate,
+            sample_width=sample_width
+        )
+        conversation_stream = audio_helpers.ConversationStream(
+            source=source,
+            sink=sink,
+            iter_size=iter_size,
+            sample_width=sample_width,
+        )
+        SampleAssistant(conversation_stream, channel, deadline,
+                        tracer=tracer,
+                        audio_in_encoding=audio_in_encoding,
+                        audio_out_encoding=audio_out_encoding,
+                        recorder=recorder).converse()
+    except grpc.RpcError as e:
+        logging.error('Query %s failed: %s', input_path, e)
+        error = e.code().name
+    except Exception as e:
+        logging.error('Query %s failed: %s', input_path, e)
+        error = '%s: %s' % (type(e).__name__, e)
+    finally:
+        if conversation_stream is not None:
+            conversation_stream.close()
+        else:
+            for f in files:
+                f.close()
+    if error is not None:
+        tracer.finish_turn(error=error)
+    return BatchResult(input_path, output_path, tracer.last_turn,
+                       time.monotonic() - started_at, error)
+
+
+def run_batch(queries, channel, deadline, workers, recorder=None,
+              **audio_options):
+    """Runs queries concurrently, multiplexed over one channel.
+
+    Args:
+      queries: list of (input, output) WAV paths.
+      channel: authorized gRPC channel shared by the queries.
+      deadline: gRPC deadline in seconds of each query.
+      workers: number of queries in flight at once.
+      recorder(SessionRecorder): optional recorder of every query.
+      audio_options: sample_rate, sample_width, iter_size and speed of
+        the WAV files, audio_in_encoding and audio_out_encoding.
+
+    Returns: list of BatchResult, in the order of queries.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_batch_query, input_path, output_path,
+                               channel, deadline, recorder=recorder,
+                               **audio_options)
+                   for input_path, output_path in queries]
+        return [future.result() for future in futures]
+
+
+def format_span(spans, span):
+    return '%.0f' % spans[span] if span in spans else '-'
+
+
+def print_batch_summary(results, elapsed):
+    """Prints the latency of each batch query and the throughput.
+
+    Args:
+      results: list of BatchResult.
+      elapsed: wall time in seconds of the whole batch.
+    """
+    header = ('query', 'end of utterance ms', 'first audio ms', 'total ms',
+              'sent KiB', 'received KiB', 'status')
+    rows = []
+    bytes_sent = 0
+    for result in results:
+        spans = result.trace.spans_ms() if result.trace else {}
+        counters = result.trace.counters if result.trace else {}
+        bytes_sent += counters.get(turn_tracing.BYTES_SENT, 0)
+        rows.append((
+            os.path.basename(result.input_path),
+            format_span(spans, turn_tracing.END_OF_UTTERANCE),
+            format_span(spans, turn_tracing.FIRST_AUDIO_OUT),
+            '%.0f' % (result.elapsed * 1000),
+            '%.1f' % (counters.get(turn_tracing.BYTES_SENT, 0) / 1024.0),
+            '%.1f' % (counters.get(turn_tracing.BYTES_RECEIVED, 0) / 1024.0),
+            result.error or 'OK'))
+    widths = [max(len(cell) for cell in column)
+              for column in zip(header, *rows)]
+    line = '  '.join('%%-%ds' % width for width in widths)
+    click.echo(line % header)
+    for row in rows:
+        click.echo(line % row)
+
+    failed = sum(1 for result in results if result.error)
+    click.echo('%d queries, %d failed, %.1f queries/min, %.1f KiB/s sent' % (
+        len(results), failed,
+        len(results) * 60 / elapsed if elapsed else 0,
+        bytes_sent / 1024.0 / elapsed if elapsed else 0))
 
 
 if __name__ == '__main__':
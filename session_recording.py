@@ -0,0 +1,524 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Recording of Converse() sessions and their replay with original timing.
+
+A session is a directory holding two append-only files:
+
+- index: a magic header followed by one record per event, a fixed
+  RECORD header (arrival time, call, kind, audio offset and size,
+  metadata size) and the serialized protobuf message without its audio.
+- audio: the audio payloads back to back, memory-mapped when read.
+
+Replay one to see what a turn of the device went through, with the
+recorded answers served by a local fake of the Assistant API:
+
+    python -m session_recording replay /var/lib/piterkom/session
+"""
+
+import collections
+import io
+import itertools
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import click
+import grpc
+
+from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
+
+try:
+    from . import (
+        audio_codecs,
+        audio_helpers,
+        fake_assistant,
+        turn_tracing
+    )
+except (SystemError, ImportError):
+    import audio_codecs
+    import audio_helpers
+    import fake_assistant
+    import turn_tracing
+
+
+INDEX_FILE = 'index'
+AUDIO_FILE = 'audio'
+MAGIC = b'PTKSESS1'
+
+# Arrival time in seconds since the recorder started, call number, kind,
+# offset and size of the audio payload in the audio file, size of the
+# serialized message following the header.
+RECORD = struct.Struct('<dIBQII')
+
+CALL_START = 1
+REQUEST = 2
+RESPONSE = 3
+CALL_END = 4
+
+# Events buffered for the writer thread, past that they are dropped.
+DEFAULT_MAX_PENDING = 1000
+
+Record = collections.namedtuple(
+    'Record', ['time', 'call', 'kind', 'metadata', 'audio'])
+
+
+def split_audio(kind, message):
+    """Returns (metadata, audio) of a ConverseRequest or ConverseResponse.
+
+    The audio field is part of a oneof, a message carrying audio has no
+    other field and its metadata is empty.
+    """
+    if kind == REQUEST and message.WhichOneof('converse_request') == 'audio_in':
+        return b'', message.audio_in
+    if (kind == RESPONSE
+            and message.WhichOneof('converse_response') == 'audio_out'):
+        return b'', message.audio_out.audio_data
+    return message.SerializeToString(), b''
+
+
+def join_audio(kind, metadata, audio):
+    """Returns the message of a REQUEST or RESPONSE record."""
+    if kind == REQUEST:
+        if audio:
+            return embedded_assistant_pb2.ConverseRequest(
+                audio_in=bytes(audio))
+        return embedded_assistant_pb2.ConverseRequest.FromString(metadata)
+    if audio:
+        return embedded_assistant_pb2.ConverseResponse(
+            audio_out=embedded_assistant_pb2.AudioOut(
+                audio_data=bytes(audio)))
+    return embedded_assistant_pb2.ConverseResponse.FromString(metadata)
+
+
+class SessionRecorder(object):
+    """Appends the Converse() calls of a device to a session directory.
+
+    The record_*() methods only stamp the time and queue a reference to
+    the message. Serializing it and writing the audio happens on a
+    background thread, so the conversation never waits for the SD card.
+    If the writer falls max_pending events behind, new events are
+    dropped and counted.
+
+    Args:
+      path: session directory, created if needed and appended to.
+      max_pending: number of events buffered for the writer.
+    """
+    def __init__(self, path, max_pending=DEFAULT_MAX_PENDING):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._index = open(os.path.join(path, INDEX_FILE), 'ab')
+        self._audio = open(os.path.join(path, AUDIO_FILE), 'ab')
+        if self._index.tell() == 0:
+            self._index.write(MAGIC)
+        self._audio_offset = self._audio.tell()
+        self._started_at = time.monotonic()
+        self._calls = itertools.count(_last_call(path) + 1)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._write,
+                                        name='session-recorder', daemon=True)
+        self._thread.start()
+
+    def start_call(self):
+        """Record the start of a Converse() call, returns its number."""
+        call = next(self._calls)
+        self._put(call, CALL_START, None)
+        return call
+
+    def record_request(self, call, request):
+        """Record a ConverseRequest sent in the call."""
+        self._put(call, REQUEST, request)
+
+    def record_response(self, call, response):
+        """Record a ConverseResponse received in the call."""
+        self._put(call, RESPONSE, response)
+
+    def end_call(self, call, error=None):
+        """Record the end of the call.
+
+        Args:
+          call: number returned by start_call().
+          error: optional description of the error that ended the call.
+        """
+        self._put(call, CALL_END, error)
+
+    def _put(self, call, kind, message):
+        try:
+            self._queue.put_nowait((time.monotonic(), call, kind, message))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write the pending events and close the session files."""
+        self._queue.put((None, None, None, None))
+        self._thread.join()
+        if self.dropped:
+            logging.warning('Session recorder dropped %d events',
+                            self.dropped)
+
+    def _write(self):
+        while True:
+            at, call, kind, message = self._queue.get()
+            if kind is None:
+                break
+            try:
+                self._write_record(at, call, kind, message)
+                if self._queue.empty():
+                    # Keep what was written so far when the device dies.
+                    self._audio.flush()
+                    self._index.flush()
+            except (IOError, OSError) as e:
+                logging.warning('Error recording session: %s', e)
+        self._audio.close()
+        self._index.close()
+
+    def _write_record(self, at, call, kind, message):
+        metadata = audio = b''
+        if kind in (REQUEST, RESPONSE):
+            metadata, audio = split_audio(kind, message)
+        elif kind == CALL_END and message:
+            metadata = message.encode('utf-8')
+        audio_offset = self._audio_offset
+        if audio:
+            self._audio.write(audio)
+            self._audio_offset += len(audio)
+        self._index.write(RECORD.pack(at - self._started_at, call, kind,
+                                      audio_offset, len(audio),
+                                      len(metadata)))
+        self._index.write(metadata)
+
+
+def _last_call(path):
+    """Returns the number of the last call recorded in path, 0 if none."""
+    try:
+        reader = SessionReader(path)
+    except (IOError, OSError, ValueError):
+        return 0
+    with reader:
+        return max((record.call for record in reader.records()), default=0)
+
+
+class RecordedCall(object):
+    """Converse() call of a session, times relative to its start.
+
+    Attributes:
+      call: number of the call.
+      started_at: time in seconds of the start of the call.
+      requests: list of (seconds, ConverseRequest).
+      responses: list of (seconds, ConverseResponse).
+      ended_at: seconds from the start to the end of the call, if recorded.
+      error: error that ended the call, if any.
+    """
+    def __init__(self, call, started_at):
+        self.call = call
+        self.started_at = started_at
+        self.requests = []
+        self.responses = []
+        self.ended_at = None
+        self.error = None
+
+    @property
+    def config(self):
+        """The ConverseConfig sent first in the call, if recorded."""
+        for _, request in self.requests:
+            if request.HasField('config'):
+                return request.config
+        return None
+
+    def audio_in(self):
+        """Returns [(seconds, bytes)] of the audio sent in the call."""
+        return [(at, request.audio_in) for at, request in self.requests
+                if request.audio_in]
+
+
+class SessionReader(object):
+    """Reads a session directory written by SessionRecorder.
+
+    A record cut short by a crash ends the session.
+
+    Args:
+      path: session directory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), 'rb') as f:
+            self._index = f.read()
+        if not self._index.startswith(MAGIC):
+            raise ValueError('not a session index: %s' % path)
+        self._audio_file = open(os.path.join(path, AUDIO_FILE), 'rb')
+        self._audio = b''
+        if os.fstat(self._audio_file.fileno()).st_size:
+            self._audio = mmap.mmap(self._audio_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+
+    def records(self):
+        """Yields the Records of the session, audio as memoryview slices."""
+        index = memoryview(self._index)
+        audio = memoryview(self._audio)
+        offset = len(MAGIC)
+        while offset < len(index):
+            if offset + RECORD.size > len(index):
+                logging.warning('Truncated session record at %d', offset)
+                return
+            (at, call, kind, audio_offset, audio_size,
+             metadata_size) = RECORD.unpack_from(index, offset)
+            offset += RECORD.size
+            metadata = index[offset:offset + metadata_size]
+            offset += metadata_size
+            if (len(metadata) < metadata_size
+                    or audio_offset + audio_size > len(audio)):
+                logging.warning('Truncated session record at %d', offset)
+                return
+            yield Record(at, call, kind, metadata,
+                         audio[audio_offset:audio_offset + audio_size])
+
+    def calls(self):
+        """Returns the RecordedCalls of the session, in order."""
+        calls = collections.OrderedDict()
+        for record in self.records():
+            if record.kind == CALL_START:
+                calls[record.call] = RecordedCall(record.call, record.time)
+                continue
+            recorded = calls.get(record.call)
+            if recorded is None:
+                continue
+            at = record.time - recorded.started_at
+            if record.kind == CALL_END:
+                recorded.ended_at = at
+                recorded.error = bytes(record.metadata).decode('utf-8') or None
+                continue
+            message = join_audio(record.kind, record.metadata, record.audio)
+            if record.kind == REQUEST:
+                recorded.requests.append((at, message))
+            else:
+                recorded.responses.append((at, message))
+        return list(calls.values())
+
+    def close(self):
+        if isinstance(self._audio, mmap.mmap):
+            self._audio.close()
+        self._audio_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, e, traceback):
+        self.close()
+
+
+def sleep_until(due):
+    delay = due - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+class RecordedSource(object):
+    """Audio source replaying the request audio of recorded calls.
+
+    Each start() moves to the next call, whose audio_in chunks read()
+    returns at their original times from the start, speed times faster.
+
+    Args:
+      calls: list of RecordedCall, with LINEAR16 request audio.
+      sample_rate: sample rate in hertz.
+      speed: pacing relative to the recording, 0 reads as fast as possible.
+    """
+    def __init__(self, calls, sample_rate, speed=1.0):
+        self._calls = collections.deque(calls)
+        self._sample_rate = sample_rate
+        self._speed = speed
+        self._chunks = iter(())
+        self._started_at = None
+
+    @property
+    def remaining(self):
+        """Number of calls not started yet."""
+        return len(self._calls)
+
+    def start(self):
+        recorded = self._calls.popleft() if self._calls else None
+        self._chunks = iter(recorded.audio_in() if recorded else ())
+        self._started_at = time.monotonic()
+
+    def read(self, size):
+        at, data = next(self._chunks, (None, b''))
+        if at is not None and self._speed:
+            sleep_until(self._started_at + at / self._speed)
+        return data
+
+    def stop(self, flush=True):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+
+class ReplayEmbeddedAssistant(embedded_assistant_pb2.EmbeddedAssistantServicer):
+    """EmbeddedAssistant servicer replaying the responses of recorded calls.
+
+    Each Converse() call gets the responses of the next recorded call, at
+    their original times from its start, speed times faster. The requests
+    are read and dropped as they come.
+
+    Args:
+      calls: list of RecordedCall, replayed in a loop.
+      speed: pacing relative to the recording, 0 replies at once.
+    """
+    def __init__(self, calls, speed=1.0):
+        self._calls = itertools.cycle(calls)
+        self._speed = speed
+        self._lock = threading.Lock()
+
+    def Converse(self, request_iterator, context):
+        started_at = time.monotonic()
+        with self._lock:
+            recorded = next(self._calls)
+        threading.Thread(target=collections.deque,
+                         args=(request_iterator, 0), daemon=True).start()
+        for at, response in recorded.responses:
+            if self._speed:
+                sleep_until(started_at + at / self._speed)
+            yield response
+        if recorded.error:
+            # Errors are recorded as str(grpc.StatusCode.X).
+            code = getattr(grpc.StatusCode, recorded.error.split('.')[-1],
+                           grpc.StatusCode.UNKNOWN)
+            context.abort(code, 'recorded error: %s' % recorded.error)
+
+
+@click.group()
+def main():
+    """Inspect and replay recorded Converse() sessions."""
+    logging.basicConfig(level=logging.INFO)
+
+
+@main.command()
+@click.argument('session', type=click.Path(exists=True, file_okay=False))
+def show(session):
+    """List the calls of a session and the gaps in their audio."""
+    with SessionReader(session) as reader:
+        for recorded in reader.calls():
+            config = recorded.config
+            responses = [at for at, response in recorded.responses
+                         if response.audio_out.audio_data]
+            # Requests and responses interleave in a duplex call.
+            times = sorted([at for at, _ in recorded.requests] + responses)
+            gaps = [b - a for a, b in zip(times, times[1:])]
+            click.echo(
+                'call %d: %d requests (%d bytes %s), %d responses (%d bytes '
+                '%s), first audio out %s, longest gap %.0f ms, %s%s' % (
+                    recorded.call, len(recorded.requests),
+                    sum(len(data) for _, data in recorded.audio_in()),
+                    embedded_assistant_pb2.AudioInConfig.Encoding.Name(
+                        config.audio_in_config.encoding) if config else '?',
+                    len(recorded.responses),
+                    sum(len(response.audio_out.audio_data)
+                        for _, response in recorded.responses),
+                    embedded_assistant_pb2.AudioOutConfig.Encoding.Name(
+                        config.audio_out_config.encoding) if config else '?',
+                    '%.0f ms' % (responses[0] * 1000) if responses else '-',
+                    max(gaps) * 1000 if gaps else 0,
+                    'ended after %.0f ms' % (recorded.ended_at * 1000)
+                    if recorded.ended_at is not None else 'not ended',
+                    ', error: %s' % recorded.error if recorded.error else ''))
+
+
+@main.command()
+@click.argument('session', type=click.Path(exists=True, file_okay=False))
+@click.option('--speed', default=1.0, show_default=True,
+              help='Pace relative to the recording, 0 replays as fast as '
+                   'possible.')
+@click.option('--scenario', default=None,
+              type=click.Choice(sorted(fake_assistant.SCENARIOS)),
+              help='Answer with a scripted fake instead of the recorded '
+                   'responses.')
+@click.option('--output-audio-file', '-o', default=None,
+              type=click.Path(dir_okay=False),
+              help='WAV file the replayed answers are written to.')
+def replay(session, speed, scenario, output_audio_file):
+    """Replay a session into SampleAssistant.
+
+    The recorded request audio is the microphone, at its original pace.
+    The recorded responses are served by a local fake of the Assistant
+    API, or the --scenario fake answers instead. Every call is traced like
+    a turn on the device.
+    """
+    # Imported here, they pull in the modules of the device.
+    try:
+        from . import benchmarks, push_red_to_talk
+    except (SystemError, ImportError):
+        import benchmarks
+        import push_red_to_talk
+
+    with SessionReader(session) as reader:
+        calls = reader.calls()
+    if not calls:
+        raise click.ClickException('no calls recorded in %s' % session)
+    config = calls[0].config
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    audio_out_encoding = audio_codecs.AUDIO_OUT_LINEAR16
+    if config is not None:
+        if config.audio_in_config.encoding != config.audio_in_config.LINEAR16:
+            raise click.ClickException(
+                'only LINEAR16 request audio can be replayed')
+        sample_rate = config.audio_in_config.sample_rate_hertz
+        audio_out_encoding = (
+            embedded_assistant_pb2.AudioOutConfig.Encoding.Name(
+                config.audio_out_config.encoding))
+
+    servicer = None
+    if scenario is None:
+        servicer = ReplayEmbeddedAssistant(calls, speed)
+    server = fake_assistant.FakeAssistantServer(
+        fake_assistant.SCENARIOS.get(scenario), servicer=servicer)
+    source = RecordedSource(calls, sample_rate, speed)
+    sink = audio_helpers.WaveSink(
+        open(output_audio_file, 'wb') if output_audio_file else io.BytesIO(),
+        sample_rate=sample_rate,
+        sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH)
+    tracer = turn_tracing.TurnTracer()
+    with server:
+        channel = server.channel()
+        stream = audio_helpers.ConversationStream(
+            source=source, sink=sink,
+            iter_size=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+            sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH)
+        with push_red_to_talk.SampleAssistant(
+                conversation_stream=stream,
+                channel=channel,
+                deadline_sec=push_red_to_talk.DEFAULT_GRPC_DEADLINE,
+                tracer=tracer,
+                led=benchmarks.UnlitLed(),
+                audio_out_encoding=audio_out_encoding) as assistant:
+            # Retries of converse() replay the recorded retries.
+            while source.remaining:
+                try:
+                    assistant.converse()
+                except grpc.RpcError as e:
+                    logging.error('Replayed call failed: %s', e.code())
+                    tracer.finish_turn(error=str(e.code()))
+        channel.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of cancelling conversations on the asyncio runtime."""
+
+import asyncio
+import time
+import unittest
+
+import grpc.aio
+
+import async_runtime
+import audio_helpers
+import breathing_led
+import fake_assistant
+import led_animator
+import push_button
+import push_red_to_talk
+import turn_tracing
+
+
+# Seconds to wait for a conversation to start or to end.
+TURN_TIMEOUT = 10
+# Milliseconds of audio in each block written.
+BLOCK_MS = 100
+
+
+def loopback_manager():
+    manager = audio_helpers.AudioDeviceManager(
+        sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+        sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+        block_size=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
+        flush_size=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE,
+        device_class=audio_helpers.LoopbackStream)
+    manager.open()
+    return manager
+
+
+async def wait_until(predicate, timeout=TURN_TIMEOUT):
+    """Returns True once predicate() is, False after timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+class AbortTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = loopback_manager()
+        self.audio = async_runtime.AsyncConversationStream(
+            self.manager.conversation_stream(
+                playback_buffer_ms=audio_helpers.DEFAULT_PLAYBACK_BUFFER_MS))
+        self.block = b'\x01\x00' * (audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+                                    * BLOCK_MS // 1000)
+
+    def tearDown(self):
+        self.audio.close().result(TURN_TIMEOUT)
+        self.manager.close()
+
+    def test_abort_drops_the_queued_answer(self):
+        async def abort():
+            await self.audio.start_recording()
+            self.audio.start_playback()
+            # Two seconds of answer, queued faster than they play.
+            for _ in range(20):
+                await self.audio.write(self.block)
+            started_at = time.monotonic()
+            await asyncio.wrap_future(self.audio.abort())
+            return time.monotonic() - started_at
+
+        elapsed = asyncio.run(abort())
+
+        self.assertLess(elapsed, 1)
+        self.assertEqual(self.audio.stream.playback_buffer.depth_ms, 0)
+
+    def test_writes_after_abort_are_dropped(self):
+        async def abort_then_write():
+            await self.audio.start_recording()
+            await asyncio.wrap_future(self.audio.abort())
+            # Playback never started, the write would wait for it.
+            await asyncio.wait_for(self.audio.write(self.block), 1)
+            await self.audio.drain()
+
+        asyncio.run(abort_then_write())
+
+        self.assertEqual(self.audio.stream.playback_buffer.depth_ms, 0)
+
+
+class ServeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_assistant.FakeAssistantServer(
+            fake_assistant.SCENARIOS['long-answer']).start()
+        self.manager = loopback_manager()
+        self.animator = led_animator.LedAnimator(
+            led_animator.FakePwmBackend())
+        self.tracer = turn_tracing.TurnTracer()
+        self.gpio = push_button.FakeGpioBackend()
+        self.pin = push_button.PushButton.DEFAULT_GPIO_PIN
+        self.button = async_runtime.AsyncPushButton(push_button.PushButton(
+            self.pin, gpio=self.gpio, long_press_time=None))
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+
+    async def push(self):
+        self.gpio.set_input(self.pin, True)
+        await asyncio.sleep(push_button.DEFAULT_DEBOUNCE_TIME * 5)
+        self.gpio.set_input(self.pin, False)
+
+    def answer_playing(self):
+        turn = self.tracer.current
+        return (turn is not None
+                and turn_tracing.FIRST_AUDIO_WRITTEN in turn.marks)
+
+    def test_second_push_cancels_the_conversation(self):
+        async def connect():
+            return grpc.aio.insecure_channel('localhost:%d' % self.server.port)
+
+        async def push_twice():
+            serving = asyncio.ensure_future(async_runtime.serve(
+                self.button, connect, animator=self.animator,
+                audio_device_manager=self.manager,
+                deadline=push_red_to_talk.DEFAULT_GRPC_DEADLINE,
+                tracer=self.tracer,
+                led=breathing_led.BreathingLed(
+                    push_red_to_talk.RED_BREATHING_LED_PIN,
+                    animator=self.animator)))
+            try:
+                # Leave serve() the time to arm the button.
+                await asyncio.sleep(0.2)
+                await self.push()
+                self.assertTrue(await wait_until(self.answer_playing))
+                stopping_at = time.monotonic()
+                await self.push()
+                self.assertTrue(await wait_until(
+                    lambda: self.tracer.current is None))
+                return time.monotonic() - stopping_at
+            finally:
+                serving.cancel()
+                await asyncio.gather(serving, return_exceptions=True)
+
+        elapsed = asyncio.run(push_twice())
+
+        # Well before the end of the 8 s answer.
+        self.assertLess(elapsed, 1)
+        self.assertEqual(self.tracer.turns, 1)
+        self.assertEqual(self.tracer.last_turn.error, 'cancelled')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of ChannelMonitor and of failing fast against a local gRPC server."""
+
+import time
+import unittest
+
+import grpc
+
+import audio_helpers
+import channel_helpers
+import fake_assistant
+import push_red_to_talk
+import turn_tracing
+
+
+# Seconds to wait for a state change of the local channel.
+STATE_TIMEOUT = 10
+
+
+def wait_until(predicate, timeout=STATE_TIMEOUT):
+    """Returns True once predicate() is, False after timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class ChannelMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_assistant.FakeAssistantServer([]).start()
+        self.channel = self.server.channel()
+        self.states = []
+        self.channel.subscribe(self.states.append)
+        self.monitor = channel_helpers.ChannelMonitor(self.channel)
+
+    def tearDown(self):
+        self.monitor.stop()
+        self.channel.unsubscribe(self.states.append)
+        self.channel.close()
+        self.server.stop()
+
+    def stop_server(self):
+        self.server.stop()
+        self.assertTrue(wait_until(self.monitor.is_down))
+
+    def test_state_is_unknown_before_start(self):
+        self.assertIsNone(self.monitor.state)
+        self.assertFalse(self.monitor.is_down())
+        self.assertFalse(self.monitor.is_ready())
+
+    def test_connects_before_the_first_call(self):
+        self.monitor.start()
+
+        self.assertTrue(self.monitor.wait_for_ready(STATE_TIMEOUT))
+        self.assertEqual(self.monitor.state, grpc.ChannelConnectivity.READY)
+        self.assertFalse(self.monitor.is_down())
+        self.assertIn(grpc.ChannelConnectivity.CONNECTING, self.states)
+
+    def test_down_once_the_server_stops(self):
+        self.monitor.start()
+        self.assertTrue(self.monitor.wait_for_ready(STATE_TIMEOUT))
+
+        self.stop_server()
+
+        self.assertIn(self.monitor.state, channel_helpers.DOWN_STATES)
+        self.assertFalse(self.monitor.is_ready())
+        # The dropped connection is retried without waiting for a call.
+        ready = self.states.index(grpc.ChannelConnectivity.READY)
+        self.assertIn(grpc.ChannelConnectivity.CONNECTING,
+                      self.states[ready:])
+
+    def test_wait_for_ready_times_out_while_down(self):
+        self.monitor.start()
+        self.assertTrue(self.monitor.wait_for_ready(STATE_TIMEOUT))
+        self.stop_server()
+
+        self.assertFalse(self.monitor.wait_for_ready(0.05))
+
+
+class FailFastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_assistant.FakeAssistantServer([]).start()
+        self.channel = self.server.channel()
+        self.monitor = channel_helpers.ChannelMonitor(self.channel)
+        self.monitor.start()
+        self.assertTrue(self.monitor.wait_for_ready(STATE_TIMEOUT))
+        self.server.stop()
+        self.assertTrue(wait_until(self.monitor.is_down))
+        self.manager = audio_helpers.AudioDeviceManager(
+            sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+            sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+            block_size=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
+            flush_size=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE,
+            device_class=audio_helpers.LoopbackStream)
+        self.manager.open()
+        self.tracer = turn_tracing.TurnTracer()
+
+    def tearDown(self):
+        self.monitor.stop()
+        self.channel.close()
+        self.manager.close()
+
+    def test_conversation_fails_within_milliseconds(self):
+        started_at = time.monotonic()
+        push_red_to_talk.converse_with_assistant(
+            self.manager, self.channel,
+            deadline=push_red_to_talk.DEFAULT_GRPC_DEADLINE,
+            channel_monitor=self.monitor,
+            tracer=self.tracer)
+        elapsed_ms = (time.monotonic() - started_at) * 1000
+
+        self.assertLess(elapsed_ms, 100)
+        self.assertIsNone(self.tracer.current)
+        self.assertTrue(self.tracer.last_turn.error.startswith(
+            'channel unavailable'))
+
+    def test_converse_is_not_retried(self):
+        converse = push_red_to_talk.SampleAssistant.converse
+        with push_red_to_talk.SampleAssistant(
+                conversation_stream=self.manager.conversation_stream(),
+                channel=self.channel,
+                deadline_sec=push_red_to_talk.DEFAULT_GRPC_DEADLINE,
+                channel_monitor=self.monitor,
+                tracer=self.tracer) as assistant:
+            with self.assertRaises(channel_helpers.ChannelUnavailableError):
+                assistant.converse()
+
+        self.assertEqual(converse.statistics['attempt_number'], 1)
+        self.assertEqual(self.tracer.turns, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the access token cache of CredentialManager."""
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import credentials_manager
+import fake_assistant
+
+
+# Seconds to wait for a background refresh.
+REFRESH_TIMEOUT = 5
+
+
+class CredentialManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.credentials_path = os.path.join(self.dir, 'credentials.json')
+        self.cache_path = os.path.join(self.dir,
+                                       credentials_manager.TOKEN_CACHE_FILE)
+        self.write_credentials('refresh-token')
+        self.server = fake_assistant.FakeTokenServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def write_credentials(self, refresh_token):
+        with open(self.credentials_path, 'w') as f:
+            json.dump({
+                'client_id': 'client-id',
+                'client_secret': 'client-secret',
+                'refresh_token': refresh_token,
+                'token_uri': 'https://oauth2.googleapis.com/token',
+            }, f)
+
+    def manager(self, **kwargs):
+        manager = credentials_manager.CredentialManager(
+            self.credentials_path, token_uri=self.server.token_uri, **kwargs)
+        manager.load()
+        return manager
+
+    def test_cache_miss_fetches_a_token(self):
+        manager = self.manager()
+        self.assertIsNone(manager.credentials.token)
+
+        self.assertTrue(manager.ensure_valid())
+
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(manager.credentials.token, 'fake-token-1')
+        self.assertEqual(manager.cache_path, self.cache_path)
+        self.assertTrue(os.path.exists(self.cache_path))
+
+    def test_cache_hit_uses_the_cached_token(self):
+        self.manager().ensure_valid()
+
+        manager = self.manager()
+
+        self.assertEqual(manager.credentials.token, 'fake-token-1')
+        self.assertFalse(manager.ensure_valid())
+        self.assertEqual(self.server.requests, 1)
+
+    def test_other_credentials_invalidate_the_cache(self):
+        self.manager().ensure_valid()
+        self.write_credentials('other-refresh-token')
+
+        manager = self.manager()
+
+        self.assertIsNone(manager.credentials.token)
+        self.assertTrue(manager.ensure_valid())
+        self.assertEqual(manager.credentials.token, 'fake-token-2')
+
+    def test_cache_is_only_readable_by_the_owner(self):
+        self.manager().ensure_valid()
+
+        mode = stat.S_IMODE(os.stat(self.cache_path).st_mode)
+        self.assertEqual(mode, 0o600)
+        self.assertFalse(os.path.exists(self.cache_path + '.tmp'))
+
+    def test_refreshes_ahead_of_expiry(self):
+        self.server.expires_in = 2
+        manager = self.manager()
+        manager.refresh()
+
+        manager.start()
+        try:
+            # The 5 min margin is capped at half the 2 s life of the token.
+            time.sleep(0.5)
+            self.assertEqual(manager.fetches, 1)
+            deadline = time.monotonic() + REFRESH_TIMEOUT
+            while manager.fetches < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            manager.stop()
+
+        self.assertEqual(manager.fetches, 2)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(manager.credentials.token, 'fake-token-2')
+        self.assertGreater(manager.expires_in(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the LedAnimator scheduler on the FakePwmBackend."""
+
+import threading
+import time
+import unittest
+
+import led_animator
+from led_animator import Animation, LedAnimator
+
+
+PIN = 12
+# Seconds to wait for the scheduler thread to exit.
+JOIN_TIMEOUT = 2
+
+
+def animator_threads():
+    return [thread for thread in threading.enumerate()
+            if thread.name == 'led-animator']
+
+
+class RecordingPwmBackend(led_animator.FakePwmBackend):
+    """FakePwmBackend keeping every duty cycle set."""
+
+    def __init__(self):
+        super(RecordingPwmBackend, self).__init__()
+        self.history = []
+
+    def set_duty_cycle(self, pin, duty_cycle):
+        self.history.append(duty_cycle)
+        super(RecordingPwmBackend, self).set_duty_cycle(pin, duty_cycle)
+
+
+class StallingPwmBackend(led_animator.FakePwmBackend):
+    """FakePwmBackend blocking on its first duty cycle change."""
+
+    def __init__(self, stall):
+        super(StallingPwmBackend, self).__init__()
+        self.stall = stall
+
+    def set_duty_cycle(self, pin, duty_cycle):
+        if not self.changes:
+            time.sleep(self.stall)
+        super(StallingPwmBackend, self).set_duty_cycle(pin, duty_cycle)
+
+
+class LedAnimatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = led_animator.FakePwmBackend()
+        self.animator = LedAnimator(self.backend)
+
+    def tearDown(self):
+        self.animator.cleanup()
+
+    def test_join_after_stop(self):
+        self.animator.animate(PIN, led_animator.BREATHING)
+
+        self.animator.stop()
+
+        self.assertTrue(self.animator.join(JOIN_TIMEOUT))
+        self.assertEqual(animator_threads(), [])
+        self.assertEqual(self.backend.duty_cycles[PIN], 0)
+
+    def test_restarts_do_not_leak_threads(self):
+        for _ in range(5):
+            self.animator.animate(PIN, led_animator.BLINK, period=0.1)
+            self.assertEqual(len(animator_threads()), 1)
+            self.animator.stop()
+            self.assertTrue(self.animator.join(JOIN_TIMEOUT))
+            self.assertEqual(animator_threads(), [])
+
+    def test_animates_again_after_stop_without_join(self):
+        self.animator.animate(PIN, led_animator.BREATHING)
+        self.animator.stop()
+        deadline = time.monotonic() + JOIN_TIMEOUT
+        while animator_threads() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.animator.set(PIN, 70)
+
+        deadline = time.monotonic() + JOIN_TIMEOUT
+        while (self.backend.duty_cycles.get(PIN) != 70
+               and time.monotonic() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.backend.duty_cycles[PIN], 70)
+
+    def test_duty_cycles_follow_the_waveform_table(self):
+        backend = RecordingPwmBackend()
+        self.animator = LedAnimator(backend)
+        period = 0.2
+        self.animator.animate(PIN, led_animator.BREATHING, period=period)
+        time.sleep(period * 2)
+        self.animator.stop()
+        self.animator.join(JOIN_TIMEOUT)
+
+        table = led_animator.waveform_table(
+            led_animator.BREATHING, int(round(period / self.animator.tick)))
+        # Every tick but the last one, turning the LED off on stop.
+        self.assertGreater(len(backend.history), 2)
+        self.assertLessEqual(set(backend.history[:-1]), set(table))
+        self.assertGreater(len(set(backend.history)), 2)
+        self.assertEqual(backend.history[-1], 0)
+
+    def test_late_ticks_skip_ahead(self):
+        stall = 0.2
+        self.animator = LedAnimator(StallingPwmBackend(stall), tick_ms=10)
+        self.animator.animate(PIN, led_animator.BREATHING)
+        time.sleep(stall + 0.1)
+        self.animator.stop()
+        self.animator.join(JOIN_TIMEOUT)
+
+        self.assertGreaterEqual(self.animator.late_ticks, 1)
+        # The ticks missed during the stall are not caught up on.
+        self.assertLess(self.animator.ticks, 20)
+
+
+class AnimationTest(unittest.TestCase):
+
+    def test_duty_cycle_of_each_tick(self):
+        table = led_animator.waveform_table(led_animator.BREATHING, 50)
+        animation = Animation(table, period=1.0, started_at=0)
+
+        for step in range(50):
+            self.assertEqual(animation.duty_cycle_at((step + 0.5) / 50),
+                             table[step])
+
+    def test_late_lookup_skips_ahead(self):
+        animation = Animation((0, 10, 20, 30), period=0.4, started_at=0)
+
+        self.assertEqual(animation.duty_cycle_at(0.05), 0)
+        self.assertEqual(animation.duty_cycle_at(0.25), 20)
+        # And wraps around to the next period.
+        self.assertEqual(animation.duty_cycle_at(0.45), 0)
+
+    def test_phase_offsets_the_table(self):
+        animation = Animation((0, 10, 20, 30), period=0.4, phase=0.5,
+                              started_at=0)
+
+        self.assertEqual(animation.duty_cycle_at(0.05), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the PushButton event path on the FakeGpioBackend."""
+
+import queue
+import threading
+import time
+import unittest
+
+import push_button
+from push_button import PushButton, PushButtonEvent, PushButtonType
+
+
+PIN = PushButton.DEFAULT_GPIO_PIN
+# Seconds to wait for an event that is expected.
+EVENT_TIMEOUT = 2
+# Seconds during which no event is expected.
+QUIET_TIME = 0.15
+
+
+class ArmedGpioBackend(push_button.FakeGpioBackend):
+    """FakeGpioBackend telling when the button has read its initial level."""
+
+    def __init__(self, levels=None):
+        super(ArmedGpioBackend, self).__init__(levels)
+        self.armed = threading.Event()
+
+    def input(self, pin):
+        self.armed.set()
+        return super(ArmedGpioBackend, self).input(pin)
+
+
+class EventsTest(unittest.TestCase):
+    """Runs PushButton.events() on a thread and collects the events."""
+
+    edge_detection = True
+
+    def start(self, button_type=PushButtonType.NC, levels=None, **kwargs):
+        self.gpio = ArmedGpioBackend(levels)
+        self.button = PushButton(PIN, button_type=button_type,
+                                 edge_detection=self.edge_detection,
+                                 sleep_time=0.005, gpio=self.gpio, **kwargs)
+        self.events = queue.Queue()
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+        self.thread.start()
+        self.assertTrue(self.gpio.armed.wait(EVENT_TIMEOUT))
+
+    def collect(self):
+        for event in self.button.events():
+            self.events.put(event)
+
+    def tearDown(self):
+        self.button.stop()
+        self.thread.join(EVENT_TIMEOUT)
+        self.assertFalse(self.thread.is_alive())
+
+    def set_level(self, high):
+        self.gpio.set_input(PIN, high)
+
+    def assertEvents(self, *expected):
+        for event in expected:
+            self.assertEqual(self.events.get(timeout=EVENT_TIMEOUT), event)
+
+    def assertNoEvent(self):
+        with self.assertRaises(queue.Empty):
+            self.events.get(timeout=QUIET_TIME)
+
+    def test_normally_closed_is_pressed_on_high(self):
+        self.start(PushButtonType.NC, long_press_time=None)
+
+        self.set_level(True)
+        self.assertEvents(PushButtonEvent.PRESS)
+        self.set_level(False)
+        self.assertEvents(PushButtonEvent.RELEASE)
+
+    def test_normally_open_is_pressed_on_low(self):
+        self.start(PushButtonType.NO, levels={PIN: 1}, long_press_time=None)
+
+        self.set_level(False)
+        self.assertEvents(PushButtonEvent.PRESS)
+        self.set_level(True)
+        self.assertEvents(PushButtonEvent.RELEASE)
+
+    def test_held_button_fires_once(self):
+        self.start(long_press_time=None)
+
+        self.set_level(True)
+        self.assertEvents(PushButtonEvent.PRESS)
+        self.assertNoEvent()
+
+    def test_long_press_then_release(self):
+        self.start(long_press_time=0.05)
+
+        self.set_level(True)
+        self.assertEvents(PushButtonEvent.PRESS, PushButtonEvent.LONG_PRESS)
+        # Reported once however long the button is held.
+        self.assertNoEvent()
+        self.set_level(False)
+        self.assertEvents(PushButtonEvent.RELEASE)
+
+    def test_short_press_is_not_long(self):
+        self.start(long_press_time=0.5)
+
+        self.set_level(True)
+        self.assertEvents(PushButtonEvent.PRESS)
+        self.set_level(False)
+        self.assertEvents(PushButtonEvent.RELEASE)
+        self.assertNoEvent()
+
+
+class EdgeEventsTest(EventsTest):
+
+    def test_bounces_are_ignored(self):
+        self.start(long_press_time=None, debounce_time=0.1)
+
+        for high in (True, False, True, False, True):
+            self.set_level(high)
+        self.assertEvents(PushButtonEvent.PRESS)
+        self.assertNoEvent()
+
+    def test_level_is_read_again_once_settled(self):
+        self.start(long_press_time=None, debounce_time=0.1)
+
+        self.set_level(True)
+        self.assertEvents(PushButtonEvent.PRESS)
+        # Released while the contacts settle.
+        self.set_level(False)
+        self.assertEvents(PushButtonEvent.RELEASE)
+        self.assertNoEvent()
+
+    def test_stop_without_events(self):
+        self.start()
+
+
+class PolledEventsTest(EventsTest):
+
+    edge_detection = False
+
+
+class WaitForPushTest(unittest.TestCase):
+
+    def test_one_call_per_push(self):
+        gpio = ArmedGpioBackend()
+        button = PushButton(PIN, gpio=gpio, long_press_time=None)
+        pushes = queue.Queue()
+        thread = threading.Thread(
+            target=button.wait_for_push,
+            args=(lambda **kwargs: pushes.put(kwargs),),
+            kwargs=dict(turn='first'), daemon=True)
+        thread.start()
+        self.assertTrue(gpio.armed.wait(EVENT_TIMEOUT))
+
+        gpio.set_input(PIN, True)
+        self.assertEqual(pushes.get(timeout=EVENT_TIMEOUT), {'turn': 'first'})
+        time.sleep(QUIET_TIME)
+        gpio.set_input(PIN, False)
+        time.sleep(QUIET_TIME)
+        button.stop()
+        thread.join(EVENT_TIMEOUT)
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(pushes.empty())
+
+
+class PushButtonTypeTest(unittest.TestCase):
+
+    def test_is_triggered(self):
+        self.assertTrue(PushButtonType.NC.is_triggered(True))
+        self.assertFalse(PushButtonType.NC.is_triggered(False))
+        self.assertTrue(PushButtonType.NO.is_triggered(False))
+        self.assertFalse(PushButtonType.NO.is_triggered(True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+# Copyright (C) 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-turn latency tracing from button press to end of playback."""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+
+# Spans of a turn, in the order they normally happen. Each one is the
+# time in milliseconds from the start of the turn (the button push).
+PUSH = 'push'
+BLEEP_START = 'bleep_start'
+BLEEP_END = 'bleep_end'
+DEVICE_OPEN = 'device_open'
+FIRST_REQUEST_SENT = 'first_request_sent'
+END_OF_UTTERANCE = 'end_of_utterance'
+FIRST_AUDIO_OUT = 'first_audio_out'
+FIRST_AUDIO_WRITTEN = 'first_audio_written'
+LAST_AUDIO_WRITTEN = 'last_audio_written'
+STOP_PLAYBACK = 'stop_playback'
+SPANS = (PUSH, BLEEP_START, BLEEP_END, DEVICE_OPEN, FIRST_REQUEST_SENT,
+         END_OF_UTTERANCE, FIRST_AUDIO_OUT, FIRST_AUDIO_WRITTEN,
+         LAST_AUDIO_WRITTEN, STOP_PLAYBACK)
+
+# Counters of a turn.
+BYTES_SENT = 'bytes_sent'
+BYTES_RECEIVED = 'bytes_received'
+XRUNS = 'xruns'
+
+DEFAULT_PERCENTILE_WINDOW = 200
+PROMETHEUS_PREFIX = 'piterkom_turn'
+GAUGE_PREFIX = 'piterkom'
+
+
+class TurnTrace(object):
+    """Timing marks and counters of one conversation turn.
+
+    Args:
+      turn: sequence number of the turn.
+      started_at: time.monotonic() of the start of the turn.
+    """
+    def __init__(self, turn, started_at=None):
+        self.turn = turn
+        self.started_at = (time.monotonic() if started_at is None
+                           else started_at)
+        self.wall_time = time.time() - (time.monotonic() - self.started_at)
+        self.marks = {PUSH: self.started_at}
+        self.counters = collections.Counter()
+        self.error = None
+        self._lock = threading.Lock()
+
+    def mark(self, span, at=None, overwrite=False):
+        """Record the time of a span.
+
+        Args:
+          span: name of the span, one of SPANS.
+          at: time.monotonic() of the span, defaults to now.
+          overwrite: replace an earlier mark of the same span, otherwise
+            the first one is kept.
+        """
+        at = time.monotonic() if at is None else at
+        with self._lock:
+            if overwrite or span not in self.marks:
+                self.marks[span] = at
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def spans_ms(self):
+        """Returns the milliseconds from the start to each marked span."""
+        with self._lock:
+            return {span: (at - self.started_at) * 1000
+                    for span, at in self.marks.items()}
+
+    def to_dict(self):
+        return {
+            'turn': self.turn,
+            'time': self.wall_time,
+            'spans_ms': self.spans_ms(),
+            'counters': dict(self.counters),
+            'error': self.error,
+        }
+
+
+class TurnTracer(object):
+    """Collects the traces of conversation turns.
+
+    Finished turns are appended as JSON lines to jsonl_path and the
+    p50/p95 of each span over the last turns are written as a Prometheus
+    text file (for the node exporter textfile collector) to
+    prometheus_path.
+
+    Args:
+      jsonl_path: optional file the finished turns are appended to.
+      prometheus_path: optional file the aggregates are written to.
+      window: number of recent turns the percentiles are computed over.
+    """
+    def __init__(self, jsonl_path=None, prometheus_path=None,
+                 window=DEFAULT_PERCENTILE_WINDOW):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self._history = collections.deque(maxlen=window)
+        self._current = None
+        self._turns = 0
+        self._totals = collections.Counter()
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        """The TurnTrace of the turn in progress, if any."""
+        return self._current
+
+    @property
+    def turns(self):
+        """Number of turns started so far."""
+        return self._turns
+
+    @property
+    def last_turn(self):
+        """The TurnTrace of the last finished turn, if any."""
+        with self._lock:
+            return self._history[-1] if self._history else None
+
+    def start_turn(self, started_at=None):
+        """Start tracing a new turn, dropping an unfinished one."""
+        with self._lock:
+            self._turns += 1
+            self._current = TurnTrace(self._turns, started_at)
+            return self._current
+
+    def mark(self, span, at=None, overwrite=False):
+        """Mark a span of the current turn, see TurnTrace.mark()."""
+        trace = self._current
+        if trace is not None:
+            trace.mark(span, at, overwrite)
+
+    def count(self, counter, value=1):
+        """Add to a counter of the current turn."""
+        trace = self._current
+        if trace is not None:
+            trace.count(counter, value)
+
+    def set_gauge(self, name, value):
+        """Set a gauge exported along the turns, e.g. the token fetch time.
+
+        The Prometheus file is written right away.
+        """
+        self.set_gauges({name: value})
+
+    def set_gauges(self, gauges):
+        """Set several gauges, writing the Prometheus file once."""
+        with self._lock:
+            self._gauges.update(gauges)
+        if self.prometheus_path:
+            try:
+                self.write_prometheus(self.prometheus_path)
+            except IOError as e:
+                logging.warning('Error exporting gauges %s: %s',
+                                ', '.join(sorted(gauges)), e)
+
+    def finish_turn(self, error=None):
+        """Finish the current turn and export it.
+
+        Args:
+          error: optional description of the error that ended the turn.
+        """
+        with self._lock:
+            trace, self._current = self._current, None
+            if trace is None:
+                return None
+            trace.error = error
+            self._history.append(trace)
+            self._totals.update(trace.counters)
+        record = trace.to_dict()
+        logging.info('Turn %d spans (ms): %s', trace.turn, ', '.join(
+            '%s=%.0f' % (span, ms) for span, ms in sorted(
+                record['spans_ms'].items(), key=lambda item: item[1])))
+        try:
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+            if self.prometheus_path:
+                self.write_prometheus(self.prometheus_path)
+        except IOError as e:
+            logging.warning('Error exporting turn trace: %s', e)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Turn span percentiles (ms): %s', self.percentiles())
+        return trace
+
+    def percentiles(self, percentiles=(50, 95)):
+        """Returns {span: {percentile: ms}} over the recent turns."""
+        with self._lock:
+            history = list(self._history)
+        values = collections.defaultdict(list)
+        for trace in history:
+            for span, ms in trace.spans_ms().items():
+                values[span].append(ms)
+        return {span: dict(zip(percentiles,
+                               np.percentile(ms, percentiles).tolist()))
+                for span, ms in values.items()}
+
+    def write_prometheus(self, path):
+        """Write the aggregates in the Prometheus text format, atomically."""
+        lines = [
+            '# HELP %s_span_milliseconds Time from the button push to '
+            'each span of recent turns.' % PROMETHEUS_PREFIX,
+            '# TYPE %s_span_milliseconds summary' % PROMETHEUS_PREFIX,
+        ]
+        for span, values in sorted(self.percentiles().items()):
+            for percentile, ms in sorted(values.items()):
+                lines.append('%s_span_milliseconds{span="%s",quantile="%s"} '
+                             '%.3f' % (PROMETHEUS_PREFIX, span,
+                                       percentile / 100.0, ms))
+        lines.append('# HELP %s_total Conversation turns traced.'
+                     % PROMETHEUS_PREFIX)
+        lines.append('# TYPE %s_total counter' % PROMETHEUS_PREFIX)
+        lines.append('%s_total %d' % (PROMETHEUS_PREFIX, self._turns))
+        for counter, value in sorted(self._totals.items()):
+            lines.append('# TYPE %s_%s_total counter'
+                         % (PROMETHEUS_PREFIX, counter))
+            lines.append('%s_%s_total %d'
+                         % (PROMETHEUS_PREFIX, counter, value))
+        with self._lock:
+            gauges = sorted(self._gauges.items())
+        for name, value in gauges:
+            lines.append('# TYPE %s_%s gauge' % (GAUGE_PREFIX, name))
+            lines.append('%s_%s %.3f' % (GAUGE_PREFIX, name, value))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, path)